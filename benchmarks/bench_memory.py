@@ -0,0 +1,130 @@
+'''
+Benchmark the memory taken by the mails a campaign keeps queued, and
+by mailing lists held in memory.
+
+Creates ROWS personalised mails with MailFactory, the way a
+TransactionMailCampaign that isn't streaming does, and keeps them in a
+list. This is done once with envelopes.Envelope and once with
+envelopes.CompactEnvelope (what the campaigns use). Prints the bytes
+allocated per queued mail for both, measured with tracemalloc, and how
+many of those bytes are the rendered subjects and bodies, which both
+kinds of envelopes keep as they are.
+
+Then holds a mailing list of ROWS receivers with COLUMNS fields in
+memory, once as a list of {"email", "variables"} dictionaries and once
+as a deltamail.mailinglist.MailingList, and prints the bytes allocated
+per receiver for both, values not included.
+
+Usage:
+    python benchmarks/bench_memory.py [--rows ROWS] [--columns COLUMNS]
+
+Needs Python 3 (for tracemalloc).
+'''
+import argparse
+import gc
+import os
+import sys
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from deltamail.mail import MailFactory, compile_template
+from deltamail.mailinglist import MailingList
+
+SUBJECT = "Hey {{name}}, greetings from {{company}}"
+TEMPLATE = os.path.join(os.path.dirname(__file__), os.pardir, "tests",
+                        "testCampaignFactory-files", "template.mmtmpl")
+
+
+def run(rows, subject, template_str, compact):
+    '''
+    Queue `rows` mails. Returns the bytes allocated per mail, and the
+    size of its subject and body.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    mails = []
+    for i in range(rows):
+        variables = {
+            "company": "Festember",
+            "copyright": "2015",
+            "name": "User%d" % i,
+            "msg": "You are selected.",
+        }
+        mails.append(MailFactory("sender@example.com", subject, ["user%d@example.com" % i],
+                                 template_str, variables, compact=compact))
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    texts = sum(sys.getsizeof(mail._subject) + sys.getsizeof(mail._parts[0][1])
+                for mail in mails)
+    return float(allocated) / rows, float(texts) / rows
+
+
+def run_mailing_list(rows, columns, columnar):
+    '''
+    Hold a mailing list of `rows` receivers with `columns` fields. Returns
+    the bytes allocated per receiver, not counting the values.
+    '''
+    headers = ["email"] + ["field%d" % i for i in range(columns)]
+    # made before measuring: the values are the same either way
+    values = [["user%d@example.com" % i] + ["value %d-%d" % (i, j) for j in range(columns)]
+              for i in range(rows)]
+
+    gc.collect()
+    tracemalloc.start()
+    if columnar:
+        mailing_list = MailingList(headers, values)
+    else:
+        mailing_list = [{"email": row[0], "variables": dict(zip(headers[1:], row[1:]))}
+                        for row in values]
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    del mailing_list
+    return float(allocated) / rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Queued mail memory benchmark")
+    parser.add_argument('--rows', type=int, default=100000,
+                        help="number of mails to queue. Defaults to 100000")
+    parser.add_argument('--columns', type=int, default=25,
+                        help="number of fields of the mailing list. Defaults to 25")
+    args = parser.parse_args()
+
+    if tracemalloc is None:
+        sys.exit("bench_memory.py needs Python 3")
+
+    ftmpl = open(TEMPLATE, "r")
+    template_str = compile_template(ftmpl.read())
+    ftmpl.close()
+    subject = compile_template(SUBJECT)
+    # render once, so that jinja's own caches aren't counted
+    MailFactory("sender@example.com", subject, [], template_str, {"name": ""})
+
+    results = {}
+    for name, compact in (("Envelope", False), ("CompactEnvelope", True)):
+        per_mail, texts = run(args.rows, subject, template_str, compact)
+        results[name] = per_mail
+        print("%-16s %8.0f bytes/mail (%.0f of them subject and body)"
+              % (name, per_mail, texts))
+
+    saved = results["Envelope"] - results["CompactEnvelope"]
+    print("%-16s %8.0f bytes/mail (%.0f%%)"
+          % ("saved", saved, saved * 100 / results["Envelope"]))
+
+    print("")
+    dicts = run_mailing_list(args.rows, args.columns, False)
+    columnar = run_mailing_list(args.rows, args.columns, True)
+    print("%-16s %8.0f bytes/receiver" % ("dict per row", dicts))
+    print("%-16s %8.0f bytes/receiver (%.1fx less)"
+          % ("MailingList", columnar, dicts / columnar))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+'''
+Benchmark the per-receiver rendering done by TransactionMailCampaign.
+
+Renders the same subject and body templates for ROWS receivers, once by
+handing MailFactory the template strings (every mail compiles the
+templates again) and once by handing it templates compiled up-front
+(what the campaigns do). Prints the time taken per ROWS rows for both.
+
+Usage:
+    python benchmarks/bench_render.py [--rows ROWS]
+'''
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from deltamail.mail import MailFactory, compile_template
+
+SUBJECT = "Hey {{name}}, greetings from {{company}}"
+TEMPLATE = os.path.join(os.path.dirname(__file__), os.pardir, "tests",
+                        "testCampaignFactory-files", "template.mmtmpl")
+
+
+def run(rows, subject, template_str):
+    '''Create `rows` mails and return the time it took, in seconds.'''
+    start = time.time()
+    for i in range(rows):
+        variables = {
+            "company": "Festember",
+            "copyright": "2015",
+            "name": "User%d" % i,
+            "msg": "You are selected.",
+        }
+        MailFactory("sender@example.com", subject, ["user%d@example.com" % i],
+                    template_str, variables)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MailFactory rendering benchmark")
+    parser.add_argument('--rows', type=int, default=100000,
+                        help="number of mails to render")
+    args = parser.parse_args()
+
+    ftmpl = open(TEMPLATE, "r")
+    template_str = ftmpl.read()
+    ftmpl.close()
+
+    before = run(args.rows, SUBJECT, template_str)
+    after = run(args.rows, compile_template(SUBJECT), compile_template(template_str))
+
+    print("rows: %d" % args.rows)
+    print("compiled per mail:     %8.2fs (%.1f us/mail)"
+          % (before, before * 1e6 / args.rows))
+    print("compiled per campaign: %8.2fs (%.1f us/mail)"
+          % (after, after * 1e6 / args.rows))
+    print("speedup: %.1fx" % (before / after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+'''
+Benchmark sending whole campaigns to a local SMTP sink.
+
+Generates synthetic .ml files of each of the given sizes, with and
+without an attachment per row, and sends a streaming
+TransactionMailCampaign for each of them to the SMTP sink of the tests
+(tests/smtpsink.py), which runs in a process of its own. Each campaign
+is also sent from a process of its own, so that the peak RSS is that
+campaign's.
+
+Prints one JSON document with a result per campaign:
+    rows, attachments, concurrency: what was sent
+    messages: number of mails sent
+    seconds, msgs_per_sec: from creating the campaign to the last mail
+    latency_ms: p50 and p99 of the time each mail spent in
+        smtp_conn.send (serializing it and the SMTP transaction)
+    peak_rss_kb: peak resident memory of the sending process
+    phases: seconds spent rendering, building the MIME messages,
+        serializing them and in SMTP transactions (see envelopes.stats)
+
+Usage:
+    python benchmarks/bench_send.py [--rows 1k,100k,1M] [--attachments both]
+                                    [-c CONCURRENCY] [--fast_serialize]
+                                    [--output FILE]
+
+The generated files are kept in --workdir (a temporary directory by
+default), so that they can be reused with --workdir.
+
+Needs Python 3.7 or later, as the sink is built on asyncio.
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from deltamail import envelopes_mod as envelopes
+from deltamail.campaign import CampaignFactory
+
+SUBJECT = "Hey {{name}}, greetings from {{company}}"
+TEMPLATE = os.path.join(os.path.dirname(__file__), os.pardir, "tests",
+                        "testCampaignFactory-files", "template.mmtmpl")
+SINK = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "smtpsink.py")
+
+# Size of the file attached to every row, in bytes
+ATTACHMENT_SIZE = 100 * 1024
+
+
+def parse_count(count):
+    '''"1k" -> 1000, "1M" -> 1000000, "25" -> 25'''
+    multipliers = {"k": 1000, "K": 1000, "m": 1000000, "M": 1000000}
+    if count[-1] in multipliers:
+        return int(count[:-1]) * multipliers[count[-1]]
+    return int(count)
+
+
+def write_campaign(workdir, rows, attachments):
+    '''
+    Write the .ml file (and the attachment it refers to) for a campaign,
+    unless it's there from a previous run. Returns its path.
+    '''
+    fname = os.path.join(workdir, "%d%s.ml" % (rows, "-attachments" if attachments else ""))
+    if os.path.exists(fname):
+        return fname
+
+    attachment = os.path.join(workdir, "brochure.pdf")
+    if attachments and not os.path.exists(attachment):
+        fattch = open(attachment, "wb")
+        fattch.write(os.urandom(ATTACHMENT_SIZE))
+        fattch.close()
+
+    # written to a temporary name first, so an interrupted run doesn't
+    # leave a short file behind
+    fml = open(fname + ".part", "w")
+    fml.write("email\tname\tmsg" + ("\t$attachments" if attachments else "") + "\n")
+    for i in range(rows):
+        row = "user%d@example.com\tUser%d\tYou are selected, User%d." % (i, i, i)
+        if attachments:
+            row += "\t" + attachment
+        fml.write(row + "\n")
+    fml.close()
+    os.rename(fname + ".part", fname)
+    return fname
+
+
+def write_globals(workdir):
+    fname = os.path.join(workdir, "globals.mvar")
+    fglbl = open(fname, "w")
+    fglbl.write("company=Festember\ncopyright=2015\n")
+    fglbl.close()
+    return fname
+
+
+class TimedSender(object):
+    '''Wraps an SMTP connection and records how long each send takes.'''
+
+    def __init__(self, smtp_conn):
+        self._smtp_conn = smtp_conn
+        self._lock = threading.Lock()
+        self.latencies = []
+
+    def send(self, envelope):
+        start = time.time()
+        result = self._smtp_conn.send(envelope)
+        elapsed = time.time() - start
+        with self._lock:
+            self.latencies.append(elapsed)
+        return result
+
+
+def percentile(values, percent):
+    '''Nearest-rank percentile of an already sorted list'''
+    if not values:
+        return None
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+
+def run_case(ml_file, globals_file, port, concurrency, fast_serialize=False):
+    '''Send the campaign of `ml_file` to the sink. Returns the result.'''
+    envelopes.Envelope.fast_serialize = fast_serialize
+    envelopes.stats.enable()
+    start = time.time()
+    campaign = CampaignFactory("sender@example.com", SUBJECT, ml_file, TEMPLATE,
+                               globals_file, streaming=True)
+
+    if concurrency > 1:
+        conn = envelopes.SMTPPool(concurrency, "127.0.0.1", port)
+    else:
+        conn = envelopes.conn.SMTP("127.0.0.1", port)
+    sender = TimedSender(conn)
+    campaign.send(sender, concurrency)
+    seconds = time.time() - start
+
+    latencies = sorted(sender.latencies)
+    timers = envelopes.stats.snapshot()["timers"]
+    return {
+        "messages": len(latencies),
+        "seconds": round(seconds, 3),
+        "msgs_per_sec": round(len(latencies) / seconds, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+        },
+        "peak_rss_kb": peak_rss_kb(),
+        "phases": dict((name, round(seconds, 3))
+                       for name, (_, seconds) in timers.items()),
+    }
+
+
+def start_sink():
+    sink = subprocess.Popen([sys.executable, SINK], stdout=subprocess.PIPE)
+    port = int(sink.stdout.readline())
+    return sink, port
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Campaign sending benchmark. "
+                                     "Needs Python 3.7 or later")
+    parser.add_argument('--rows', default="1k,100k,1M",
+                        help="comma separated campaign sizes. Defaults to 1k,100k,1M")
+    parser.add_argument('--attachments', choices=["both", "yes", "no"], default="both",
+                        help="send campaigns with an attachment per row, without, or both")
+    parser.add_argument('-c', '--concurrency', type=int, default=1,
+                        help="number of SMTP connections to send over")
+    parser.add_argument('--fast_serialize', action='store_true',
+                        help="serialize with Envelope.as_bytes (see envelopes.serializer)")
+    parser.add_argument('--workdir', help="directory for the generated files")
+    parser.add_argument('--output', help="write the JSON there instead of stdout")
+
+    # used to run one campaign in a child process
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--globals', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        result = run_case(args.case, args.globals, args.port, args.concurrency,
+                          args.fast_serialize)
+        print(json.dumps(result))
+        return
+
+    if sys.version_info < (3, 7):
+        parser.error("the SMTP sink (tests/smtpsink.py) needs Python 3.7 or later")
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="deltamail-bench-")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    globals_file = write_globals(workdir)
+
+    attachments = {"both": [False, True], "yes": [True], "no": [False]}[args.attachments]
+
+    results = []
+    sink, port = start_sink()
+    try:
+        for rows in [parse_count(count) for count in args.rows.split(",")]:
+            for with_attachments in attachments:
+                ml_file = write_campaign(workdir, rows, with_attachments)
+                output = subprocess.check_output([
+                    sys.executable, __file__, "--case", ml_file,
+                    "--globals", globals_file, "--port", str(port),
+                    "--concurrency", str(args.concurrency),
+                ] + (["--fast_serialize"] if args.fast_serialize else []))
+
+                result = {"rows": rows, "attachments": with_attachments,
+                          "concurrency": args.concurrency,
+                          "fast_serialize": args.fast_serialize}
+                result.update(json.loads(output.decode("utf-8")))
+                results.append(result)
+                sys.stderr.write("%d rows%s: %.1f msgs/sec\n" % (
+                    rows, " with attachments" if with_attachments else "",
+                    result["msgs_per_sec"]))
+    finally:
+        sink.terminate()
+        sink.wait()
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    report = json.dumps({
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }, indent=2, sort_keys=True)
+
+    if args.output:
+        fout = open(args.output, "w")
+        fout.write(report + "\n")
+        fout.close()
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
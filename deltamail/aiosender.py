@@ -0,0 +1,60 @@
+'''Sends the mails of a campaign from a single asyncio event loop
+
+This is the asyncio counterpart of deltamail.sender. Use the send_async
+coroutine along with an envelopes_mod.aio.AsyncSMTPPool. Requires
+Python 3.7 or later.
+'''
+import asyncio
+
+# Put in the queue to tell a worker to stop
+_STOP = object()
+
+
+async def send_async(mails, smtp_conn, workers):
+    '''
+    Send the mails from `workers` coroutines.
+
+    Works like deltamail.sender.send_parallel, but with coroutines on
+    the running event loop instead of threads, so `workers` can be in
+    the thousands.
+
+    Args:
+        mails (iterable): The envelopes.Envelope objects to be sent.
+        smtp_conn (envelopes_mod.aio.AsyncSMTPPool): Used to do the actual
+            sending. The pool should have at least `workers` connections,
+            otherwise some workers just wait for the others.
+        workers (int): Number of mails to be in flight at once.
+
+    Returns:
+        None
+    '''
+    queue = asyncio.Queue(maxsize=workers * 2)
+    errors = []
+
+    async def work():
+        while True:
+            mail = await queue.get()
+            if mail is _STOP:
+                return
+            if errors:
+                continue
+
+            try:
+                await smtp_conn.send(mail)
+            except Exception as e:
+                errors.append(e)
+
+    tasks = [asyncio.ensure_future(work()) for _ in range(workers)]
+
+    try:
+        for mail in mails:
+            if errors:
+                break
+            await queue.put(mail)
+    finally:
+        for task in tasks:
+            await queue.put(_STOP)
+        await asyncio.gather(*tasks)
+
+    if errors:
+        raise errors[0]
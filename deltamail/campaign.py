@@ -12,43 +12,80 @@ TODO(thakkarparth007): Handle previewing in a better manner.
 '''
 
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+import hashlib
+from itertools import islice
 import os
 
-from deltamail.mail import MailFactory
+from deltamail import envelopes_mod as envelopes
+from deltamail.journal import JournaledSender
+from deltamail.mail import MailFactory, compile_template
+from deltamail.mailinglist import MailingListFile
+from deltamail.preview import MBOX, open_mailbox
+from deltamail.render import render_parallel
+from deltamail.sender import send_parallel
 
 # Upper limit on preview-file name length
 MAX_PREVIEW_FILE_LEN = 70
 
+# "To" header of bulk mails sent to batches of BCC recipients
+UNDISCLOSED_RECIPIENTS = "undisclosed-recipients:;"
+
+# Number of distinct mails a deduplicating TransactionMailCampaign holds
+# back, waiting for more receivers of the same mail
+DEDUP_WINDOW = 1000
+
+# Most receivers a deduplicated mail is sent to when no batch_size is given
+DEDUP_GROUP_SIZE = 100
+
+# Number of serialized mails a TransactionMailCampaign whose templates
+# use no personal variables keeps, one per distinct $attachments
+SHARED_MAILS = 1000
+
 
 class Campaign(object):
     '''
     Abstract class. Used to handle a bunch of mails to be sent.
 
     *-Campaign objects inherit from Campaign.
-    *-Campaign objects just fill the _mails list, and
+    *-Campaign objects just generate the mails to be sent, and
     The sending and previewing is done here itself.
+
+    By default all the mails are created upfront and kept in the _mails
+    list. A streaming campaign doesn't keep any mails around: they are
+    created one at a time while the campaign is being sent or previewed.
     '''
     __metaclass__ = ABCMeta
 
     @abstractmethod
-    def _create_mail_objects(self, from_addr, subject, mailing_list, template_str, global_vars):
+    def _generate_mails(self, from_addr, subject, mailing_list, template_str, global_vars):
         '''
-        Populate the self._mails list
+        Yield the mails (envelopes.Envelope objects) of the campaign.
 
-        Called by __init__
         This is the only method that is to be implemented by the *-Campaign
-        classes. It fills the _mails list and the other operations on
+        classes. It generates the mails and the other operations on
         Campaign classes are all the same, and hence are defined in the
         Campaign class itself.
         '''
         pass
 
-    def __init__(self, from_addr, subject, mailing_list, template_str, global_vars):
+    def _create_mail_objects(self, from_addr, subject, mailing_list, template_str, global_vars):
+        '''
+        Populate the self._mails list
+
+        Called by __init__ for non-streaming campaigns.
+        '''
+        self._mails = list(self._generate_mails(
+            from_addr, subject, mailing_list, template_str, global_vars
+        ))
+
+    def __init__(self, from_addr, subject, mailing_list, template_str, global_vars,
+                 streaming=False):
         '''
         Initialise the Campaign class.
 
-        Calls the (abstract) _create_mail_objects method and populates
-        the the self._mails list.
+        Calls the _create_mail_objects method and populates
+        the the self._mails list, unless the campaign is streaming.
 
         Args:
             from_addr (str): The "From" address for the mail being sent.
@@ -59,15 +96,46 @@ class Campaign(object):
             template_str (str): The template string for the mail.
             global_vars (dict): The dictionary of global variables to fill
                 up the template.
+            streaming (Optional[bool]): If True, the mails aren't created
+                here. They are created one by one, each time the campaign
+                is sent or previewed, and dropped as soon as they are done
+                with. mailing_list must then be iterable more than once
+                if the campaign is to be used more than once. Defaults to
+                False.
+
+            subject and template_str can also be compiled templates (see
+            deltamail.mail.compile_template). Strings are compiled here,
+            once for the whole campaign.
 
         Returns:
             None
         '''
-        # will store the mail objects to be sent
-        self._mails = []
-        self._create_mail_objects(from_addr, subject, mailing_list, template_str, global_vars)
+        subject = compile_template(subject)
+        template_str = compile_template(template_str)
+
+        self._campaign_args = (from_addr, subject, mailing_list, template_str, global_vars)
+
+        # each attached file is read and encoded once for all the mails
+        self._attachment_cache = envelopes.AttachmentCache()
+
+        # will store the mail objects to be sent.
+        # None for streaming campaigns.
+        self._mails = None
+        if not streaming:
+            self._create_mail_objects(*self._campaign_args)
 
-    def send(self, smtp_conn):
+    def _iter_mails(self):
+        '''
+        Iterate over the mails of the campaign.
+
+        Yields the mails from the _mails list, or, for streaming campaigns,
+        creates them as they are asked for.
+        '''
+        if self._mails is not None:
+            return iter(self._mails)
+        return self._generate_mails(*self._campaign_args)
+
+    def send(self, smtp_conn, concurrency=1, journal=None):
         '''
         Send the mails.
 
@@ -76,15 +144,53 @@ class Campaign(object):
         of the envelopes.Envelope objects in the Campaign. Just a
         helper/syntactic sugar.
 
+        With concurrency > 1, the mails are sent from that many threads
+        (see deltamail.sender.send_parallel). smtp_conn must then be an
+        envelopes.SMTPPool with (at least) that many connections.
+
         Args:
             smtp_conn (envelopes.conn.SMTP): Used to do the actual sending
+            concurrency (Optional[int]): Number of mails to send at once.
+                Defaults to 1.
+            journal (Optional[deltamail.journal.SendJournal]): If given,
+                what happens to each receiver is recorded in it.
 
         Returns:
             None
         '''
-        for mail in self._mails:
+        if journal is not None:
+            smtp_conn = JournaledSender(smtp_conn, journal)
+
+        if concurrency > 1:
+            send_parallel(self._iter_mails(), smtp_conn, concurrency)
+            return
+
+        for mail in self._iter_mails():
             smtp_conn.send(mail)
 
+    def send_async(self, smtp_conn, concurrency=1):
+        '''
+        Send the mails from the running asyncio event loop.
+
+        Returns a coroutine, to be awaited. Up to `concurrency` mails are
+        sent at once (see deltamail.aiosender.send_async). Requires
+        Python 3.7 or later.
+
+        Args:
+            smtp_conn (envelopes_mod.aio.AsyncSMTPPool): Used to do the
+                actual sending. Should have (at least) `concurrency`
+                connections.
+            concurrency (Optional[int]): Number of mails to send at once.
+                Defaults to 1.
+
+        Returns:
+            coroutine
+        '''
+        # imported here as it doesn't even compile on Python 2
+        from deltamail.aiosender import send_async
+
+        return send_async(self._iter_mails(), smtp_conn, concurrency)
+
     def preview(self, location="", preview_count=-1):
         '''
         Generate the html files to be sent in the `location` folder.
@@ -117,14 +223,7 @@ class Campaign(object):
                 .format(os.path.abspath(location))
             )
 
-        if preview_count == -1:
-            preview_count = len(self._mails)
-
-        for mail in self._mails:
-            if preview_count <= 0:
-                    break
-            preview_count -= 1
-
+        for mail in self._preview_mails(preview_count):
             receivers = ",".join(mail.to_addr + mail.cc_addr + mail.bcc_addr)
 
             filename = mail._subject + "-" + receivers
@@ -142,6 +241,43 @@ class Campaign(object):
             fpreview.write(mail._parts[0][1])
             fpreview.close()
 
+    def preview_mailbox(self, location, mailbox_format=MBOX, preview_count=-1):
+        '''
+        Write the mails to be sent into a mailbox, for a mail client.
+
+        Unlike preview(), the whole messages are written, headers and
+        attachments included, and into a single mbox file or Maildir
+        (see deltamail.preview).
+
+        Args:
+            location (str): The mbox file (appended to if it exists) or
+                the Maildir directory (created if it doesn't exist).
+            mailbox_format (Optional[str]): "mbox" or "maildir". Defaults
+                to "mbox".
+            preview_count (Optional[int]): Number of preview mails to
+                generate. Set that to -1 if preview of all mails must
+                be generated. Defaults to -1.
+
+        Raises:
+            Exception: If the format is unknown.
+        '''
+        mailbox = open_mailbox(location, mailbox_format)
+        try:
+            for mail in self._preview_mails(preview_count):
+                mailbox.add(mail)
+        finally:
+            mailbox.close()
+
+    def _preview_mails(self, preview_count):
+        mails = self._iter_mails()
+
+        # several batches of receivers can share a mail. Preview it once.
+        mails = _unique_contents(mails)
+
+        if preview_count != -1:
+            mails = islice(mails, max(preview_count, 0))
+        return mails
+
     def preview_one_in_browser(self):
         '''
         Open the first mail in browser
@@ -165,14 +301,20 @@ class Campaign(object):
 class BulkMailCampaign(Campaign):
     '''
         Same mail sent to each person. (Allows usage of global variables)
+
+        By default the mail is sent once, with everyone in the "To"
+        header. With a batch_size, the receivers are instead sent the mail
+        as BCC, batch_size receivers per SMTP transaction. With
+        personal_to, each receiver is sent a mail of their own, with them
+        in the "To" header. Either way the mail is still rendered and
+        encoded only once.
     '''
-    def _create_mail_objects(self, from_addr, subject, mailing_list, template_str, global_vars):
+    def _generate_mails(self, from_addr, subject, mailing_list, template_str, global_vars):
         '''
-        Populate the _mails list. (Private method)
+        Yield the mail of the campaign. (Private method)
 
-        Called by __init__
         This is the only method that is to be implemented by the *-Campaign
-        classes. It fills the _mails list and the other operations on
+        classes. It generates the mails and the other operations on
         Campaign classes are all the same, and hence are defined in the
         Campaign class itself.
 
@@ -186,15 +328,58 @@ class BulkMailCampaign(Campaign):
                 contain only global variables.
             global_vars (dict): The dictionary of global variables.
 
-        Returns:
-            None
+        Yields:
+            envelopes.Envelope: The one mail sent to everyone, or, with a
+                batch_size, an envelopes.SerializedEnvelope per batch of
+                receivers, or, with personal_to, one per receiver.
         '''
-        self._mails = [MailFactory(from_addr, subject, mailing_list,
-                                   template_str, global_vars)]
+        # MailFactory pops $attachments off the variables. Hand it a copy
+        # so that the mail can be generated again.
+        if self._personal_to:
+            # serialized once; each receiver's mail only adds its To header
+            mail = envelopes.SerializedEnvelope(
+                MailFactory(from_addr, subject, [], template_str, dict(global_vars),
+                            attachment_cache=self._attachment_cache))
+            for receiver in mailing_list:
+                yield mail.addressed_copy(receiver)
+            return
+
+        if not self._batch_size:
+            yield MailFactory(from_addr, subject, mailing_list,
+                              template_str, dict(global_vars),
+                              attachment_cache=self._attachment_cache)
+            return
+
+        mail = MailFactory(from_addr, subject, [], template_str, dict(global_vars),
+                           attachment_cache=self._attachment_cache)
+        mail.add_header("To", UNDISCLOSED_RECIPIENTS)
+        mail = envelopes.SerializedEnvelope(mail)
+
+        receivers = iter(mailing_list)
+        batch = list(islice(receivers, self._batch_size))
+        while batch:
+            yield mail.bcc_copy(batch)
+            batch = list(islice(receivers, self._batch_size))
+
+    def __init__(self, from_addr, subject, mailing_list, template_str, global_vars,
+                 streaming=False, batch_size=None, personal_to=False):
+        '''
+        Initialise the BulkMailCampaign class.
+
+        Takes the same arguments as Campaign, plus:
 
-    def __init__(self, from_addr, subject, mailing_list, template_str, global_vars):
+        Args:
+            batch_size (Optional[int]): If given, the mail is sent as BCC
+                to at most that many receivers at a time. Defaults to
+                None, which sends one mail to all the receivers.
+            personal_to (Optional[bool]): Send each receiver a mail of
+                their own, addressed to them in the "To" header, instead.
+                batch_size is then ignored. Defaults to False.
+        '''
+        self._batch_size = batch_size
+        self._personal_to = personal_to
         super(BulkMailCampaign, self).__init__(
-            from_addr, subject, mailing_list, template_str, global_vars
+            from_addr, subject, mailing_list, template_str, global_vars, streaming
         )
 
     def preview(self, location=""):
@@ -215,16 +400,24 @@ class BulkMailCampaign(Campaign):
         '''
         super(BulkMailCampaign, self).preview(location, 1)
 
+    def preview_mailbox(self, location, mailbox_format=MBOX):
+        '''
+        Write the mail to be sent into a mailbox, for a mail client.
+
+        Calls the Campaign.preview_mailbox method with preview_count set
+        to 1, for the same reason as preview().
+        '''
+        super(BulkMailCampaign, self).preview_mailbox(location, mailbox_format, 1)
+
 
 class TransactionMailCampaign(Campaign):
     '''Personalised mails sent to each person.'''
-    def _create_mail_objects(self, from_addr, subject, mailing_list, template_str, global_vars):
+    def _generate_mails(self, from_addr, subject, mailing_list, template_str, global_vars):
         '''
-        Populate the _mails list. (Private method)
+        Yield the mails of the campaign, one per receiver. (Private method)
 
-        Called by __init__
         This is the only method that is to be implemented by the *-Campaign
-        classes. It fills the _mails list and the other operations on
+        classes. It generates the mails and the other operations on
         Campaign classes are all the same, and hence are defined in the
         Campaign class itself.
 
@@ -236,37 +429,252 @@ class TransactionMailCampaign(Campaign):
             subject (str): The subject of the mail. Can be a template with
                 global or personal variables.
             mailing_list (list): The list of the {"email","variables"} dicts
-                to whom the mails are to be sent.
+                to whom the mails are to be sent, or a
+                deltamail.mailinglist.MailingList.
             template_str (str): The template for the body of the mail. Can
                 contain global or personal variables.
             global_vars (dict): The dictionary of global variables.
 
-        Returns:
-            None
+        Yields:
+            envelopes.Envelope: The mail for each receiver, in order.
+                Deduplicating campaigns yield the mails in the order their
+                group is complete instead, see _dedup_mails.
+
+        The templates are analysed first (see CompiledTemplate.variables).
+        If they use none of the personal variables, the mail is rendered
+        once and shared by all the receivers, see _shared_mails.
+        Otherwise the personal variables the templates don't use are
+        left out of the rows, and the parts of the templates that only use
+        global variables are rendered once (see CompiledTemplate.bake).
+        '''
+        used = subject.variables | template_str.variables
+        columns = _row_columns(mailing_list)
+        if columns is not None and not (columns & used) and not self._dedup:
+            for mail in self._shared_mails(from_addr, subject, mailing_list,
+                                           template_str, global_vars):
+                yield mail
+            return
+
+        if columns is None or not columns <= used | set(["$attachments"]):
+            mailing_list = _used_columns(mailing_list, used)
+        if columns is not None:
+            subject = subject.bake(global_vars, columns)
+            template_str = template_str.bake(global_vars, columns)
+
+        if self._processes:
+            for mail in render_parallel(from_addr, subject, mailing_list,
+                                        template_str, global_vars, self._processes):
+                yield mail
+            return
+
+        rendered = self._render_rows(from_addr, subject, mailing_list, template_str,
+                                     global_vars)
+        if self._dedup:
+            for mail in self._dedup_mails(rendered):
+                yield mail
+            return
+
+        for mail, _ in rendered:
+            yield mail
+
+    def _render_rows(self, from_addr, subject, mailing_list, template_str, global_vars):
+        '''
+        Yield a (mail, attachments) tuple per receiver, where attachments
+        is the $attachments variable of the mail, if any.
         '''
-
-        self._mails = []
-
         for receiver in mailing_list:
             # copy the global variables in a new dict.
             # Override with personal variables if needed
             variables = dict(global_vars)
+            variables.update(receiver["variables"])
 
-            for key in receiver["variables"]:
-                variables[key] = receiver["variables"][key]
+            attachments = variables.get("$attachments", "")
+            yield MailFactory(from_addr, subject, [receiver["email"]], template_str, variables,
+                              attachment_cache=self._attachment_cache,
+                              # campaigns that aren't streaming keep them all queued
+                              compact=True), attachments
 
-            self._mails.append(
-                MailFactory(from_addr, subject, [receiver["email"]], template_str, variables)
-            )
+    def _shared_mails(self, from_addr, subject, mailing_list, template_str, global_vars):
+        '''
+        Yield the mails of a campaign whose templates use none of the
+        personal variables, one per receiver. (Private method)
+
+        The mail is rendered and serialized once, or once per distinct
+        $attachments of the receivers, and each receiver's mail only adds
+        its "To" header to it, like the mails of a BulkMailCampaign with
+        personal_to.
+
+        Yields:
+            envelopes.SerializedEnvelope: The mail for each receiver, in
+                order.
+        '''
+        mails = {}
+        for receiver in mailing_list:
+            attachments = receiver["variables"].get("$attachments")
+
+            mail = mails.get(attachments)
+            if mail is None:
+                if len(mails) >= SHARED_MAILS:
+                    mails.clear()
+
+                variables = dict(global_vars)
+                if attachments is not None:
+                    variables["$attachments"] = attachments
+                mail = mails[attachments] = envelopes.SerializedEnvelope(
+                    MailFactory(from_addr, subject, [], template_str, variables,
+                                attachment_cache=self._attachment_cache))
+
+            yield mail.addressed_copy(receiver["email"])
+
+    def _dedup_mails(self, rendered):
+        '''
+        Group the receivers whose mails have the same subject, body and
+        attachments, and yield one mail per group. (Private method)
 
-    def __init__(self, from_addr, subject, mailing_list, template_str, global_vars):
+        Mails are told apart by a hash of their contents. A group is sent
+        as soon as it has batch_size (or DEDUP_GROUP_SIZE) receivers (as
+        BCC, like a BulkMailCampaign's batches). Groups that don't fill up are sent
+        once DEDUP_WINDOW more recent groups are waiting, or at the end,
+        so memory use doesn't grow with the size of the mailing list.
+        A group of one is sent as the receiver's own mail.
+
+        Args:
+            rendered (iterable): (mail, attachments) tuples, as yielded by
+                _render_rows.
+
+        Yields:
+            envelopes.Envelope: The mail of each group.
+        '''
+        group_size = self._batch_size or DEDUP_GROUP_SIZE
+        groups = OrderedDict()
+        for mail, attachments in rendered:
+            key = _content_key(mail, attachments)
+
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = (mail, [])
+            group[1].extend(mail.to_addr)
+
+            if len(group[1]) >= group_size:
+                del groups[key]
+                yield _group_mail(key, *group)
+            elif len(groups) > DEDUP_WINDOW:
+                oldest = next(iter(groups))
+                yield _group_mail(oldest, *groups.pop(oldest))
+
+        for key, group in groups.items():
+            yield _group_mail(key, *group)
+
+    def __init__(self, from_addr, subject, mailing_list, template_str, global_vars,
+                 streaming=False, processes=None, dedup=False, batch_size=None):
+        '''
+        Initialise the TransactionMailCampaign class.
+
+        Takes the same arguments as Campaign, plus:
+
+        Args:
+            processes (Optional[int]): If given, the mails are rendered
+                on that many worker processes (see
+                deltamail.render.render_parallel), and are
+                envelopes.SerializedEnvelope objects. Defaults to None,
+                which renders them in this process.
+            dedup (Optional[bool]): If True, receivers whose mails come
+                out identical are sent a single mail, as BCC. Defaults to
+                False. Can't be used with processes.
+            batch_size (Optional[int]): The most receivers a deduplicated
+                mail is sent to. Defaults to None (DEDUP_GROUP_SIZE).
+
+        Raises:
+            Exception: If both processes and dedup are given.
+        '''
+        if processes and dedup:
+            raise Exception("Mails rendered on several processes can't be deduplicated.")
+
+        self._processes = processes
+        self._dedup = dedup
+        self._batch_size = batch_size
         super(TransactionMailCampaign, self).__init__(
-            from_addr, subject, mailing_list, template_str, global_vars
+            from_addr, subject, mailing_list, template_str, global_vars, streaming
         )
 
 
+def _row_columns(mailing_list):
+    '''
+    The names of the personal variables of a mailing list, as a set,
+    or None if they can't be known without reading it all
+    '''
+    headers = getattr(mailing_list, "headers", None)
+    if headers is not None:
+        # a MailingList or MailingListFile
+        return set(headers[1:])
+    if isinstance(mailing_list, list):
+        return set(key for receiver in mailing_list for key in receiver["variables"])
+    return None
+
+
+def _used_columns(mailing_list, used):
+    '''
+    The receivers of the mailing list with only the personal variables
+    in `used`, and their $attachments
+    '''
+    used = used | set(["$attachments"])
+    if hasattr(mailing_list, "select"):
+        # a MailingList or MailingListFile
+        return mailing_list.select(used)
+    return _only_columns(mailing_list, used)
+
+
+def _only_columns(mailing_list, used):
+    for receiver in mailing_list:
+        variables = receiver["variables"]
+        yield {
+            "email": receiver["email"],
+            "variables": dict((key, variables[key]) for key in variables if key in used),
+        }
+
+
+def _content_key(mail, attachments):
+    '''Hash of the subject, the body and the attachments of a mail'''
+    texts = [mail._subject] + [part[1] for part in mail._parts if len(part) == 3]
+    texts.append(attachments)
+
+    digest = hashlib.sha1()
+    for text in texts:
+        if not isinstance(text, bytes):
+            text = text.encode("utf-8")
+        digest.update(text)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _group_mail(key, mail, receivers):
+    '''The mail of a group of receivers who get the same mail'''
+    if len(receivers) > 1:
+        mail.clear_to_addr()
+        mail.add_header("To", UNDISCLOSED_RECIPIENTS)
+        mail = envelopes.SerializedEnvelope(mail).bcc_copy(receivers)
+
+    # used to preview each distinct mail once
+    mail.content_key = key
+    return mail
+
+
+def _unique_contents(mails):
+    '''Leave out the mails with the same content_key as an earlier one'''
+    seen = set()
+    for mail in mails:
+        key = getattr(mail, "content_key", None)
+        if key is not None:
+            if key in seen:
+                continue
+            seen.add(key)
+        yield mail
+
+
 def CampaignFactory(from_addr, subject, mailing_list,
-                    template_file, global_vars_file=""):
+                    template_file, global_vars_file="", streaming=False,
+                    processes=None, batch_size=None, exclude=None, dedup=False,
+                    personal_to=False):
     '''
     Factory to construct BulkMailCampaign or TransactionMailCampaign object
 
@@ -283,6 +691,27 @@ def CampaignFactory(from_addr, subject, mailing_list,
         template_file (str): The filename that contains the template that is to
             be used to send the mails.
         global_vars_file (Optional[str]): The filename that contains the global variables.
+        streaming (Optional[bool]): Create a streaming campaign, which creates
+            the mails only while sending/previewing them, one at a time.
+            Defaults to False.
+        processes (Optional[int]): Render the mails of a TransactionMailCampaign
+            on that many processes. Ignored for BulkMailCampaigns, which
+            only have one mail. Defaults to None (no extra processes).
+        batch_size (Optional[int]): Send the mail of a BulkMailCampaign as
+            BCC to at most that many email-ids per SMTP transaction, and
+            the deduplicated mails of a TransactionMailCampaign to at most
+            that many email-ids each. Defaults to None (no limit for a
+            BulkMailCampaign, DEDUP_GROUP_SIZE for deduplicated mails).
+        exclude (Optional[set]): email-ids not to send to, e.g. the ones
+            a resumed campaign has already sent to. Their rows of the
+            mailing-list file aren't even read into variables.
+        dedup (Optional[bool]): Send a single mail to the receivers of a
+            TransactionMailCampaign whose mails are identical. Ignored
+            for BulkMailCampaigns. Defaults to False.
+        personal_to (Optional[bool]): Send each receiver of a
+            BulkMailCampaign a mail of their own, with them in the "To"
+            header. Ignored for TransactionMailCampaigns, whose mails are
+            personal already. Defaults to False.
 
     Returns:
         Campaign: BulkMailCampaign or TransactionMailCampaign based on whether
@@ -294,6 +723,9 @@ def CampaignFactory(from_addr, subject, mailing_list,
             If global_vars_file is given and the file doesn't exist.
             If the mailing-list file doesn't exist (if mailing_list is filename).
             If first field of mailing list file isn't "email"
+            If a row of the mailing list file has the wrong number of
+            columns (unless the campaign is streaming, in which case it's
+            raised when the row is reached while sending/previewing).
 
     TODO (thakkarparth007): Use better exception-names.
     '''
@@ -301,8 +733,8 @@ def CampaignFactory(from_addr, subject, mailing_list,
     #
     #   template_str : The template string read from the template file
     #   global_vars  : The dictionary containing the global variables
-    #   mailing_list : The list of dictionaries that contains the
-    #                 mailing list
+    #   mailing_list : The iterable of dictionaries that contains the
+    #                 mailing list (a MailingListFile for .ml files)
 
     # read the template file
 
@@ -314,6 +746,11 @@ def CampaignFactory(from_addr, subject, mailing_list,
     template_str = ftmpl.read()
     ftmpl.close()
 
+    # compile the templates once. The compiled templates are shared
+    # by all the mails of the campaign.
+    subject = compile_template(subject)
+    template_str = compile_template(template_str)
+
     # read the global vars file
     if global_vars_file != "" and os.path.exists(global_vars_file) is False:
         raise Exception("Global variables file ({0}) doesn't exist"
@@ -330,45 +767,16 @@ def CampaignFactory(from_addr, subject, mailing_list,
         for line in contents.splitlines() if line.rstrip() != ""
     ])
 
-    # read the mailing_list if it is a string
-    # in any case, convert it to a list of
-    # dictionaries of form:
-    #   { "email": "...", "variables": "" }
+    # if the mailing_list is a string, it is the name of the .ml file.
+    # MailingListFile reads it one row at a time, as dictionaries of form:
+    #   { "email": "...", "variables": RowVariables }
     if isinstance(mailing_list, str):
-        mailing_list_file = mailing_list
-
-        if os.path.exists(mailing_list_file) is False:
-            raise Exception("Mailing list file ({0}) doesn't exist"
-                            .format(os.path.abspath(mailing_list_file)))
+        mailing_list = MailingListFile(mailing_list, exclude)
+        return TransactionMailCampaign(from_addr, subject, mailing_list, template_str,
+                                       global_vars, streaming, processes, dedup, batch_size)
 
-        fml = open(mailing_list_file, "r")
-        contents = fml.read().splitlines()
-        fml.close()
+    if exclude:
+        mailing_list = [email for email in mailing_list if email not in exclude]
 
-        headers, rows = contents[0].split("\t"), contents[1:]
-
-        if headers[0] != "email":
-            raise Exception("First field of mailing list file is "
-                            "required to be `email`")
-
-        mailing_list = []
-        for row in rows:
-            if row.strip() == "":
-                continue
-            row = row.split("\t")
-            if len(row) != len(headers):
-                raise Exception("%s: Mismatch in number of columns." % (mailing_list_file,))
-            mailing_list.append({
-                "email": row[0],
-                "variables": dict([
-                    (headers[i], row[i])
-                    for i in range(1, len(headers))
-                ])
-            })
-
-        mail_constructor = TransactionMailCampaign
-
-    else:
-        mail_constructor = BulkMailCampaign
-
-    return mail_constructor(from_addr, subject, mailing_list, template_str, global_vars)
+    return BulkMailCampaign(from_addr, subject, mailing_list, template_str, global_vars,
+                            streaming, batch_size, personal_to)
@@ -31,4 +31,7 @@ __version__ = '0.4'
 
 
 from .conn import *
-from .envelope import Envelope
+from .envelope import AttachmentCache, CompactEnvelope, Envelope, SerializedEnvelope
+from .pool import SMTPPool
+from .ratelimit import RateLimiter
+from . import serializer, stats
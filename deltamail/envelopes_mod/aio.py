@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+
+"""
+envelopes.aio
+=============
+
+This module contains an asyncio SMTP client, built on asyncio streams,
+and a pool of such connections. Requires Python 3.7 or later.
+
+Unlike :py:class:`envelopes.conn.SMTP`, sending doesn't block a thread:
+thousands of connections can be kept busy from a single event loop.
+"""
+
+import asyncio
+import base64
+import smtplib
+import socket
+import ssl
+
+__all__ = ['AsyncSMTP', 'AsyncSMTPPool']
+
+from .conn import CRLF, _data_chunks, _is_8bit
+from . import stats
+from .ratelimit import host_rate_limiter
+
+_local_hostname = None
+
+
+async def _get_local_hostname():
+    # socket.getfqdn() may block on a DNS lookup: run it once, off the loop
+    global _local_hostname
+    if _local_hostname is None:
+        loop = asyncio.get_running_loop()
+        _local_hostname = await loop.run_in_executor(None, socket.getfqdn)
+    return _local_hostname
+
+
+class AsyncSMTP(object):
+    """asyncio SMTP connection. Takes the same arguments as
+    :py:class:`envelopes.conn.SMTP`:
+
+    :param keepalive: number of seconds a connection can stay idle before
+        it is checked with a ``NOOP`` when it is next used. Connections
+        found dead are opened again. ``None`` disables the check.
+    :param pipelining: if the server supports ``PIPELINING``, send the
+        ``MAIL``, ``RCPT`` and ``DATA`` commands of a message in one go.
+    :param rate_limit: :py:class:`envelopes.ratelimit.RateLimiter` to wait
+        on before each message, without blocking the event loop. ``'auto'``
+        uses the shared limiter of *host*, if it has one. Defaults to no
+        limit.
+
+    The connection is opened on the first :py:meth:`send` and kept open
+    for the following ones. A connection can only carry one transaction
+    at a time, so concurrent :py:meth:`send` calls on the same object
+    wait for each other. Use :py:class:`AsyncSMTPPool` to send over
+    several connections at once.
+
+    Errors are reported with the :py:mod:`smtplib` exception classes."""
+
+    def __init__(self, host=None, port=25, login=None, password=None,
+                 tls=False, timeout=None, keepalive=30, pipelining=True,
+                 rate_limit=None):
+        self._host = host
+        self._port = port
+        self._login = login
+        self._password = password
+        self._tls = tls
+        self._timeout = timeout
+        self._keepalive = keepalive
+        self._pipelining = pipelining
+        if rate_limit == 'auto':
+            rate_limit = host_rate_limiter(host)
+        self._rate_limit = rate_limit or None
+
+        self._reader = None
+        self._writer = None
+        self._last_used = None
+        self._lock = None
+
+        self.esmtp_features = {}
+
+    @property
+    def is_connected(self):
+        """Returns *True* if the connection is open. Doesn't talk to the
+        server."""
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def _wait(self, aw):
+        if self._timeout:
+            try:
+                return await asyncio.wait_for(aw, self._timeout)
+            except asyncio.TimeoutError:
+                self._close()
+                raise socket.timeout('SMTP command timed out')
+        return await aw
+
+    async def _read_reply(self):
+        lines = []
+        while True:
+            line = await self._wait(self._reader.readline())
+            if not line:
+                self._close()
+                raise smtplib.SMTPServerDisconnected(
+                    'Connection unexpectedly closed')
+            try:
+                code = int(line[:3])
+            except ValueError:
+                code = -1
+            lines.append(line[4:].strip(b' \t\r\n'))
+            if line[3:4] != b'-':
+                return code, b'\n'.join(lines)
+
+    async def _command(self, line):
+        if not self.is_connected:
+            raise smtplib.SMTPServerDisconnected('please run connect() first')
+        self._writer.write(line.encode('ascii') + CRLF)
+        return await self._read_reply()
+
+    async def _ehlo(self):
+        name = await _get_local_hostname()
+        code, resp = await self._command('EHLO %s' % name)
+        if code != 250:
+            code, resp = await self._command('HELO %s' % name)
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, resp)
+            self.esmtp_features = {}
+            return
+
+        features = {}
+        for line in resp.decode('latin-1').split('\n')[1:]:
+            parts = line.split(None, 1)
+            if parts:
+                features[parts[0].lower()] = parts[1] if len(parts) > 1 else ''
+        self.esmtp_features = features
+
+    async def _starttls(self):
+        code, resp = await self._command('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPNotSupportedError(
+                'STARTTLS extension not supported by server.')
+
+        context = self._ssl_context()
+        if hasattr(self._writer, 'start_tls'):
+            await self._wait(self._writer.start_tls(
+                context, server_hostname=self._host))
+        else:
+            # StreamWriter.start_tls() is new in Python 3.11. Upgrade the
+            # transport by hand, and read and write it through new streams.
+            loop = asyncio.get_running_loop()
+            reader = asyncio.StreamReader(loop=loop)
+            protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+            tls_transport = await self._wait(loop.start_tls(
+                self._writer.transport, protocol, context,
+                server_hostname=self._host))
+            protocol.connection_made(tls_transport)
+            self._reader = reader
+            self._writer = asyncio.StreamWriter(tls_transport, protocol,
+                                                reader, loop)
+
+        # the server forgets everything it was told before STARTTLS
+        await self._ehlo()
+
+    def _ssl_context(self):
+        return ssl.create_default_context()
+
+    async def _auth(self):
+        methods = self.esmtp_features.get('auth', '').upper().split()
+        login = self._login.encode('utf-8')
+        password = (self._password or '').encode('utf-8')
+
+        if 'PLAIN' in methods or 'LOGIN' not in methods:
+            token = base64.b64encode(b'\0' + login + b'\0' + password)
+            code, resp = await self._command('AUTH PLAIN ' + token.decode('ascii'))
+        else:
+            code, resp = await self._command('AUTH LOGIN')
+            if code == 334:
+                code, resp = await self._command(
+                    base64.b64encode(login).decode('ascii'))
+            if code == 334:
+                code, resp = await self._command(
+                    base64.b64encode(password).decode('ascii'))
+
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, resp)
+
+    async def connect(self):
+        """Opens the connection: greeting, ``EHLO``, ``STARTTLS`` (if *tls*)
+        and ``AUTH`` (if *login*). Closes the current connection first,
+        if any."""
+        self._close()
+
+        self._reader, self._writer = await self._wait(
+            asyncio.open_connection(self._host, self._port))
+
+        code, resp = await self._read_reply()
+        if code != 220:
+            self._close()
+            raise smtplib.SMTPConnectError(code, resp)
+
+        await self._ehlo()
+
+        if self._tls:
+            await self._starttls()
+
+        if self._login:
+            await self._auth()
+
+        self._last_used = asyncio.get_running_loop().time()
+
+    async def noop(self):
+        """Sends a ``NOOP``. Returns the reply code and message."""
+        return await self._command('NOOP')
+
+    async def _ensure_connected(self):
+        if not self.is_connected:
+            await self.connect()
+            return
+
+        idle = asyncio.get_running_loop().time() - self._last_used
+        if self._keepalive is not None and idle > self._keepalive:
+            try:
+                code, _ = await self.noop()
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                code = None
+            if code != 250:
+                await self.connect()
+
+    async def _transaction(self, from_addr, to_addrs, data, eightbit=False, retry=True):
+        mail = 'MAIL FROM:%s' % smtplib.quoteaddr(from_addr)
+        if eightbit and '8bitmime' in self.esmtp_features:
+            mail += ' BODY=8BITMIME'
+        rcpts = ['RCPT TO:%s' % smtplib.quoteaddr(addr) for addr in to_addrs]
+        pipelined = self._pipelining and 'pipelining' in self.esmtp_features
+
+        try:
+            if pipelined:
+                self._writer.write(b''.join(
+                    line.encode('ascii') + CRLF for line in [mail] + rcpts + ['DATA']))
+                await self._wait(self._writer.drain())
+                code, resp = await self._read_reply()
+            else:
+                code, resp = await self._command(mail)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # The connection died while it was idle. Nothing has been
+            # delivered yet, so it's safe to reconnect and start over.
+            if not retry:
+                raise
+            await self.connect()
+            return await self._transaction(from_addr, to_addrs, data, eightbit, False)
+
+        if pipelined:
+            rcpt_replies = [await self._read_reply() for _ in rcpts]
+            data_reply = await self._read_reply()
+            if code != 250 or all(c not in (250, 251) for c, _ in rcpt_replies):
+                if data_reply[0] == 354:
+                    # the server wants a message anyway: send an empty one
+                    self._writer.write(b'.' + CRLF)
+                    await self._read_reply()
+        elif code == 250:
+            rcpt_replies = [await self._command(line) for line in rcpts]
+
+        if code != 250:
+            await self._rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+        refused = {}
+        for addr, (code, resp) in zip(to_addrs, rcpt_replies):
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            await self._rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        if pipelined:
+            code, resp = data_reply
+        else:
+            code, resp = await self._command('DATA')
+        if code != 354:
+            await self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+
+        self._writer.writelines(data)
+        await self._wait(self._writer.drain())
+        code, resp = await self._read_reply()
+        if code != 250:
+            await self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+
+        return refused
+
+    async def _rset(self):
+        try:
+            await self._command('RSET')
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        """Sends the message *msg* (a string) from *from_addr* to each of
+        *to_addrs*. Returns the refused recipients the same way
+        :py:meth:`smtplib.SMTP.sendmail` does.
+
+        If the connection turns out to be closed when the transaction
+        starts, it's opened again and the transaction is retried once."""
+        data = _data_chunks(msg)
+        eightbit = _is_8bit(msg)
+
+        if self._rate_limit is not None:
+            delay = self._rate_limit.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            with stats.timed('smtp'):
+                await self._ensure_connected()
+                refused = await self._transaction(from_addr, to_addrs, data, eightbit)
+            self._last_used = asyncio.get_running_loop().time()
+            stats.count('sent')
+            if refused:
+                stats.count('refused', len(refused))
+            return refused
+
+    async def send(self, envelope):
+        """Sends an *envelope*. Once connected, its text parts may be
+        sent as 8bit if the server supports ``8BITMIME``."""
+        features = self.esmtp_features if self.is_connected else {}
+        allow_8bit = '8bitmime' in features
+        return await self.sendmail(*envelope.sendmail_args(allow_8bit=allow_8bit))
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = None
+        self._writer = None
+
+    async def quit(self):
+        """Sends ``QUIT`` and closes the connection."""
+        if self.is_connected:
+            try:
+                await self._command('QUIT')
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                pass
+        self._close()
+
+
+class AsyncSMTPPool(object):
+    """A fixed number of :py:class:`AsyncSMTP` connections to the same
+    server. Every :py:meth:`send` borrows a free connection, waiting for
+    one if they're all busy, so up to *size* envelopes are in flight at
+    the same time.
+
+    The remaining arguments are passed to the constructor of
+    *smtp_class* (:py:class:`AsyncSMTP` by default) for each of the
+    connections. The connections are opened lazily, on their first
+    use."""
+
+    def __init__(self, size, *args, **kwargs):
+        smtp_class = kwargs.pop('smtp_class', AsyncSMTP)
+
+        if size < 1:
+            raise ValueError('AsyncSMTPPool size must be at least 1')
+
+        self._size = size
+        self._all = [smtp_class(*args, **kwargs) for _ in range(size)]
+        self._free = None
+
+    @property
+    def size(self):
+        """Number of connections in the pool."""
+        return self._size
+
+    async def send(self, envelope):
+        """Sends an *envelope* over one of the free connections."""
+        if self._free is None:
+            # created here so that it belongs to the running loop
+            self._free = asyncio.Queue()
+            for conn in self._all:
+                self._free.put_nowait(conn)
+
+        conn = await self._free.get()
+        try:
+            return await conn.send(envelope)
+        finally:
+            self._free.put_nowait(conn)
+
+    async def quit(self):
+        """Closes all the connections."""
+        await asyncio.gather(*[conn.quit() for conn in self._all])
@@ -27,20 +27,66 @@ envelopes.conn
 This module contains SMTP connection wrapper.
 """
 
+import errno
+import re
 import smtplib
 import socket
+import sys
+import time
+
+from . import stats
+from .ratelimit import host_rate_limiter
+
+if sys.version_info[0] == 3:
+    basestring = str
 
 TimeoutException = socket.timeout
 
+CRLF = b'\r\n'
+
+# Same as smtplib: normalise all line endings to CRLF and escape lines
+# starting with a period.
+_EOLS_RE = re.compile(br'(?:\r\n|\n|\r(?!\n))')
+_PERIODS_RE = re.compile(br'(?m)^\.')
+
+# Bytes that aren't ASCII, which make data 8bit
+_HIGH_BYTES = bytes(bytearray(range(128, 256)))
+
 __all__ = ['SMTP', 'GMailSMTP', 'SendGridSMTP', 'MailcatcherSMTP',
            'TimeoutException']
 
 
 class SMTP(object):
-    """Wrapper around :py:class:`smtplib.SMTP` class."""
+    """Wrapper around :py:class:`smtplib.SMTP` class.
+
+    The connection is opened on the first :py:meth:`send` and then assumed
+    to be healthy: if it turns out to be closed while a message is being
+    sent, it is opened again and that message is sent once more. Only a
+    connection that has been idle for more than *keepalive* seconds is
+    checked with a ``NOOP`` before it is used (``None`` disables the
+    check).
+
+    If the server supports ``8BITMIME`` (RFC 6152), the text parts of the
+    envelopes sent with :py:meth:`send` once connected may be sent as
+    8bit, without being encoded. Messages with 8bit data are sent with
+    ``BODY=8BITMIME``.
+
+    If the server supports ``PIPELINING`` (RFC 2920), the ``MAIL``,
+    ``RCPT`` and ``DATA`` commands of a message are sent in one go, and
+    their replies are read afterwards, instead of waiting for each reply
+    in turn. Pass *pipelining=False* to never do that.
+
+    Each message waits on the *rate_limit*
+    (:py:class:`envelopes.ratelimit.RateLimiter`) before it is sent. Share
+    one limiter between connections to limit them all together. With
+    *rate_limit='auto'*, connections to the hosts in
+    :py:data:`envelopes.ratelimit.HOST_RATE_LIMITS` share a limiter with
+    that host's limits, and other connections aren't limited. By default
+    (``None``), messages aren't limited."""
 
     def __init__(self, host=None, port=25, login=None, password=None,
-                 tls=False, timeout=None):
+                 tls=False, timeout=None, keepalive=30, pipelining=True,
+                 rate_limit=None):
         self._conn = None
         self._host = host
         self._port = port
@@ -48,6 +94,12 @@ class SMTP(object):
         self._password = password
         self._tls = tls
         self._timeout = timeout
+        self._keepalive = keepalive
+        self._pipelining = pipelining
+        if rate_limit == 'auto':
+            rate_limit = host_rate_limiter(host)
+        self._rate_limit = rate_limit or None
+        self._last_used = None
 
     @property
     def is_connected(self):
@@ -55,7 +107,7 @@ class SMTP(object):
         connected. Otherwise returns *False*"""
         try:
             self._conn.noop()
-        except (AttributeError, smtplib.SMTPServerDisconnected):
+        except (AttributeError, smtplib.SMTPServerDisconnected, socket.error):
             return False
         else:
             return True
@@ -64,7 +116,7 @@ class SMTP(object):
         if self._conn is None or replace_current:
             try:
                 self._conn.quit()
-            except (AttributeError, smtplib.SMTPServerDisconnected):
+            except (AttributeError, smtplib.SMTPServerDisconnected, socket.error):
                 pass
 
             if self._timeout:
@@ -79,42 +131,205 @@ class SMTP(object):
         if self._login:
             self._conn.login(self._login, self._password or '')
 
+        self._last_used = time.time()
+
+    def _is_idle(self):
+        return (self._keepalive is not None and
+                time.time() - self._last_used > self._keepalive)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """Sends the already serialized message *msg* from *from_addr* to
+        each of *to_addrs*. Returns what :py:meth:`smtplib.SMTP.sendmail`
+        returns."""
+        if self._rate_limit is not None:
+            self._rate_limit.acquire()
+
+        with stats.timed('smtp'):
+            if self._conn is None:
+                self._connect()
+            elif self._is_idle() and not self.is_connected:
+                self._connect(replace_current=True)
+
+            try:
+                result = self._transaction(from_addr, to_addrs, msg)
+            except Exception as e:
+                if not _is_disconnect(e):
+                    raise
+                self._connect(replace_current=True)
+                result = self._transaction(from_addr, to_addrs, msg)
+
+        self._last_used = time.time()
+        stats.count('sent')
+        if result:
+            stats.count('refused', len(result))
+        return result
+
+    def _transaction(self, from_addr, to_addrs, msg):
+        conn = self._conn
+        conn.ehlo_or_helo_if_needed()
+
+        mail_options = []
+        if _is_8bit(msg) and conn.has_extn('8bitmime'):
+            mail_options.append('BODY=8BITMIME')
+            if not isinstance(msg, bytes) and not hasattr(msg, 'data_chunks'):
+                msg = msg.encode('utf-8')
+
+        if self._pipelining and conn.has_extn('pipelining'):
+            return self._pipelined_transaction(from_addr, to_addrs, msg, mail_options)
+        if hasattr(msg, 'data_chunks'):
+            msg = msg.tobytes()
+        if mail_options:
+            return conn.sendmail(from_addr, to_addrs, msg, mail_options)
+        return conn.sendmail(from_addr, to_addrs, msg)
+
+    def _pipelined_transaction(self, from_addr, to_addrs, msg, mail_options=()):
+        # Does what smtplib.SMTP.sendmail does, with the same exceptions
+        # and the same return value, but sends MAIL, all the RCPTs and
+        # DATA with a single write.
+        conn = self._conn
+        if isinstance(to_addrs, basestring):
+            to_addrs = [to_addrs]
+
+        options = ''
+        if conn.has_extn('size'):
+            options = ' size=%d' % len(msg)
+        for option in mail_options:
+            options += ' ' + option
+
+        commands = ['mail FROM:%s%s' % (smtplib.quoteaddr(from_addr), options)]
+        commands.extend(['rcpt TO:%s' % smtplib.quoteaddr(addr) for addr in to_addrs])
+        commands.append('data')
+        conn.send(''.join(command + '\r\n' for command in commands))
+
+        mail_reply = conn.getreply()
+        rcpt_replies = [conn.getreply() for _ in to_addrs]
+        data_code, data_resp = conn.getreply()
+
+        senderrs = {}
+        for addr, (code, resp) in zip(to_addrs, rcpt_replies):
+            if code != 250 and code != 251:
+                senderrs[addr] = (code, resp)
+
+        if mail_reply[0] != 250 or len(senderrs) == len(to_addrs):
+            if data_code == 354:
+                # the server wants a message anyway: send an empty one
+                conn.send(b'.' + CRLF)
+                conn.getreply()
+            conn.rset()
+            if mail_reply[0] != 250:
+                raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+
+        if data_code != 354:
+            conn.rset()
+            raise smtplib.SMTPDataError(data_code, data_resp)
+
+        for chunk in _data_chunks(msg):
+            conn.send(chunk)
+        code, resp = conn.getreply()
+        if code != 250:
+            conn.rset()
+            raise smtplib.SMTPDataError(code, resp)
+
+        return senderrs
+
+    def _allows_8bit(self):
+        # what the server supports is only known once connected; the
+        # first envelope is made 7bit-safe
+        if self._conn is None:
+            return False
+        conn = self._conn
+        conn.ehlo_or_helo_if_needed()
+        # SMTPUTF8 alone doesn't allow 8bit bodies without BODY=8BITMIME
+        return bool(conn.has_extn('8bitmime'))
+
     def send(self, envelope):
         """Sends an *envelope*."""
-        if not self.is_connected:
-            self._connect()
+        return self.sendmail(*envelope.sendmail_args(allow_8bit=self._allows_8bit()))
+
+
+def _quote_lines(data):
+    """Returns the bytes *data* with CRLF line endings and leading
+    periods doubled."""
+    return _PERIODS_RE.sub(b'..', _EOLS_RE.sub(CRLF, data))
+
+
+def _quote_data(msg):
+    """Returns the message *msg* ready to be sent after ``DATA``, as
+    bytes: CRLF line endings, leading periods doubled and the final
+    ``.`` line."""
+    if not isinstance(msg, bytes):
+        msg = msg.encode('utf-8')
+    data = _quote_lines(msg)
+    if not data.endswith(CRLF):
+        data += CRLF
+    return data + b'.' + CRLF
+
+
+def _is_8bit(msg):
+    """Returns *True* if the message *msg* has non-ASCII data."""
+    eightbit = getattr(msg, 'eightbit', None)
+    if eightbit is not None:
+        return eightbit
+    if not isinstance(msg, bytes):
+        try:
+            msg.encode('ascii')
+        except UnicodeError:
+            return True
+        return False
+    return len(msg.translate(None, _HIGH_BYTES)) != len(msg)
+
+
+def _data_chunks(msg):
+    """Returns the message *msg* ready to be sent after ``DATA``, as a
+    list of bytes-like chunks. Messages spliced onto a skeleton
+    (:py:class:`envelopes.serializer.SplicedMessage`) are quoted
+    already, and their shared part is sent without being copied."""
+    data_chunks = getattr(msg, 'data_chunks', None)
+    if data_chunks is not None:
+        return data_chunks()
+    return [_quote_data(msg)]
 
-        msg = envelope.to_mime_message()
-        to_addrs = [envelope._addrs_to_header([addr]) for addr in envelope._to + envelope._cc + envelope._bcc]
 
-        return self._conn.sendmail(msg['From'], to_addrs, msg.as_string())
+def _is_disconnect(exc):
+    """Returns *True* if *exc* means that the server closed the
+    connection."""
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    # On Python 3 the other smtplib exceptions are socket errors too
+    if isinstance(exc, smtplib.SMTPException):
+        return False
+    return (isinstance(exc, socket.error) and
+            exc.errno in (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED))
 
 
 class GMailSMTP(SMTP):
-    """Subclass of :py:class:`SMTP` preconfigured for GMail SMTP."""
+    """Subclass of :py:class:`SMTP` preconfigured for GMail SMTP, with
+    GMail's rate limits unless another *rate_limit* is given."""
 
     GMAIL_SMTP_HOST = 'smtp.googlemail.com'
     GMAIL_SMTP_TLS = True
 
-    def __init__(self, login=None, password=None):
+    def __init__(self, login=None, password=None, rate_limit='auto'):
         super(GMailSMTP, self).__init__(
             self.GMAIL_SMTP_HOST, tls=self.GMAIL_SMTP_TLS, login=login,
-            password=password
+            password=password, rate_limit=rate_limit
         )
 
 
 class SendGridSMTP(SMTP):
-    """Subclass of :py:class:`SMTP` preconfigured for SendGrid SMTP."""
+    """Subclass of :py:class:`SMTP` preconfigured for SendGrid SMTP, with
+    SendGrid's rate limits unless another *rate_limit* is given."""
 
     SENDGRID_SMTP_HOST = 'smtp.sendgrid.net'
     SENDGRID_SMTP_PORT = 587
     SENDGRID_SMTP_TLS = False
 
-    def __init__(self, login=None, password=None):
+    def __init__(self, login=None, password=None, rate_limit='auto'):
         super(SendGridSMTP, self).__init__(
             self.SENDGRID_SMTP_HOST, port=self.SENDGRID_SMTP_PORT,
             tls=self.SENDGRID_SMTP_TLS, login=login,
-            password=password
+            password=password, rate_limit=rate_limit
         )
 
 
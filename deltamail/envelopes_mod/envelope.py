@@ -24,13 +24,14 @@
 envelopes.envelope
 ==================
 
-This module contains the Envelope class.
+This module contains the Envelope class, and its variants.
 """
 
 import sys
 
 if sys.version_info[0] == 2:
     from email import Encoders as email_encoders
+    from cStringIO import StringIO
 elif sys.version_info[0] == 3:
     from email import encoders as email_encoders
     basestring = str
@@ -42,17 +43,23 @@ else:
         sys.version_info[0], sys.version_info[1], sys.version_info[2]
     ))
 
+from collections import OrderedDict
+import copy
+import email
+from email.generator import Generator
 from email.header import Header
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
+from email.mime.nonmultipart import MIMENonMultipart
 from email.mime.application import MIMEApplication
 from email.mime.audio import MIMEAudio
 from email.mime.image import MIMEImage
-from email.mime.text import MIMEText
 import mimetypes
 import os
 import re
+import threading
 
+from . import serializer, stats
 from .conn import SMTP
 from .compat import encoded
 
@@ -61,6 +68,100 @@ class MessageEncodeError(Exception):
     pass
 
 
+class _Memo(dict):
+    """A dictionary of values that are costly to compute, emptied when
+    it has *size* of them."""
+
+    def __init__(self, size):
+        super(_Memo, self).__init__()
+        self.size = size
+
+    def put(self, key, value):
+        if len(self) >= self.size:
+            self.clear()
+        self[key] = value
+
+
+# Encoded addresses and header values, shared by all the envelopes
+_encoded_addrs = _Memo(10000)
+_encoded_headers = _Memo(10000)
+
+
+def _as_string(msg):
+    # msg.as_string(), without the ">From " escaping of lines that
+    # Python 2 does, which would change 7bit and 8bit text
+    if sys.version_info[0] == 3:
+        return msg.as_string()
+    fp = StringIO()
+    Generator(fp, mangle_from_=False).flatten(msg)
+    return fp.getvalue()
+
+
+def _attachment_part(file_path, mimetype=None, charset='utf-8'):
+    """Reads and encodes the file at *file_path*. Returns a ``(mimetype,
+    MIME part)`` tuple, as stored in :py:attr:`Envelope._parts`."""
+    if not mimetype:
+        mimetype, _ = mimetypes.guess_type(file_path)
+
+    if mimetype is None:
+        mimetype = 'application/octet-stream'
+
+    type_maj, type_min = mimetype.split('/')
+    with open(file_path, 'rb') as fh:
+        part_data = fh.read()
+
+        part = MIMEBase(type_maj, type_min)
+        part.set_payload(part_data)
+        email_encoders.encode_base64(part)
+
+        part_filename = os.path.basename(encoded(file_path, charset))
+        part.add_header('Content-Disposition', 'attachment; filename="%s"'
+                        % part_filename)
+
+        return (mimetype, part)
+
+
+class AttachmentCache(object):
+    """Reads and encodes each attached file only once.
+
+    The encoded attachments are kept by absolute path and are shared by
+    all the envelopes they're attached to, so they must not be modified.
+    A file is read again if its size or modification time changes. Safe
+    to use from several threads.
+
+    :param max_entries: number of attachments to keep; the least recently
+        used one is dropped when a new one doesn't fit. ``None`` keeps
+        them all.
+    """
+
+    def __init__(self, max_entries=64):
+        self._max_entries = max_entries
+        self._parts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._parts)
+
+    def get(self, file_path, mimetype=None, charset='utf-8'):
+        """Returns the ``(mimetype, MIME part)`` tuple for the file at
+        *file_path*, reading and encoding it only if it isn't cached
+        yet."""
+        key = (os.path.abspath(file_path), mimetype, charset)
+        stat = os.stat(file_path)
+        version = (stat.st_size, stat.st_mtime)
+
+        with self._lock:
+            cached = self._parts.pop(key, None)
+            if cached is None or cached[0] != version:
+                cached = (version, _attachment_part(file_path, mimetype, charset))
+            # (re)inserted last: the first entry is the least recently used
+            self._parts[key] = cached
+            if self._max_entries is not None:
+                while len(self._parts) > self._max_entries:
+                    self._parts.popitem(last=False)
+            return cached[1]
+
+
 class Envelope(object):
     """
     The Envelope class.
@@ -85,11 +186,26 @@ class Envelope(object):
     :param bcc_addr: optional single BCC address or list of BCC addresses
     :param headers: optional dictionary of headers
     :param charset: message charset
+
+    **Serializing**
+
+    Messages are built with :py:meth:`to_mime_message` and serialized
+    with :py:mod:`email.generator` by default. Set :py:attr:`fast_serialize`
+    (on an envelope, or on the class for all of them) to write them with
+    :py:meth:`as_bytes` instead, which is several times faster.
     """
 
     ADDR_FORMAT = '%s <%s>'
     ADDR_REGEXP = re.compile(r'^(.*) <([^@]+@[^@]+)>$')
 
+    # Other attributes (e.g. those of subclasses) go in a __dict__, which
+    # is only made for the envelopes that have some
+    __slots__ = ('_to', '_from', '_subject', '_parts', '_cc', '_bcc',
+                 '_headers', '_charset', '_addr_format', '__dict__', '__weakref__')
+
+    #: Whether :py:meth:`sendmail_args` serializes with :py:meth:`as_bytes`
+    fast_serialize = False
+
     def __init__(self, to_addr=None, from_addr=None, subject=None,
                  html_body=None, text_body=None, cc_addr=None, bcc_addr=None,
                  headers=None, charset='utf-8'):
@@ -136,6 +252,18 @@ class Envelope(object):
 
         self._addr_format = unicode(self.ADDR_FORMAT, charset)
 
+    def __getstate__(self):
+        # needed to pickle envelopes with protocols before 2
+        state = dict(getattr(self, '__dict__', {}))
+        for name in Envelope.__slots__:
+            if not name.startswith('__') and hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __repr__(self):
         return u'<Envelope from="%s" to="%s" subject="%s">' % (
             self._addrs_to_header([self._from]),
@@ -214,6 +342,13 @@ class Envelope(object):
 
         return addr
 
+    @property
+    def recipients(self):
+        """List of every ``To``, ``CC`` and ``BCC`` address, encoded, as
+        passed to :py:meth:`smtplib.SMTP.sendmail`."""
+        return [self._addr_to_header(addr)
+                for addr in self._to + self._cc + self._bcc if addr]
+
     @property
     def headers(self):
         """Dictionary of custom headers."""
@@ -228,98 +363,168 @@ class Envelope(object):
         self._headers = {}
 
     def _addrs_to_header(self, addrs):
-        _addrs = []
-        for addr in addrs:
-            if not addr:
-                continue
-
-            if isinstance(addr, basestring):
-                if self._is_ascii(addr):
-                    _addrs.append(self._encoded(addr))
-                else:
-                    # these headers need special care when encoding, see:
-                    #   http://tools.ietf.org/html/rfc2047#section-8
-                    # Need to break apart the name from the address if there are
-                    # non-ascii chars
-                    m = self.ADDR_REGEXP.match(addr)
-                    if m:
-                        t = (m.group(2), m.group(1))
-                        _addrs.append(self._addr_tuple_to_addr(t))
-                    else:
-                        # What can we do? Just pass along what the user gave us and hope they did it right
-                        _addrs.append(self._encoded(addr))
-            elif isinstance(addr, tuple):
-                _addrs.append(self._addr_tuple_to_addr(addr))
-            else:
-                self._raise(MessageEncodeError,
-                            '%s is not a valid address' % str(addr))
-
-        _header = ','.join(_addrs)
+        _header = ','.join([self._addr_to_header(addr) for addr in addrs if addr])
         return _header
 
+    def _addr_to_header(self, addr):
+        # the same addresses come up over and over again in a campaign
+        # (the sender to begin with): encode each of them once
+        key = (addr, self._charset, self.ADDR_FORMAT)
+        try:
+            return _encoded_addrs[key]
+        except KeyError:
+            value = self._encode_addr(addr)
+            _encoded_addrs.put(key, value)
+            return value
+        except TypeError:
+            # unhashable, so not a valid address
+            return self._encode_addr(addr)
+
+    def _encode_addr(self, addr):
+        if isinstance(addr, basestring):
+            if self._is_ascii(addr):
+                return self._encoded(addr)
+
+            # these headers need special care when encoding, see:
+            #   http://tools.ietf.org/html/rfc2047#section-8
+            # Need to break apart the name from the address if there are
+            # non-ascii chars
+            m = self.ADDR_REGEXP.match(addr)
+            if m:
+                t = (m.group(2), m.group(1))
+                return self._addr_tuple_to_addr(t)
+
+            # What can we do? Just pass along what the user gave us and hope they did it right
+            return self._encoded(addr)
+        elif isinstance(addr, tuple):
+            return self._addr_tuple_to_addr(addr)
+
+        self._raise(MessageEncodeError,
+                    '%s is not a valid address' % str(addr))
+
     def _raise(self, exc_class, message):
         raise exc_class(self._encoded(message))
 
     def _header(self, _str):
         if self._is_ascii(_str):
             return _str
-        return Header(_str, self._charset).encode()
+
+        key = (_str, self._charset)
+        try:
+            return _encoded_headers[key]
+        except KeyError:
+            value = Header(_str, self._charset).encode()
+            _encoded_headers.put(key, value)
+            return value
 
     def _is_ascii(self, _str):
-        return all(ord(c) < 128 for c in _str)
+        try:
+            _str.encode('ascii')
+        except UnicodeError:
+            return False
+        return True
 
     def _encoded(self, _str):
         return encoded(_str, self._charset)
 
-    def to_mime_message(self):
-        """Returns the envelope as
-        :py:class:`email.mime.multipart.MIMEMultipart`."""
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = self._header(self._subject or '')
-
-        msg['From'] = self._encoded(self._addrs_to_header([self._from]))
-        msg['To'] = self._encoded(self._addrs_to_header(self._to))
+    def _message_headers(self):
+        headers = [('Subject', self._header(self._subject or '')),
+                   ('From', self._encoded(self._addrs_to_header([self._from])))]
+        if self._to:
+            headers.append(('To', self._encoded(self._addrs_to_header(self._to))))
 
         if self._cc:
-            msg['CC'] = self._addrs_to_header(self._cc)
+            headers.append(('CC', self._addrs_to_header(self._cc)))
 
         if self._headers:
             for key, value in self._headers.items():
-                msg[key] = self._header(value)
+                headers.append((key, self._header(value)))
+
+        return headers
+
+    def _text_part(self, subtype, text, allow_8bit):
+        charset, encoding, body = serializer.text_body(text, self._charset, allow_8bit)
+        part = MIMENonMultipart('text', subtype, charset=charset)
+        part['Content-Transfer-Encoding'] = encoding
+        if sys.version_info[0] == 3:
+            # what email does with 8bit text: see email.message.set_payload
+            body = body.decode('ascii', 'surrogateescape')
+        part.set_payload(body)
+        return part
+
+    def to_mime_message(self, allow_8bit=False):
+        """Returns the envelope as
+        :py:class:`email.mime.multipart.MIMEMultipart`.
+
+        Text parts are 7bit if they are ASCII, and quoted-printable or
+        base64, whichever is shorter, if not. With *allow_8bit*, text
+        with lines short enough is 8bit instead of being encoded (on
+        Python 3, serialize the message with ``as_bytes()`` then)."""
+        msg = MIMEMultipart('alternative')
+        for key, value in self._message_headers():
+            msg[key] = value
 
         for part in self._parts:
             type_maj, type_min = part[0].split('/')
             if type_maj == 'text' and type_min in ('html', 'plain') and\
-                (isinstance(part[1], str) or isinstance(part[1], unicode)):
-                msg.attach(MIMEText(part[1], type_min, self._charset))
+                isinstance(part[1], basestring):
+                msg.attach(self._text_part(type_min, part[1], allow_8bit))
             else:
                 msg.attach(part[1])
 
         return msg
 
-    def add_attachment(self, file_path, mimetype=None):
+    def as_bytes(self, allow_8bit=False):
+        """Returns the message as bytes, written directly instead of
+        through :py:meth:`to_mime_message`. Parsed with :py:mod:`email`,
+        it has the same headers and parts as the message
+        :py:meth:`to_mime_message` builds with the same *allow_8bit*.
+
+        Envelopes without any part are serialized through
+        :py:meth:`to_mime_message`."""
+        if not self._parts:
+            msg = self.to_mime_message().as_string()
+            if not isinstance(msg, bytes):
+                msg = msg.encode(self._charset)
+            return serializer.crlf(msg)
+
+        return serializer.message_bytes(self._message_headers(), self._parts,
+                                        self._charset, allow_8bit)
+
+    def sendmail_args(self, allow_8bit=False):
+        """Returns the ``(from_addr, to_addrs, msg)`` arguments to send the
+        envelope with :py:meth:`smtplib.SMTP.sendmail`: the ``From``
+        address, every ``To``, ``CC`` and ``BCC`` address, and the
+        serialized message. *allow_8bit* is passed on to
+        :py:meth:`to_mime_message`, for servers that support
+        ``8BITMIME``."""
+        if self.fast_serialize:
+            with stats.timed('serialize'):
+                msg = self.as_bytes(allow_8bit)
+            return self._encoded(self._addrs_to_header([self._from])), self.recipients, msg
+
+        with stats.timed('mime'):
+            msg = self.to_mime_message(allow_8bit)
+
+        with stats.timed('serialize'):
+            if allow_8bit and sys.version_info[0] == 3:
+                return msg['From'], self.recipients, msg.as_bytes()
+            return msg['From'], self.recipients, _as_string(msg)
+
+    def add_attachment(self, file_path, mimetype=None, cache=None):
         """Attaches a file located at *file_path* to the envelope. If
         *mimetype* is not specified an attempt to guess it is made. If nothing
-        is guessed then `application/octet-stream` is used."""
-        if not mimetype:
-            mimetype, _ = mimetypes.guess_type(file_path)
-
-        if mimetype is None:
-            mimetype = 'application/octet-stream'
+        is guessed then `application/octet-stream` is used.
 
-        type_maj, type_min = mimetype.split('/')
-        with open(file_path, 'rb') as fh:
-            part_data = fh.read()
+        If *cache* (an :py:class:`AttachmentCache`) is given, the encoded
+        attachment is taken from it, and shared with every other envelope
+        the same file is attached to through that cache."""
+        self._parts.append(self._attachment(file_path, mimetype, cache))
 
-            part = MIMEBase(type_maj, type_min)
-            part.set_payload(part_data)
-            email_encoders.encode_base64(part)
-
-            part_filename = os.path.basename(self._encoded(file_path))
-            part.add_header('Content-Disposition', 'attachment; filename="%s"'
-                            % part_filename)
-
-            self._parts.append((mimetype, part))
+    def _attachment(self, file_path, mimetype, cache):
+        if cache is not None:
+            return cache.get(file_path, mimetype, self._charset)
+        return _attachment_part(file_path, mimetype, self._charset)
 
     def send(self, *args, **kwargs):
         """Sends the envelope using a freshly created SMTP connection. *args*
@@ -330,3 +535,223 @@ class Envelope(object):
         conn = SMTP(*args, **kwargs)
         send_result = conn.send(self)
         return conn, send_result
+
+
+# Values shared by the compact envelopes, see _shared
+_shared_values = {}
+
+# Number of values kept in _shared_values before it's emptied
+MAX_SHARED_VALUES = 1024
+
+
+def _shared(value):
+    """Returns the value equal to *value* that is already in use by
+    other compact envelopes, if there is one, so that they all refer to
+    a single copy."""
+    if len(_shared_values) >= MAX_SHARED_VALUES:
+        _shared_values.clear()
+    return _shared_values.setdefault(value, value)
+
+
+def _addr_tuple(addr):
+    if not addr:
+        return ()
+    if isinstance(addr, list):
+        return tuple(addr)
+    return (addr,)
+
+
+class _Headers(tuple):
+    """Headers as a tuple of ``(name, value)`` pairs, with the bits of
+    the dictionary interface :py:class:`Envelope` uses."""
+
+    __slots__ = ()
+
+    def items(self):
+        return self
+
+    def __contains__(self, key):
+        return any(name == key for name, _ in self)
+
+
+class CompactEnvelope(Envelope):
+    """An :py:class:`Envelope` that takes as little memory as possible,
+    for campaigns that keep many of them queued.
+
+    It has no ``__dict__`` of its own (until an attribute other than the
+    envelope's is set on it), keeps its addresses, parts and headers in
+    tuples, and shares its ``From`` address, charset and header values
+    (e.g. ``Date``) with the other compact envelopes that have the same
+    ones instead of keeping copies.
+
+    It is used like an :py:class:`Envelope`, except that the lists and
+    dictionary :py:attr:`to_addr`, :py:attr:`cc_addr`,
+    :py:attr:`bcc_addr` and :py:attr:`headers` return are copies: use the
+    ``add_*`` and ``clear_*`` methods to change them.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, to_addr=None, from_addr=None, subject=None,
+                 html_body=None, text_body=None, cc_addr=None, bcc_addr=None,
+                 headers=None, charset='utf-8'):
+        charset = _shared(charset)
+
+        self._to = _addr_tuple(to_addr)
+        self._cc = _addr_tuple(cc_addr)
+        self._bcc = _addr_tuple(bcc_addr)
+        self._from = _shared(from_addr)
+        self._subject = subject
+
+        parts = ()
+        if text_body:
+            parts += (('text/plain', text_body, charset),)
+        if html_body:
+            parts += (('text/html', html_body, charset),)
+        self._parts = parts
+
+        self._headers = _Headers((_shared(key), _shared(value))
+                                 for key, value in (headers or {}).items())
+
+        self._charset = charset
+        self._addr_format = _shared(unicode(self.ADDR_FORMAT, charset))
+
+    @property
+    def to_addr(self):
+        """List of ``To`` addresses."""
+        return list(self._to)
+
+    def add_to_addr(self, to_addr):
+        """Adds a ``To`` address."""
+        self._to += (to_addr,)
+
+    def clear_to_addr(self):
+        """Clears list of ``To`` addresses."""
+        self._to = ()
+
+    @property
+    def cc_addr(self):
+        """List of CC addresses."""
+        return list(self._cc)
+
+    def add_cc_addr(self, cc_addr):
+        """Adds a CC address."""
+        self._cc += (cc_addr,)
+
+    def clear_cc_addr(self):
+        """Clears list of CC addresses."""
+        self._cc = ()
+
+    @property
+    def bcc_addr(self):
+        """List of BCC addresses."""
+        return list(self._bcc)
+
+    def add_bcc_addr(self, bcc_addr):
+        """Adds a BCC address."""
+        self._bcc += (bcc_addr,)
+
+    def clear_bcc_addr(self):
+        """Clears list of BCC addresses."""
+        self._bcc = ()
+
+    @property
+    def headers(self):
+        """Dictionary of custom headers."""
+        return dict(self._headers)
+
+    def add_header(self, key, value):
+        """Adds a custom header."""
+        self._headers = _Headers(tuple(header for header in self._headers if header[0] != key) +
+                                 ((_shared(key), _shared(value)),))
+
+    def clear_headers(self):
+        """Clears custom headers."""
+        self._headers = _Headers()
+
+    def add_attachment(self, file_path, mimetype=None, cache=None):
+        """Attaches a file, as :py:meth:`Envelope.add_attachment` does."""
+        self._parts += (self._attachment(file_path, mimetype, cache),)
+
+
+class SerializedEnvelope(Envelope):
+    """An :py:class:`Envelope` that has already been serialized.
+
+    Made from another envelope, it keeps that envelope's addresses,
+    subject, headers and text parts, along with its serialized message.
+    Sending it just sends that message, without building it again. It is
+    small and cheap to pickle, as attachments only live in the message.
+
+    :param envelope: the :py:class:`Envelope` to serialize
+    """
+
+    def __init__(self, envelope):
+        super(SerializedEnvelope, self).__init__(
+            to_addr=list(envelope._to), from_addr=envelope._from,
+            subject=envelope._subject, cc_addr=list(envelope._cc),
+            bcc_addr=list(envelope._bcc), headers=dict(envelope._headers),
+            charset=envelope._charset
+        )
+
+        # text parts are (mimetype, text, charset) tuples, attachments
+        # are (mimetype, MIME part) ones
+        self._parts = [part for part in envelope._parts if len(part) == 3]
+        self._sendmail_args = envelope.sendmail_args()
+        self._skeleton = None
+
+    def sendmail_args(self, allow_8bit=False):
+        # serialized already, without 8bit parts
+        return self._sendmail_args
+
+    def bcc_copy(self, bcc_addr):
+        """Returns a copy of this envelope sent to the *bcc_addr* list
+        only. The copy shares the serialized message instead of building
+        it again, so a message can go out to a long list of recipients
+        in several transactions. Its ``To`` and ``CC`` headers are kept,
+        but those addresses don't receive the copy."""
+        envelope = copy.copy(self)
+        envelope._to = []
+        envelope._cc = []
+        envelope._bcc = list(bcc_addr)
+
+        envelope._sendmail_args = (self._sendmail_args[0], envelope.recipients,
+                                   self._sendmail_args[2])
+        return envelope
+
+    def addressed_copy(self, to_addr):
+        """Returns a copy of this envelope sent to *to_addr* only, with
+        it in the ``To`` header. The serialized message is turned into a
+        :py:class:`envelopes.serializer.MessageSkeleton` the first time,
+        and each copy only adds its ``To`` header to it, so the message
+        isn't built, copied or quoted again per recipient. This envelope
+        must not have a ``To`` header of its own."""
+        if self._skeleton is None:
+            if self._to or 'To' in self._headers:
+                self._raise(MessageEncodeError,
+                            'addressed copies need an envelope without a To header')
+            msg = self._sendmail_args[2]
+            if not isinstance(msg, bytes):
+                msg = msg.encode(self._charset)
+            self._skeleton = serializer.MessageSkeleton(msg)
+
+        envelope = copy.copy(self)
+        envelope._to = [to_addr]
+        envelope._cc = []
+        envelope._bcc = []
+
+        to_header = self._encoded(self._addrs_to_header([to_addr]))
+        envelope._sendmail_args = (
+            self._sendmail_args[0], envelope.recipients,
+            self._skeleton.splice([('To', to_header)], self._charset)
+        )
+        return envelope
+
+    def to_mime_message(self, allow_8bit=False):
+        """Returns the serialized message, parsed back into a
+        :py:class:`email.message.Message`."""
+        msg = self._sendmail_args[2]
+        if isinstance(msg, serializer.SplicedMessage):
+            msg = msg.tobytes()
+        if isinstance(msg, bytes) and sys.version_info[0] == 3:
+            return email.message_from_bytes(msg)
+        return email.message_from_string(msg)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+"""
+envelopes.pool
+==============
+
+This module contains a pool of SMTP connections to the same server.
+"""
+
+try:
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Queue
+
+from .conn import SMTP
+
+__all__ = ['SMTPPool']
+
+
+class SMTPPool(object):
+    """A fixed number of :py:class:`envelopes.conn.SMTP` connections to the
+    same server. :py:meth:`send` is thread-safe: every call borrows a
+    connection nobody else is using, and blocks until one is free, so up
+    to *size* envelopes can be sent at the same time from different
+    threads.
+
+    The remaining arguments are passed to the constructor of
+    *smtp_class* (:py:class:`envelopes.conn.SMTP` by default) for each
+    of the connections. The connections are opened lazily, on their
+    first use. They all get the same *rate_limit*, so the limits apply
+    to the pool as a whole."""
+
+    def __init__(self, size, *args, **kwargs):
+        smtp_class = kwargs.pop('smtp_class', SMTP)
+
+        if size < 1:
+            raise ValueError('SMTPPool size must be at least 1')
+
+        self._size = size
+        self._conns = Queue()
+        for _ in range(size):
+            self._conns.put(smtp_class(*args, **kwargs))
+
+    @property
+    def size(self):
+        """Number of connections in the pool."""
+        return self._size
+
+    def send(self, envelope):
+        """Sends an *envelope* over one of the free connections."""
+        conn = self._conns.get()
+        try:
+            return conn.send(envelope)
+        finally:
+            self._conns.put(conn)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+envelopes.ratelimit
+===================
+
+This module contains the rate limiter SMTP connections wait on before
+sending each message.
+"""
+
+import threading
+import time
+
+try:
+    _now = time.monotonic
+except AttributeError:  # Python 2
+    _now = time.time
+
+__all__ = ['RateLimiter', 'HOST_RATE_LIMITS', 'host_rate_limiter']
+
+# Default limits of well-known SMTP hosts, as RateLimiter keyword arguments
+HOST_RATE_LIMITS = {
+    # GMail accounts may send about 2000 messages a day
+    'smtp.googlemail.com': {'per_second': 1, 'per_hour': 80},
+    'smtp.gmail.com': {'per_second': 1, 'per_hour': 80},
+    'smtp.sendgrid.net': {'per_second': 50},
+}
+
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+
+class _TokenBucket(object):
+    # Holds up to `capacity` tokens and gains `rate` tokens a second.
+    # Taking a token from an empty bucket leaves it in debt, which the
+    # taker waits out; later takers wait behind it.
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = self.capacity
+        self._stamp = None
+
+    def take(self, now):
+        if self._stamp is not None:
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+        self._tokens -= 1
+        return max(0.0, -self._tokens / self.rate)
+
+
+class RateLimiter(object):
+    """Token bucket limit on the number of messages sent per second and
+    per hour. One limiter can be shared by any number of connections and
+    threads: together they don't go over the limits.
+
+    :param per_second: messages per second, on average
+    :param per_hour: messages per hour
+    :param burst: number of messages that can be sent at once after a
+        quiet period, before the *per_second* rate kicks in. Defaults to
+        one second's worth. A quiet hour lets *per_hour* messages go
+        out as fast as *per_second* allows.
+
+    Either limit may be left out (``None``)."""
+
+    def __init__(self, per_second=None, per_hour=None, burst=None):
+        self.per_second = per_second
+        self.per_hour = per_hour
+
+        self._buckets = []
+        if per_second:
+            self._buckets.append(_TokenBucket(per_second, burst or max(per_second, 1)))
+        if per_hour:
+            self._buckets.append(_TokenBucket(per_hour / 3600.0, per_hour))
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes the right to send one message, and returns the number of
+        seconds to wait before sending it. Doesn't wait."""
+        now = _now()
+        with self._lock:
+            return max([bucket.take(now) for bucket in self._buckets] or [0.0])
+
+    def acquire(self):
+        """Blocks until one more message can be sent."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def host_rate_limiter(host):
+    """Returns the :py:class:`RateLimiter` shared by all the connections
+    to *host*, if it is in :py:data:`HOST_RATE_LIMITS`, else *None*."""
+    if host not in HOST_RATE_LIMITS:
+        return None
+
+    with _host_limiters_lock:
+        if host not in _host_limiters:
+            _host_limiters[host] = RateLimiter(**HOST_RATE_LIMITS[host])
+        return _host_limiters[host]
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+
+"""
+envelopes.serializer
+====================
+
+This module writes envelopes out as RFC 5322/MIME bytes directly,
+without building a tree of :py:mod:`email.mime` objects and walking it
+again with :py:mod:`email.generator`.
+
+The messages are laid out the way :py:meth:`Envelope.to_mime_message`
+lays them out: a ``multipart/alternative`` message with the text parts,
+followed by the attachments. Parsed with
+:py:mod:`email`, both give the same headers and parts; only the boundary
+and where long headers are folded differ. Lines end with CRLF, as they
+do on the wire.
+
+Every chunk of the message is collected in a list and joined once at
+the end, so the message is copied into a buffer of the right size in a
+single pass. Attachments are serialized the first time they're written
+and the bytes are kept on the MIME part, so an attachment shared through
+an :py:class:`envelopes.envelope.AttachmentCache` is only serialized
+once per process.
+
+Both pick the transfer encoding of each text part with
+:py:func:`text_body`: text that is all ASCII is sent as it is (7bit),
+mostly ASCII text is quoted-printable and the rest base64, unless the
+server takes 8bit data (``8BITMIME``), in which case text with short
+enough lines is sent as it is (8bit).
+
+A message sent to many receivers can also be turned into a
+:py:class:`MessageSkeleton` once, and a few headers (e.g. ``To``)
+spliced onto it for each receiver. The body is shared, ready to be
+sent, by all the :py:class:`SplicedMessage` objects made from the
+skeleton.
+"""
+
+import base64
+import binascii
+from email.charset import Charset
+import random
+import re
+import sys
+
+from .conn import _HIGH_BYTES, _quote_data, _quote_lines
+
+if sys.version_info[0] == 3:
+    _encodebytes = base64.encodebytes
+else:
+    _encodebytes = base64.encodestring
+
+__all__ = ['crlf', 'header_line', 'transfer_encoding', 'text_body', 'message_bytes',
+           'MessageSkeleton', 'SplicedMessage']
+
+CRLF = b'\r\n'
+
+# Length lines are folded at, not counting the CRLF
+MAX_LINE_LENGTH = 78
+
+_BOUNDARY_FORMAT = '===============%019d=='
+
+_EOLS_RE = re.compile(br'\r?\n')
+
+# Lines longer than that many octets (RFC 5322 and 5321's limit) have
+# to be encoded
+_LONG_LINE_RE = re.compile(br'[^\r\n]{999}')
+
+SEVEN_BIT = '7bit'
+EIGHT_BIT = '8bit'
+QUOTED_PRINTABLE = 'quoted-printable'
+BASE64 = 'base64'
+
+
+def crlf(msg):
+    """Returns the bytes *msg* with CRLF line endings."""
+    return _EOLS_RE.sub(CRLF, msg)
+
+
+def _bytes(_str, charset):
+    if isinstance(_str, bytes):
+        return _str
+    return _str.encode(charset)
+
+
+def header_line(name, value, charset):
+    """``Name: value`` as bytes, folded if it is too long. Values
+    encoded with :py:class:`email.header.Header` are folded already."""
+    value = _bytes(value, charset)
+    if b'\n' in value:
+        return name + b': ' + crlf(value) + CRLF
+
+    if len(name) + 2 + len(value) <= MAX_LINE_LENGTH:
+        return name + b': ' + value + CRLF
+
+    lines = []
+    line = name + b':'
+    for word in value.split(b' '):
+        if len(line) + 1 + len(word) > MAX_LINE_LENGTH and line.strip():
+            lines.append(line)
+            line = b''
+        line += b' ' + word
+    lines.append(line)
+    return CRLF.join(lines) + CRLF
+
+
+def _boundary(texts):
+    # base64 lines never contain "==" followed by anything, and "=" is
+    # escaped in quoted-printable text, so the boundary can only turn up
+    # in 7bit and 8bit text
+    while True:
+        boundary = (_BOUNDARY_FORMAT % random.randrange(sys.maxsize)).encode('ascii')
+        if not any(boundary in text for text in texts):
+            return boundary
+
+
+def transfer_encoding(data, allow_8bit=False):
+    """Returns the transfer encoding the text *data* (``bytes``) takes
+    the fewest bytes in, of those it can be sent in.
+
+    Quoted-printable takes three bytes per non-ASCII byte, and base64 four
+    bytes per three, so text is quoted-printable if less than a sixth of
+    it isn't ASCII."""
+    long_lines = _LONG_LINE_RE.search(data) is not None
+    high = len(data) - len(data.translate(None, _HIGH_BYTES))
+
+    if not high and not long_lines:
+        return SEVEN_BIT
+    if allow_8bit and not long_lines:
+        return EIGHT_BIT
+    if high * 6 < len(data):
+        return QUOTED_PRINTABLE
+    return BASE64
+
+
+def text_body(text, charset, allow_8bit=False):
+    """Encodes the *text* of a text part.
+
+    :param charset: the charset of the part
+    :param allow_8bit: whether the part can be sent as 8bit
+    :returns: the ``(charset, transfer encoding, body)`` of the part,
+              with the body as ``bytes`` with LF line endings
+    """
+    output_charset = Charset(charset).get_output_charset()
+    data = _bytes(text, output_charset)
+    encoding = transfer_encoding(data, allow_8bit)
+
+    if encoding == BASE64:
+        data = _encodebytes(data)
+    elif encoding == QUOTED_PRINTABLE:
+        data = binascii.b2a_qp(data, istext=True)
+    return output_charset, encoding, data
+
+
+def _text_part(mimetype, text, charset, allow_8bit):
+    output_charset, encoding, body = text_body(text, charset, allow_8bit)
+    return (b'Content-Type: ' + mimetype.encode('ascii') +
+            b'; charset="' + output_charset.encode('ascii') + b'"' + CRLF +
+            b'MIME-Version: 1.0' + CRLF +
+            b'Content-Transfer-Encoding: ' + encoding.encode('ascii') + CRLF +
+            CRLF +
+            crlf(body))
+
+
+def _attachment_part(part):
+    serialized = getattr(part, '_serialized', None)
+    if serialized is None:
+        serialized = crlf(_bytes(part.as_string(), 'utf-8'))
+        if not serialized.endswith(CRLF):
+            serialized += CRLF
+        # shared by all the messages the part is in; it mustn't change
+        part._serialized = serialized
+    return serialized
+
+
+def message_bytes(headers, parts, charset, allow_8bit=False):
+    """Returns the message as bytes.
+
+    :param headers: list of ``(name, value)`` tuples, with the values
+                    encoded as they should appear in the message
+    :param parts: the :py:attr:`Envelope._parts` of the message
+    :param charset: the charset of the header values and text parts
+    :param allow_8bit: whether text parts can be sent as 8bit
+    """
+    texts = []
+    serialized_parts = []
+    for part in parts:
+        if len(part) == 3:
+            serialized = _text_part(part[0], part[1], charset, allow_8bit)
+            texts.append(serialized)
+        else:
+            serialized = _attachment_part(part[1])
+        serialized_parts.append(serialized)
+
+    boundary = _boundary(texts)
+    chunks = [
+        b'Content-Type: multipart/alternative; boundary="' + boundary + b'"' + CRLF,
+        b'MIME-Version: 1.0' + CRLF,
+    ]
+    for name, value in headers:
+        chunks.append(header_line(_bytes(name, 'ascii'), value, charset))
+
+    delimiter = CRLF + b'--' + boundary + CRLF
+    for serialized in serialized_parts:
+        chunks.append(delimiter)
+        chunks.append(serialized)
+    chunks.append(CRLF + b'--' + boundary + b'--' + CRLF)
+
+    return b''.join(chunks)
+
+
+class MessageSkeleton(object):
+    """A serialized message that headers are spliced onto.
+
+    The message is split after its headers. Its body is quoted for
+    ``DATA`` once, and shared by all the messages :py:meth:`splice`
+    makes.
+
+    :param msg: the serialized message, as bytes, without the headers
+                that will be spliced onto it
+    """
+
+    def __init__(self, msg):
+        msg = crlf(msg)
+        #: Whether the message has 8bit data, and must be sent as such
+        self.eightbit = len(msg.translate(None, _HIGH_BYTES)) != len(msg)
+
+        end = msg.index(CRLF + CRLF) + len(CRLF)
+        self.headers = msg[:end]
+        body = msg[end:]
+
+        quoted = _quote_data(body)
+        self.quoted_body = memoryview(quoted)
+        if len(quoted) == len(body) + 3 and quoted.startswith(body):
+            # nothing was quoted but the final ".": keep a single copy
+            self.body = self.quoted_body[:len(body)]
+        else:
+            self.body = memoryview(body)
+
+    def splice(self, headers, charset='utf-8'):
+        """Returns a :py:class:`SplicedMessage` with the *headers* (a
+        list of ``(name, value)`` tuples, with the values encoded as they
+        should appear in the message) added to the skeleton's."""
+        return SplicedMessage(self, b''.join(header_line(_bytes(name, 'ascii'), value, charset)
+                                             for name, value in headers))
+
+
+class SplicedMessage(object):
+    """A message made of a few headers of its own in front of a
+    :py:class:`MessageSkeleton`.
+
+    Stands in for the serialized message string of an envelope.
+    :py:class:`envelopes.conn.SMTP` sends its :py:meth:`data_chunks`
+    without joining them."""
+
+    __slots__ = ('_skeleton', '_headers')
+
+    def __init__(self, skeleton, headers):
+        self._skeleton = skeleton
+        self._headers = headers
+
+    def __len__(self):
+        return (len(self._skeleton.headers) + len(self._headers) +
+                len(self._skeleton.body))
+
+    @property
+    def eightbit(self):
+        """Whether the skeleton has 8bit data."""
+        return self._skeleton.eightbit
+
+    def data_chunks(self):
+        """Returns the message ready to be sent after ``DATA``, as a list
+        of a small ``bytes`` and the skeleton's shared body."""
+        return [_quote_lines(self._skeleton.headers + self._headers),
+                self._skeleton.quoted_body]
+
+    def tobytes(self):
+        """Returns the whole message as ``bytes``."""
+        return self._skeleton.headers + self._headers + self._skeleton.body.tobytes()
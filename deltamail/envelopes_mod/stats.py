@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+envelopes.stats
+===============
+
+This module contains timers and counters for the phases messages go
+through on their way out: rendering the templates (``render``), building
+the MIME message (``mime``), serializing it (``serialize``) and the SMTP
+transaction (``smtp``), and counters of the messages the server took
+(``sent``) and of the receivers it refused (``refused``).
+
+They are off by default, and then cost one function call per phase.
+Call :py:func:`enable` to start collecting, and :py:func:`report` or
+:py:func:`status_line` to see the figures. The figures are shared by
+all the threads of the process. Work done in other processes (e.g.
+rendering with ``deltamail.render.render_parallel``) isn't counted.
+
+    with stats.timed('render'):
+        body = template.render(**variables)
+"""
+
+import threading
+import time
+
+try:
+    _now = time.perf_counter
+except AttributeError:  # Python 2
+    _now = time.time
+
+__all__ = ['enable', 'disable', 'reset', 'timed', 'count', 'snapshot',
+           'report', 'status_line']
+
+# Listed first, in this order, in reports
+PHASES = ('render', 'mime', 'serialize', 'smtp')
+
+enabled = False
+
+_lock = threading.Lock()
+_timers = {}    # name -> [calls, seconds]
+_counters = {}  # name -> count
+_started = None
+
+
+class _Timer(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = _now()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = _now() - self.start
+        with _lock:
+            timer = _timers.get(self.name)
+            if timer is None:
+                timer = _timers[self.name] = [0, 0.0]
+            timer[0] += 1
+            timer[1] += elapsed
+
+
+class _NoTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_TIMER = _NoTimer()
+
+
+def enable():
+    """Clears the figures and starts collecting."""
+    global enabled
+    reset()
+    enabled = True
+
+
+def disable():
+    """Stops collecting. The figures are kept."""
+    global enabled
+    enabled = False
+
+
+def reset():
+    """Clears the figures, and restarts the clock."""
+    global _started
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _started = _now()
+
+
+def timed(name):
+    """Returns a context manager that adds the time spent in it to the
+    timer *name*."""
+    if not enabled:
+        return _NO_TIMER
+    return _Timer(name)
+
+
+def count(name, n=1):
+    """Adds *n* to the counter *name*."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def snapshot():
+    """Returns the figures as a dictionary::
+
+        {'elapsed': seconds since enable(),
+         'timers': {name: (calls, seconds), ...},
+         'counters': {name: count, ...}}
+    """
+    with _lock:
+        return {
+            'elapsed': _now() - _started if _started is not None else 0.0,
+            'timers': dict((name, tuple(t)) for name, t in _timers.items()),
+            'counters': dict(_counters),
+        }
+
+
+def _ordered(names):
+    return ([name for name in PHASES if name in names] +
+            sorted(name for name in names if name not in PHASES))
+
+
+def report():
+    """Returns a table of the time spent in each phase, and the
+    counters, as a string."""
+    figures = snapshot()
+    timers = figures['timers']
+    total = sum(seconds for _, seconds in timers.values()) or 1.0
+
+    lines = ['%-12s %10s %10s %12s %6s' % ('phase', 'calls', 'seconds', 'ms/call', '%')]
+    for name in _ordered(timers):
+        calls, seconds = timers[name]
+        lines.append('%-12s %10d %10.3f %12.3f %5.1f%%' % (
+            name, calls, seconds, seconds * 1000 / calls, seconds * 100 / total))
+    for name in sorted(figures['counters']):
+        lines.append('%-12s %10d' % (name, figures['counters'][name]))
+    lines.append('elapsed: %.3fs' % figures['elapsed'])
+    return '\n'.join(lines)
+
+
+def status_line():
+    """Returns a one line summary: messages sent so far, the rate, and
+    the mean time per call of each phase."""
+    figures = snapshot()
+    timers = figures['timers']
+    elapsed = figures['elapsed'] or 1e-9
+
+    sent = figures['counters'].get('sent', 0)
+    parts = ['[%.1fs] %d sent (%.1f/s)' % (figures['elapsed'], sent, sent / elapsed)]
+    for name in _ordered(timers):
+        calls, seconds = timers[name]
+        parts.append('%s %.2fms' % (name, seconds * 1000 / calls))
+    return ' '.join(parts)
@@ -0,0 +1,159 @@
+'''Records what happened to each receiver of a campaign
+
+A journal is an append-only text file, with one line per receiver:
+
+    STATUS<TAB>EMAIL<TAB>DETAILS
+
+where STATUS is one of:
+    delivered: the SMTP server accepted the mail for the receiver.
+    refused: the server refused the receiver. DETAILS has its reply.
+    failed: sending the mail failed. DETAILS has the error.
+
+The lines are written as the mails are sent, and synced to disk every
+few lines (see SendJournal), so a crashed campaign can be resumed by
+leaving out the receivers read_delivered finds in its journal. The
+lines not synced yet at the time of the crash are lost, so the last
+few receivers may get the mail twice, but no receiver is left out.
+'''
+import os
+import threading
+import time
+
+DELIVERED = "delivered"
+REFUSED = "refused"
+FAILED = "failed"
+
+
+class SendJournal(object):
+    '''
+    An open journal file, which lines are appended to.
+
+    record() can be called from several threads at once. The file is
+    synced to disk (fsync) once `sync_every` lines have been written
+    since the last sync, or once `sync_interval` seconds have gone by,
+    whichever comes first, and when the journal is closed.
+    '''
+
+    def __init__(self, filename, sync_every=100, sync_interval=1.0):
+        '''
+        Open the journal file for appending, creating it if needed.
+
+        Args:
+            filename (str): The path of the journal file.
+            sync_every (Optional[int]): Number of lines between syncs.
+            sync_interval (Optional[float]): Seconds between syncs.
+        '''
+        self.filename = filename
+        self._sync_every = sync_every
+        self._sync_interval = sync_interval
+
+        self._file = open(filename, "a")
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def record(self, status, email, details=""):
+        '''
+        Append the outcome of sending to a receiver.
+
+        Args:
+            status (str): DELIVERED, REFUSED or FAILED.
+            email (str): The email-id of the receiver.
+            details (Optional[str]): The server's reply or the error.
+        '''
+        details = " ".join(str(details).split())
+        line = "%s\t%s\t%s\n" % (status, email, details)
+
+        with self._lock:
+            self._file.write(line)
+            self._unsynced += 1
+            if (self._unsynced >= self._sync_every or
+                    time.time() - self._last_sync >= self._sync_interval):
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def close(self):
+        '''Sync and close the journal file.'''
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class JournaledSender(object):
+    '''
+    Wraps an SMTP connection (or pool), and records in a SendJournal what
+    happens to the receivers of each mail sent through it.
+
+    Has the same send() method as the connection, so it can be handed to
+    Campaign.send and deltamail.sender.send_parallel in its place.
+    '''
+
+    def __init__(self, smtp_conn, journal):
+        self._smtp_conn = smtp_conn
+        self._journal = journal
+
+    def send(self, envelope):
+        receivers = [str(addr) for addr in
+                     envelope.to_addr + envelope.cc_addr + envelope.bcc_addr]
+        try:
+            refused = self._smtp_conn.send(envelope) or {}
+        except Exception as e:
+            # smtplib raises this one when all the receivers were refused
+            refused = getattr(e, "recipients", None)
+            if not refused:
+                for email in receivers:
+                    self._journal.record(FAILED, email, e)
+            else:
+                for email in receivers:
+                    self._journal.record(REFUSED, email, refused.get(email, e))
+            raise
+
+        for email in receivers:
+            if email in refused:
+                self._journal.record(REFUSED, email, refused[email])
+            else:
+                self._journal.record(DELIVERED, email)
+        return refused
+
+
+def read_delivered(filename):
+    '''
+    Read the email-ids recorded as delivered in a journal file.
+
+    A line cut short by a crash is ignored. A missing file is taken as an
+    empty journal.
+
+    Args:
+        filename (str): The path of the journal file.
+
+    Returns:
+        set: The delivered email-ids.
+    '''
+    delivered = set()
+    if not os.path.exists(filename):
+        return delivered
+
+    fjournal = open(filename, "r")
+    try:
+        for line in fjournal:
+            if not line.endswith("\n"):
+                break
+            fields = line.split("\t")
+            if len(fields) == 3 and fields[0] == DELIVERED:
+                delivered.add(fields[1])
+    finally:
+        fjournal.close()
+
+    return delivered
@@ -7,10 +7,252 @@ import os.path as path
 from email.utils import formatdate
 
 from deltamail import envelopes_mod as envelopes
-from jinja2 import Template
+from jinja2 import Template, meta, nodes
 
+try:
+    text_type = unicode
+except NameError:  # Python 3
+    text_type = str
 
-def MailFactory(from_addr, subject, mailing_list, template_str, variables):
+
+class CompiledTemplate(object):
+    '''
+    A template string, compiled by jinja2.
+
+    Keeps the source along with the compiled template, so that it can be
+    pickled (e.g. to send it to other processes). Unpickling compiles
+    the source again.
+
+    Templates that are only text and {{ variable }} placeholders, with no
+    tags, filters or expressions, are rendered without jinja2: the text
+    between the placeholders is kept, and the values are put in between
+    and joined once per render. They render to the same text jinja2
+    would (a missing variable renders as nothing).
+    '''
+
+    def __init__(self, source):
+        self.source = source
+        self._template = Template(source)
+        self._variables = None
+
+        environment = self._template.environment
+        self._segments = _substitution_segments(environment,
+                                                environment.parse(source).body)
+
+    @property
+    def variables(self):
+        '''
+        The names of the variables the template uses, as a frozenset.
+
+        Found by jinja2's static analysis of the template (see
+        jinja2.meta.find_undeclared_variables): the variables that can
+        change what the template renders to. Names the template sets
+        itself (e.g. with {% set %} or {% for %}) aren't included.
+        '''
+        if self._variables is None:
+            ast = self._template.environment.parse(self.source)
+            self._variables = frozenset(meta.find_undeclared_variables(ast))
+        return self._variables
+
+    def render(self, **variables):
+        '''Render the template with the given variables.'''
+        if self._segments is not None:
+            return _substitute(self._segments, variables)
+        return self._template.render(**variables)
+
+    def bake(self, global_vars, personal):
+        '''
+        Render the parts of the template that only use global variables.
+
+        Args:
+            global_vars (dict): The global variables of a campaign.
+            personal (iterable): The names of the personal variables,
+                which can override the global ones.
+
+        Returns:
+            BakedTemplate: A template that renders to the same text,
+                given the same global variables along with the personal
+                ones.
+        '''
+        return BakedTemplate(self.source, global_vars, personal)
+
+    def __reduce__(self):
+        return (CompiledTemplate, (self.source,))
+
+
+# Names jinja2 gives a meaning of its own inside templates
+_RESERVED_NAMES = frozenset(["self", "loop", "varargs", "kwargs", "caller"])
+
+
+def _substitution_segments(environment, body):
+    '''
+    Split a template that only has text and {{ variable }} placeholders.
+
+    Args:
+        environment (jinja2.Environment): The environment of the template.
+        body (list): The nodes of the template.
+
+    Returns:
+        tuple: The text before the first placeholder, and a tuple of
+            (variable name, text after it) tuples, or None if the
+            template has anything else.
+    '''
+    texts = [u""]
+    names = []
+    for node in body:
+        if not isinstance(node, nodes.Output):
+            return None
+        for child in node.nodes:
+            if isinstance(child, nodes.TemplateData):
+                texts[-1] += child.data
+            elif (isinstance(child, nodes.Name) and child.ctx == "load" and
+                  child.name not in environment.globals and
+                  child.name not in _RESERVED_NAMES):
+                names.append(child.name)
+                texts.append(u"")
+            else:
+                return None
+    return texts[0], tuple(zip(names, texts[1:]))
+
+
+def _substitute(segments, variables):
+    '''Render the segments of a template, see _substitution_segments.'''
+    first, rest = segments
+    chunks = [first]
+    for name, text in rest:
+        value = variables.get(name, u"")
+        chunks.append(value if isinstance(value, text_type) else text_type(value))
+        chunks.append(text)
+    return u"".join(chunks)
+
+
+# Nodes that define names, or take text from other templates, which the
+# parts of a template around them may depend on
+_SCOPE_NODES = (nodes.Assign, nodes.AssignBlock, nodes.Macro, nodes.CallBlock,
+                nodes.Block, nodes.Extends, nodes.Include, nodes.Import,
+                nodes.FromImport)
+
+# Filters that don't always give the same result for the same value
+_IMPURE_FILTERS = frozenset(["random"])
+
+# Globals of jinja2 that give random text, or objects with state
+_IMPURE_GLOBALS = frozenset(["lipsum", "cycler", "joiner"])
+
+
+def _is_constant(environment, node, constants):
+    '''Whether the template node only uses the variables in `constants`'''
+    if not isinstance(node, (nodes.Output, nodes.If, nodes.For)):
+        return False
+    if any(True for _ in node.find_all(_SCOPE_NODES)):
+        return False
+    if any(f.name in _IMPURE_FILTERS for f in node.find_all(nodes.Filter)):
+        return False
+    if any(n.name in _IMPURE_GLOBALS for n in node.find_all(nodes.Name)):
+        return False
+
+    template = nodes.Template([node], lineno=1)
+    template.set_environment(environment)
+    return meta.find_undeclared_variables(template) <= constants
+
+
+def _from_ast(environment, body):
+    template = nodes.Template(body, lineno=1)
+    template.set_environment(environment)
+    return environment.template_class.from_code(
+        environment, environment.compile(template), environment.make_globals(None))
+
+
+class BakedTemplate(CompiledTemplate):
+    '''
+    A CompiledTemplate with the parts that only use global variables
+    rendered once, when it is created, and kept as text.
+
+    The template is parsed and each of its top-level statements, and
+    each expression of its top-level {{ }} outputs, is looked at with
+    jinja2's static analysis. The ones that use no personal variable,
+    no name the template defines itself, no random filter and none of
+    the lipsum, cycler and joiner globals are rendered with the global
+    variables. Runs of them are merged into
+    constant text, so only the parts that use personal variables are
+    evaluated when the template is rendered.
+
+    Templates that extend, include or import others are kept as they are.
+
+    Create one with CompiledTemplate.bake.
+    '''
+
+    def __init__(self, source, global_vars, personal):
+        CompiledTemplate.__init__(self, source)
+        self._global_vars = global_vars
+        self._personal = frozenset(personal)
+        self._bake()
+
+    def _bake(self):
+        environment = self._template.environment
+        ast = environment.parse(self.source)
+
+        names = set(node.name for node in ast.find_all(nodes.Name) if node.ctx != "load")
+        if any(True for _ in ast.find_all((nodes.Extends, nodes.Include, nodes.Import,
+                                           nodes.FromImport))):
+            return
+        constants = frozenset(self._global_vars) - self._personal - names
+
+        # the statements, with each output split in its expressions
+        statements = []
+        for node in ast.body:
+            if isinstance(node, nodes.Output):
+                statements.extend(nodes.Output([child]) for child in node.nodes)
+            else:
+                statements.append(node)
+
+        body = []
+        run = []
+        for node in statements + [None]:
+            if node is not None and _is_constant(environment, node, constants):
+                run.append(node)
+                continue
+
+            if run:
+                try:
+                    text = _from_ast(environment, run).render(**self._global_vars)
+                except Exception:
+                    # left to fail (or not) for every mail, as it would have
+                    body.extend(run)
+                else:
+                    body.append(nodes.Output([nodes.TemplateData(text)]))
+                run = []
+            if node is not None:
+                body.append(node)
+
+        self._template = _from_ast(environment, body)
+        self._segments = _substitution_segments(environment, body)
+
+    def __reduce__(self):
+        return (BakedTemplate, (self.source, self._global_vars, self._personal))
+
+
+def compile_template(source):
+    '''
+    Compile a template string so that it can be rendered many times.
+
+    Campaigns compile their subject and body templates once and pass the
+    compiled templates to MailFactory for every receiver, instead of
+    making jinja2 parse the same source over and over again.
+
+    Args:
+        source (str): The template string. If it is already a
+            CompiledTemplate, it is returned as it is.
+
+    Returns:
+        CompiledTemplate: The compiled template.
+    '''
+    if isinstance(source, CompiledTemplate):
+        return source
+    return CompiledTemplate(source)
+
+
+def MailFactory(from_addr, subject, mailing_list, template_str, variables,
+                attachment_cache=None, compact=False):
     '''
     Create a Mail object.
 
@@ -19,12 +261,20 @@ def MailFactory(from_addr, subject, mailing_list, template_str, variables):
 
     Args:
         from_addr (str): The email address of the sender.
-        subject (str): The subject of the mail. Can be a template.
+        subject (str): The subject of the mail. Can be a template, either
+            as a string or as a CompiledTemplate.
         mailing_list (list): The list of the email addresses to whom
             the mail will be sent.
-        template_str (str): The template of the mail-body.
+        template_str (str): The template of the mail-body. Can be a
+            string or a CompiledTemplate.
         variables (dict): The dictionary of the variables used to fill-in
             the body and subject templates and to attach files.
+        attachment_cache (Optional[envelopes.AttachmentCache]): Cache to take
+            the attachments from. Campaigns share one cache between all
+            their mails, so that each file is read and encoded only once.
+        compact (Optional[bool]): Create an envelopes.CompactEnvelope,
+            which takes less memory, for campaigns that keep many mails
+            queued. Defaults to False.
 
     Returns:
         Mail: An instance of Mail with values appropriately filled in.
@@ -36,18 +286,17 @@ def MailFactory(from_addr, subject, mailing_list, template_str, variables):
     else:
         attachments = []
 
-    subject_templ = Template(subject)
-
-    subject = subject_templ.render(**variables)
-
-    body_template = Template(template_str)
-    body = body_template.render(**variables)
+    with envelopes.stats.timed("render"):
+        subject = compile_template(subject).render(**variables)
+        body = compile_template(template_str).render(**variables)
 
-    envl = envelopes.Envelope(from_addr=from_addr, subject=subject,
-                              to_addr=mailing_list, html_body=body,
-                              headers={"Date": formatdate(localtime=True)})
+    envelope_class = envelopes.CompactEnvelope if compact else envelopes.Envelope
+    envl = envelope_class(from_addr=from_addr, subject=subject,
+                          to_addr=mailing_list, html_body=body,
+                          headers={"Date": formatdate(localtime=True)})
 
     for attch in attachments:
-        envl.add_attachment(path.abspath(path.expanduser(attch)))
+        envl.add_attachment(path.abspath(path.expanduser(attch)),
+                            cache=attachment_cache)
 
     return envl
@@ -0,0 +1,233 @@
+'''Reads mailing-list (.ml) files
+
+A .ml file is a tab separated file. Its first line is the list of
+fields, the first of which has to be `email`. Every other non-blank line
+is a receiver, with one value per field.
+
+Use the MailingListFile class to iterate over the receivers of a .ml
+file. The file is read one line at a time, so mailing lists of any size
+can be used without holding them in memory.
+
+A mailing list that has to be held in memory is best kept in a
+MailingList, which stores the fields once and a tuple of values per
+receiver, instead of a dictionary per receiver.
+
+Either way, the variables of each receiver are a RowVariables mapping:
+a view of the row's tuple, with the field -> position index shared by
+all the rows.
+'''
+import copy
+import os
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # Python 2
+    from collections import Mapping
+
+
+class RowVariables(Mapping):
+    '''
+    Read-only mapping of the fields of a mailing list to the values of a
+    row, without the `email` field.
+
+    Args:
+        index (dict): Position of each field in the row. Shared by all
+            the rows of a mailing list.
+        values (tuple): The row, email-id first.
+    '''
+    __slots__ = ("_index", "_values")
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, field):
+        return self._values[self._index[field]]
+
+    def __contains__(self, field):
+        return field in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __reduce__(self):
+        return (RowVariables, (self._index, self._values))
+
+    def __repr__(self):
+        return "RowVariables(%r)" % (dict(self),)
+
+
+def _index(headers):
+    '''Position of each field but `email` in the rows'''
+    return dict((field, position) for position, field in enumerate(headers) if position)
+
+
+def _receivers(headers, rows):
+    '''Yield the {"email", "variables"} dict of each row'''
+    index = _index(headers)
+    for row in rows:
+        yield {"email": row[0], "variables": RowVariables(index, row)}
+
+
+def _selected(headers, columns):
+    '''The fields in `columns`, after `email`, and their positions'''
+    fields = [field for field in headers[1:] if field in columns]
+    return ["email"] + fields, [0] + [headers.index(field) for field in fields]
+
+
+class MailingList(object):
+    '''
+    A mailing list held in memory.
+
+    Iterating over it yields the receivers, as dictionaries of form:
+        { "email": "...", "variables": RowVariables }
+
+    Args:
+        headers (list): The fields, the first of which is `email`.
+        rows (Optional[iterable]): The rows, as sequences of values in
+            the order of the fields.
+    '''
+
+    def __init__(self, headers, rows=()):
+        self.headers = list(headers)
+        self.rows = []
+        for row in rows:
+            self.append(row)
+
+    def append(self, row):
+        '''
+        Add a row.
+
+        Raises:
+            Exception: If the row doesn't have a value per field.
+        '''
+        row = tuple(row)
+        if len(row) != len(self.headers):
+            raise Exception("Mismatch in number of columns.")
+        self.rows.append(row)
+
+    def select(self, columns):
+        '''
+        Returns a MailingList with the fields in `columns` only.
+        '''
+        headers, positions = _selected(self.headers, columns)
+        return MailingList(headers, (tuple(row[i] for i in positions) for row in self.rows))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return _receivers(self.headers, self.rows)
+
+
+class MailingListFile(object):
+    '''
+    Iterable over the receivers in a mailing-list (.ml) file.
+
+    Each receiver is a dictionary of form:
+        { "email": "...", "variables": RowVariables }
+
+    The header is read and checked when the object is created. The rows
+    are read, split and checked only while iterating, and the file is
+    read again from the start for every iteration.
+
+    The rows of the email-ids in `exclude` are skipped without being
+    split or checked, e.g. to leave out the receivers a resumed campaign
+    has already sent to (see deltamail.journal).
+    '''
+
+    def __init__(self, filename, exclude=None):
+        '''
+        Open the mailing-list file and read its header.
+
+        Args:
+            filename (str): The path of the .ml file.
+            exclude (Optional[set]): email-ids to skip. Defaults to None.
+
+        Raises:
+            Exception: If the file doesn't exist, or if the first field
+                of the file isn't `email`.
+        '''
+        if os.path.exists(filename) is False:
+            raise Exception("Mailing list file ({0}) doesn't exist"
+                            .format(os.path.abspath(filename)))
+
+        self.filename = filename
+        self.exclude = exclude or set()
+
+        fml = open(filename, "r")
+        self.headers = fml.readline().rstrip("\r\n").split("\t")
+        fml.close()
+
+        if self.headers[0] != "email":
+            raise Exception("%s:1: First field of mailing list file is "
+                            "required to be `email`" % (filename,))
+
+        # number of columns of the rows, and the ones to keep (all)
+        self._width = len(self.headers)
+        self._positions = None
+
+    def select(self, columns):
+        '''
+        Returns a MailingListFile over the same file that only reads the
+        fields in `columns`. The other values of each row are dropped as
+        soon as the row is split.
+        '''
+        selected = copy.copy(self)
+        selected.headers, selected._positions = _selected(self.headers, columns)
+        return selected
+
+    def load(self):
+        '''
+        Read the whole file into a MailingList.
+
+        Raises:
+            Exception: See __iter__.
+        '''
+        return MailingList(self.headers, self._rows())
+
+    def __iter__(self):
+        '''
+        Yield the receivers in the file, in order.
+
+        Blank lines are skipped.
+
+        Raises:
+            Exception: If the number of columns in a row doesn't match
+                the number of fields in the header. The message contains
+                the line number of the row.
+        '''
+        return _receivers(self.headers, self._rows())
+
+    def _rows(self):
+        '''Yield the rows of the file, as tuples'''
+        width = self._width
+        positions = self._positions
+        exclude = self.exclude
+
+        fml = open(self.filename, "r")
+        try:
+            fml.readline()
+
+            # the header is line 1
+            for lineno, line in enumerate(fml, 2):
+                line = line.rstrip("\r\n")
+                if line.strip() == "":
+                    continue
+                if exclude and line.split("\t", 1)[0] in exclude:
+                    continue
+
+                row = line.split("\t")
+                if len(row) != width:
+                    raise Exception("%s:%d: Mismatch in number of columns."
+                                    % (self.filename, lineno))
+
+                if positions is None:
+                    yield tuple(row)
+                else:
+                    yield tuple(row[i] for i in positions)
+        finally:
+            fml.close()
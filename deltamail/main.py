@@ -7,8 +7,10 @@ import argparse
 import os
 import getpass
 import sys
+import threading
 
 from deltamail.campaign import CampaignFactory
+from deltamail.journal import SendJournal, read_delivered
 from deltamail import envelopes_mod as envelopes
 
 
@@ -20,7 +22,7 @@ def console_main():
         # SystemExit raised by sys.exit() call in argparse.
         # Nothing to print in that case. Print other errors.
         if not isinstance(e, SystemExit):
-            print "\nError: " + str(e)
+            print("\nError: " + str(e))
         sys.exit()
 
 
@@ -78,9 +80,56 @@ def work():
     parser.add_argument('-p', '--port',        help="Port to be used", type=int, default=25)
     parser.add_argument('-m', '--sendermailid',help="The sender email")
     parser.add_argument('-o', '--host',        help="SMTP host IP or name", default="localhost")
+    parser.add_argument('-c', '--concurrency', help="Number of SMTP connections to send mails over at once",
+                        type=int, default=1)
+
+    parser.add_argument('--rate', type=rate,
+                        help="maximum number of mails sent per second (on average).\n"
+                             "'auto' uses the known limits of the host, if any (see\n"
+                             "envelopes.ratelimit). Mails aren't limited by default")
+    parser.add_argument('--hourly_rate', type=int,
+                        help="maximum number of mails sent per hour. Can't be used\n"
+                             "with --rate auto")
 
     parser.add_argument('-pw', '--preview',    help="to preview the mail(**the mail wont be sent**)")
+    parser.add_argument('--preview_format', choices=['html', 'mbox', 'maildir'], default='html',
+                        help="html: the body of each mail in a file of its own, in the\n"
+                             "--preview directory. mbox/maildir: the whole mails in the\n"
+                             "--preview mbox file/Maildir directory")
     parser.add_argument('-sm', '--smart_send', help="path for smart send")
+    parser.add_argument('-j', '--processes', type=int,
+                        help="number of processes to render personalised (-R) mails on")
+    parser.add_argument('-b', '--batch_size', type=int,
+                        help="send the mail as BCC to this many receivers (-r, or -R\n"
+                             "with --dedup) per SMTP transaction. By default -r sends\n"
+                             "one mail with all the receivers in the To header, and\n"
+                             "--dedup 100 receivers per mail")
+    parser.add_argument('--personal_to', action='store_true',
+                        help="send each -r receiver a mail of their own, with them in\n"
+                             "the To header (the mail is still built only once)")
+    parser.add_argument('--dedup', action='store_true',
+                        help="send personalised (-R) mails that come out identical\n"
+                             "as one mail to all their receivers, as BCC")
+    parser.add_argument('--stream', action='store_true',
+                        help="create the mails one at a time while sending/previewing,\n"
+                             "instead of creating all of them before the first one is sent")
+
+    parser.add_argument('--fast_serialize', action='store_true',
+                        help="write the mails out directly instead of through the\n"
+                             "email package's MIME classes (faster, same mails)")
+
+    parser.add_argument('--journal',
+                        help="file to record what happens to each receiver in")
+    parser.add_argument('--resume', action='store_true',
+                        help="resume an interrupted campaign: skip the receivers the\n"
+                             "--journal file has as delivered (implies --stream)")
+
+    parser.add_argument('--stats', action='store_true',
+                        help="time the rendering, MIME building, serialization and\n"
+                             "SMTP phases, and print a breakdown at the end")
+    parser.add_argument('--stats_interval', type=float,
+                        help="also print a stats line every that many seconds\n"
+                             "(implies --stats)")
 
     args = vars(parser.parse_args())
 
@@ -88,30 +137,110 @@ def work():
     host = args['host']
     port = args['port']
     username = args['username']
+    concurrency = args['concurrency']
     sendermailid = args['sendermailid'] or (username + '@' + host)
 
+    # send/preview?
+    smart_send = args['smart_send']
+    preview_dir = args['preview']
+    streaming = args['stream']
+    journal_file = args['journal']
+
+    # receivers already sent to, for --resume
+    exclude = None
+    if args['resume']:
+        if not journal_file:
+            raise Exception("--resume needs the --journal of the campaign.")
+        exclude = read_delivered(journal_file)
+        streaming = True
+
     # read the password if it's not a preview
     if not preview_dir:
         password = getpass.getpass(prompt="Password for %s@%s: " % (username, host))
 
-    # send/preview?
-    smart_send = args['smart_send']
-    preview_dir = args['preview']
+    if args['fast_serialize']:
+        envelopes.Envelope.fast_serialize = True
 
-    # Choosing Smart Send or Hard Send
-    if smart_send:
-        smart_send = os.path.abspath(smart_send)
-        campaign_object = CampaignFactory(sendermailid, *smart_send_fun(smart_send))
-    else:
-        campaign_object = CampaignFactory(sendermailid, *hard_send(args))
+    stop_stats = None
+    if args['stats'] or args['stats_interval']:
+        envelopes.stats.enable()
+        if args['stats_interval']:
+            stop_stats = print_stats_every(args['stats_interval'])
 
-    # Choosing Preview or Sending the Mail
-    if preview_dir:
-        preview_dir = os.path.abspath(preview_dir)
-        campaign_object.preview(preview_dir)
-    else:
-        conn = envelopes.conn.SMTP(host, port, username, password)
-        campaign_object.send(conn)
+    try:
+        # Choosing Smart Send or Hard Send
+        if smart_send:
+            smart_send = os.path.abspath(smart_send)
+            campaign_args = smart_send_fun(smart_send)
+        else:
+            campaign_args = hard_send(args)
+
+        campaign_object = CampaignFactory(sendermailid, *campaign_args, streaming=streaming,
+                                          processes=args['processes'],
+                                          batch_size=args['batch_size'], exclude=exclude,
+                                          dedup=args['dedup'],
+                                          personal_to=args['personal_to'])
+
+        # Choosing Preview or Sending the Mail
+        if preview_dir:
+            preview_dir = os.path.abspath(preview_dir)
+            if args['preview_format'] == 'html':
+                campaign_object.preview(preview_dir)
+            else:
+                campaign_object.preview_mailbox(preview_dir, args['preview_format'])
+        else:
+            # shared by all the connections
+            rate_limit = None
+            if args['rate'] == 'auto':
+                if args['hourly_rate']:
+                    raise Exception("--rate auto can't be used with --hourly_rate.")
+                rate_limit = 'auto'
+            elif args['rate'] or args['hourly_rate']:
+                rate_limit = envelopes.RateLimiter(args['rate'], args['hourly_rate'])
+
+            if concurrency > 1:
+                conn = envelopes.SMTPPool(concurrency, host, port, username, password,
+                                          rate_limit=rate_limit)
+            else:
+                conn = envelopes.conn.SMTP(host, port, username, password,
+                                           rate_limit=rate_limit)
+
+            if journal_file:
+                with SendJournal(journal_file) as journal:
+                    campaign_object.send(conn, concurrency, journal)
+            else:
+                campaign_object.send(conn, concurrency)
+    finally:
+        if stop_stats is not None:
+            stop_stats.set()
+        if envelopes.stats.enabled:
+            print(envelopes.stats.report())
+
+
+def rate(value):
+    '''
+    argparse type of --rate: a number of mails per second, or 'auto'.
+    '''
+    if value == 'auto':
+        return value
+    return float(value)
+
+
+def print_stats_every(interval):
+    '''
+    Print envelopes.stats.status_line() every `interval` seconds, from a
+    background thread, until the returned event is set.
+    '''
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            sys.stderr.write(envelopes.stats.status_line() + "\n")
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return stop
 
 
 def smart_send_fun(smart_send):
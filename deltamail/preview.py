@@ -0,0 +1,128 @@
+'''Writes previews of the mails of a campaign into a mailbox
+
+Campaign.preview writes the html body of each mail to a file of its own.
+Campaign.preview_mailbox instead writes the whole messages, with their
+headers and attachments, into a single mbox file or a Maildir, using the
+writers defined here. Either can be opened in a mail client.
+
+Each message gets an X-Envelope-To header listing the addresses it is
+sent to, as BCC receivers don't appear anywhere else in it.
+'''
+from email.utils import parseaddr
+import os
+import re
+import socket
+import time
+
+MBOX = "mbox"
+MAILDIR = "maildir"
+
+# Size of the write buffer of mbox files
+BUFFER_SIZE = 1024 * 1024
+
+# mboxrd: lines starting with "From ", after any number of ">", get
+# one more ">"
+_FROM_RE = re.compile(br'^(>*From )', re.M)
+
+
+def _message_bytes(mail):
+    '''The message of an envelope, as bytes with LF line endings'''
+    from_addr, to_addrs, message = mail.sendmail_args()
+    if hasattr(message, "tobytes"):
+        # spliced onto a skeleton, see envelopes.serializer
+        message = message.tobytes()
+    elif not isinstance(message, bytes):
+        message = message.encode("utf-8")
+
+    header = "X-Envelope-To: %s\n" % ", ".join(to_addrs)
+    message = header.encode("utf-8") + message.replace(b"\r\n", b"\n")
+    if not message.endswith(b"\n"):
+        message += b"\n"
+    return from_addr, message
+
+
+class MboxWriter(object):
+    '''
+    Appends messages to an mbox file (mboxrd flavour).
+
+    The file is written through a large buffer, and only flushed when
+    the writer is closed.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "ab", BUFFER_SIZE)
+        self._date = time.asctime(time.gmtime())
+
+    def add(self, mail):
+        '''Append the message of the envelope `mail`.'''
+        from_addr, message = _message_bytes(mail)
+        # the separator takes the bare address, without a display name
+        from_line = "From %s %s\n" % (parseaddr(from_addr)[1] or "MAILER-DAEMON",
+                                      self._date)
+
+        self._file.write(from_line.encode("utf-8"))
+        self._file.write(_FROM_RE.sub(br'>\1', message))
+        self._file.write(b"\n")
+
+    def close(self):
+        self._file.close()
+
+
+class MaildirWriter(object):
+    '''
+    Delivers messages into a Maildir, creating it if needed.
+
+    Each message is written to tmp/ in one go and then moved to new/,
+    as the Maildir format requires.
+    '''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        for subdir in ("tmp", "new", "cur"):
+            path = os.path.join(dirname, subdir)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+        self._prefix = "%d.P%d" % (time.time(), os.getpid())
+        self._host = socket.gethostname().replace("/", "\\057").replace(":", "\\072")
+        self._count = 0
+
+    def add(self, mail):
+        '''Deliver the message of the envelope `mail`.'''
+        _, message = _message_bytes(mail)
+
+        self._count += 1
+        name = "%sQ%d.%s" % (self._prefix, self._count, self._host)
+        tmp_path = os.path.join(self.dirname, "tmp", name)
+
+        fmsg = open(tmp_path, "wb")
+        fmsg.write(message)
+        fmsg.close()
+        os.rename(tmp_path, os.path.join(self.dirname, "new", name))
+
+    def close(self):
+        pass
+
+
+def open_mailbox(location, mailbox_format=MBOX):
+    '''
+    Open a mailbox to write previews into.
+
+    Args:
+        location (str): The mbox file (appended to if it exists) or the
+            Maildir directory (created if it doesn't exist).
+        mailbox_format (Optional[str]): MBOX or MAILDIR. Defaults to MBOX.
+
+    Returns:
+        MboxWriter or MaildirWriter
+
+    Raises:
+        Exception: If the format is unknown.
+    '''
+    if mailbox_format == MBOX:
+        return MboxWriter(location)
+    if mailbox_format == MAILDIR:
+        return MaildirWriter(location)
+    raise Exception("Unknown mailbox format `%s`. Use `%s` or `%s`."
+                    % (mailbox_format, MBOX, MAILDIR))
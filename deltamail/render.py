@@ -0,0 +1,118 @@
+'''Renders personalised mails on several processes
+
+Rendering the templates and building the MIME messages is CPU-bound, so
+for large TransactionMailCampaigns it can be spread over a pool of
+processes with the render_parallel function.
+'''
+from collections import deque
+import multiprocessing
+
+from deltamail import envelopes_mod as envelopes
+from deltamail.mail import MailFactory
+
+# Number of rows handed to a worker process at a time
+DEFAULT_CHUNK_SIZE = 100
+
+# Set in each worker process by _init_worker
+_worker_args = None
+
+
+def _init_worker(from_addr, subject, template_str, global_vars, fast_serialize):
+    '''
+    Initialise a worker process.
+
+    Called once per worker. The compiled templates are pickled as their
+    source, so unpickling them here compiles them once per worker. Each
+    worker also has its own attachment cache, and serializes the mails
+    the way the parent process would (Envelope.fast_serialize).
+    '''
+    global _worker_args
+    envelopes.Envelope.fast_serialize = fast_serialize
+    _worker_args = (from_addr, subject, template_str, global_vars,
+                    envelopes.AttachmentCache())
+
+
+def _render_chunk(rows):
+    '''
+    Render a chunk of rows in a worker process.
+
+    Args:
+        rows (list): (email, variables) tuples.
+
+    Returns:
+        list: The envelopes.SerializedEnvelope of each row, in order.
+    '''
+    from_addr, subject, template_str, global_vars, attachment_cache = _worker_args
+
+    serialized = []
+    for email, personal_vars in rows:
+        variables = dict(global_vars)
+        variables.update(personal_vars)
+
+        envl = MailFactory(from_addr, subject, [email], template_str, variables,
+                           attachment_cache=attachment_cache)
+        serialized.append(envelopes.SerializedEnvelope(envl))
+
+    return serialized
+
+
+def _chunks(mailing_list, chunk_size):
+    chunk = []
+    for receiver in mailing_list:
+        chunk.append((receiver["email"], receiver["variables"]))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def render_parallel(from_addr, subject, mailing_list, template_str, global_vars,
+                    processes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Render the mails of a TransactionMailCampaign on a pool of processes.
+
+    The rows are read from the mailing list and handed to the processes
+    in chunks of `chunk_size` rows. At most two chunks per process are
+    being rendered or waiting to be picked up at any time, so memory use
+    doesn't grow with the size of the mailing list.
+
+    Args:
+        from_addr (str): The "From" address for the mails.
+        subject (CompiledTemplate): The subject template.
+        mailing_list (iterable): The {"email","variables"} dicts of the
+            receivers.
+        template_str (CompiledTemplate): The body template.
+        global_vars (dict): The dictionary of global variables. Personal
+            variables override them.
+        processes (Optional[int]): Number of worker processes. Defaults
+            to the number of CPUs.
+        chunk_size (Optional[int]): Number of rows per chunk.
+
+    Yields:
+        envelopes.SerializedEnvelope: The mail for each receiver, in the
+            order of the mailing list.
+    '''
+    processes = processes or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(processes, _init_worker,
+                                (from_addr, subject, template_str, global_vars,
+                                 envelopes.Envelope.fast_serialize))
+
+    try:
+        pending = deque()
+        for chunk in _chunks(mailing_list, chunk_size):
+            pending.append(pool.apply_async(_render_chunk, (chunk,)))
+
+            if len(pending) >= 2 * processes:
+                for envl in pending.popleft().get():
+                    yield envl
+
+        while pending:
+            for envl in pending.popleft().get():
+                yield envl
+
+        pool.close()
+    finally:
+        # also stops the workers if the mails weren't all used
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,74 @@
+'''Sends the mails of a campaign from several threads at once
+
+Use the send_parallel function along with an envelopes.SMTPPool, so that
+each of the threads has an SMTP connection of its own.
+'''
+import sys
+import threading
+
+try:
+    from queue import Queue
+except ImportError:  # Python 2
+    from Queue import Queue
+
+# Put in the queue to tell a worker thread to stop
+_STOP = object()
+
+
+def send_parallel(mails, smtp_conn, workers):
+    '''
+    Send the mails using `workers` threads.
+
+    The mails are handed to the threads through a small queue, so only a
+    few of them are waiting to be sent at any time, and each is dropped
+    as soon as it is sent. That keeps streaming campaigns streaming.
+
+    If sending a mail fails, no more mails are handed to the threads, the
+    ones already handed to them are dropped and the first error is raised
+    once all the threads have stopped.
+
+    Args:
+        mails (iterable): The envelopes.Envelope objects to be sent.
+        smtp_conn (envelopes.SMTPPool): Used to do the actual sending. Its
+            send() method is called from all the threads at once, so it
+            must be thread-safe. The pool should have at least `workers`
+            connections, otherwise some threads just wait for the others.
+        workers (int): Number of threads to send the mails from.
+
+    Returns:
+        None
+    '''
+    queue = Queue(maxsize=workers * 2)
+    errors = []
+
+    def work():
+        while True:
+            mail = queue.get()
+            if mail is _STOP:
+                return
+            if errors:
+                continue
+
+            try:
+                smtp_conn.send(mail)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for mail in mails:
+            if errors:
+                break
+            queue.put(mail)
+    finally:
+        for thread in threads:
+            queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
@@ -0,0 +1,282 @@
+"""In-process asyncio SMTP server that accepts and records every message
+
+Used by the tests to send mails without any network. Requires Python 3.7
+or later.
+
+    sink = SMTPSink()
+    loop.run_until_complete(sink.start())
+    ... send to 127.0.0.1:sink.port ...
+    loop.run_until_complete(sink.stop())
+    sink.messages  # [(mail_from, [rcpt_to, ...], data), ...]
+    sink.commands  # every command line received
+    sink.reads     # every chunk of data received, as read from the socket
+
+SMTPSinkThread runs a sink on its own loop in a background thread, for
+blocking clients such as smtplib.
+
+Recipients starting with "reject" are refused with a 550.
+
+The benchmarks run it as a script, which serves on 127.0.0.1 until
+killed. It prints the port it listens on, then one line with the message
+count when stopped:
+
+    python tests/smtpsink.py [--port PORT]
+"""
+import argparse
+import asyncio
+import base64
+import sys
+import threading
+
+
+class SMTPSink(object):
+    """The server. Keyword arguments:
+
+    extensions: extra EHLO keywords to advertise (e.g. ["PIPELINING"])
+    login/password: if given, AUTH PLAIN and AUTH LOGIN are advertised
+        and checked against these
+    ssl_context: if given, STARTTLS is advertised and uses this server
+        side ssl.SSLContext
+    close_after: close each connection after that many messages
+    record: if False, the messages, commands and reads aren't kept, only
+        counted in .received
+    """
+
+    def __init__(self, extensions=(), login=None, password=None,
+                 ssl_context=None, close_after=None, record=True):
+        self.extensions = list(extensions)
+        self.login = login
+        self.password = password
+        self.ssl_context = ssl_context
+        self.close_after = close_after
+        self.record = record
+
+        self.messages = []
+        self.commands = []
+        self.reads = []
+        self.received = 0
+        self.connections = 0
+        self.port = None
+
+        self._server = None
+        self._protocols = set()
+
+    async def start(self, host="127.0.0.1", port=0):
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(
+            lambda: _SinkProtocol(self), host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        for protocol in list(self._protocols):
+            if protocol.transport is not None:
+                protocol.transport.close()
+        await self._server.wait_closed()
+
+
+class SMTPSinkThread(object):
+    """An SMTPSink served from a background thread. Takes the same
+    keyword arguments; the sink is the .sink attribute."""
+
+    def __init__(self, **options):
+        self.sink = SMTPSink(**options)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self.sink.start(), self._loop).result()
+        return self.sink
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.sink.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+
+def _address(arg):
+    # "FROM:<addr> SIZE=123" -> "addr"
+    path = arg.split(b":", 1)[1].strip().split(b" ")[0]
+    return path.strip(b"<>").decode("utf-8")
+
+
+class _SinkProtocol(asyncio.Protocol):
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.transport = None
+        self.buffer = b""
+        self.in_data = False
+        self.auth_login = None
+        self.tls = False
+        self.upgrading = False
+        self.count = 0
+        self._reset()
+
+    def _reset(self):
+        self.mail_from = None
+        self.rcpt_to = []
+        self.data = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.sink.connections += 1
+        self.sink._protocols.add(self)
+        self.reply(b"220 sink ESMTP")
+
+    def connection_lost(self, exc):
+        self.sink._protocols.discard(self)
+
+    def reply(self, line):
+        self.transport.write(line + b"\r\n")
+
+    def data_received(self, data):
+        if self.sink.record:
+            self.sink.reads.append(data)
+        self.buffer += data
+        self.process()
+
+    def process(self):
+        while (b"\r\n" in self.buffer and self.transport is not None and
+               not self.upgrading):
+            line, self.buffer = self.buffer.split(b"\r\n", 1)
+            if self.in_data:
+                self.data_line(line)
+            else:
+                self.command(line)
+
+    def data_line(self, line):
+        if line != b".":
+            if line.startswith(b".."):
+                line = line[1:]
+            self.data.append(line)
+            return
+
+        self.in_data = False
+        self.sink.received += 1
+        if self.sink.record:
+            self.sink.messages.append(
+                (self.mail_from, self.rcpt_to, b"\r\n".join(self.data) + b"\r\n"))
+        self._reset()
+        self.reply(b"250 OK queued")
+
+        self.count += 1
+        if self.sink.close_after and self.count >= self.sink.close_after:
+            self.transport.close()
+            self.transport = None
+
+    def command(self, line):
+        if self.sink.record:
+            self.sink.commands.append(line)
+
+        if self.auth_login is not None:
+            return self.auth_login_step(line)
+
+        verb, _, arg = line.partition(b" ")
+        verb = verb.upper()
+
+        if verb == b"EHLO":
+            lines = [b"sink"] + [e.encode("ascii") for e in self.sink.extensions]
+            if self.sink.login is not None:
+                lines.append(b"AUTH PLAIN LOGIN")
+            if self.sink.ssl_context is not None and not self.tls:
+                lines.append(b"STARTTLS")
+            for ext in lines[:-1]:
+                self.reply(b"250-" + ext)
+            self.reply(b"250 " + lines[-1])
+        elif verb == b"HELO":
+            self.reply(b"250 sink")
+        elif verb == b"STARTTLS":
+            self.reply(b"220 Ready to start TLS")
+            self.upgrading = True
+            asyncio.ensure_future(self.starttls())
+        elif verb == b"AUTH":
+            self.auth(arg)
+        elif verb == b"MAIL":
+            self.mail_from = _address(arg)
+            self.reply(b"250 OK")
+        elif verb == b"RCPT":
+            addr = _address(arg)
+            if addr.startswith("reject"):
+                self.reply(b"550 No such user")
+            else:
+                self.rcpt_to.append(addr)
+                self.reply(b"250 OK")
+        elif verb == b"DATA":
+            if not self.rcpt_to:
+                self.reply(b"503 No valid recipients")
+            else:
+                self.in_data = True
+                self.reply(b"354 End data with <CR><LF>.<CR><LF>")
+        elif verb == b"RSET":
+            self._reset()
+            self.reply(b"250 OK")
+        elif verb == b"NOOP":
+            self.reply(b"250 OK")
+        elif verb == b"QUIT":
+            self.reply(b"221 Bye")
+            self.transport.close()
+            self.transport = None
+        else:
+            self.reply(b"500 Unknown command")
+
+    async def starttls(self):
+        loop = asyncio.get_running_loop()
+        self.transport = await loop.start_tls(
+            self.transport, self, self.sink.ssl_context, server_side=True)
+        self.tls = True
+        # commands that came in during the handshake wait in the buffer
+        self.upgrading = False
+        self.process()
+
+    def auth(self, arg):
+        mech, _, token = arg.partition(b" ")
+        if mech.upper() == b"PLAIN":
+            parts = base64.b64decode(token).split(b"\0")
+            self.auth_result(parts[1], parts[2])
+        elif mech.upper() == b"LOGIN":
+            self.auth_login = []
+            self.reply(b"334 VXNlcm5hbWU6")
+        else:
+            self.reply(b"504 Unrecognized authentication type")
+
+    def auth_login_step(self, line):
+        self.auth_login.append(base64.b64decode(line))
+        if len(self.auth_login) == 1:
+            self.reply(b"334 UGFzc3dvcmQ6")
+        else:
+            login, password = self.auth_login
+            self.auth_login = None
+            self.auth_result(login, password)
+
+    def auth_result(self, login, password):
+        if (login.decode("utf-8") == self.sink.login and
+                password.decode("utf-8") == self.sink.password):
+            self.reply(b"235 Authentication successful")
+        else:
+            self.reply(b"535 Authentication failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SMTP sink for the benchmarks")
+    parser.add_argument('--port', type=int, default=0,
+                        help="port to listen on. Defaults to a free one")
+    args = parser.parse_args()
+
+    sink = SMTPSink(extensions=["PIPELINING", "8BITMIME"], record=False)
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(sink.start(port=args.port))
+    print(sink.port)
+    sys.stdout.flush()
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    print(sink.received)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""Code to test the asyncio transport (deltamail.envelopes_mod.aio) and
+Campaign.send_async, against the in-process SMTP sink in tests/smtpsink.py.
+
+These tests need Python 3.7 or later, and are skipped otherwise.
+"""
+import os
+import shutil
+import smtplib
+import ssl
+import subprocess
+import sys
+import tempfile
+import unittest
+
+if sys.version_info >= (3, 7):
+    import asyncio
+    from deltamail.envelopes_mod.aio import AsyncSMTP, AsyncSMTPPool
+    from tests.smtpsink import SMTPSink
+else:
+    asyncio = None
+
+from deltamail import envelopes_mod as envelopes
+from deltamail.campaign import TransactionMailCampaign
+
+
+def _envelope(to_addr="job@bob.com", body="Hello Job"):
+    return envelopes.Envelope(from_addr="sender@example.com", to_addr=to_addr,
+                              subject="Greetings", html_body=body)
+
+
+class TestAsyncSMTP(object):
+    """Class to test the envelopes_mod.aio.AsyncSMTP class"""
+
+    def _start(self, **options):
+        if asyncio is None:
+            raise unittest.SkipTest("asyncio transport needs Python 3.7+")
+        loop = asyncio.new_event_loop()
+        sink = SMTPSink(**options)
+        loop.run_until_complete(sink.start())
+        return loop, sink
+
+    def _stop(self, loop, sink, *conns):
+        for conn in conns:
+            loop.run_until_complete(conn.quit())
+        loop.run_until_complete(sink.stop())
+        loop.close()
+
+    def test_send(self):
+        """Test EHLO, MAIL/RCPT/DATA, dot-stuffing and refused recipients"""
+        loop, sink = self._start(extensions=["8BITMIME"])
+        conn = AsyncSMTP("127.0.0.1", sink.port)
+        try:
+            refused = loop.run_until_complete(conn.send(
+                _envelope(["job@bob.com", "reject@bob.com"], "Hi\n.\n..dots")))
+
+            assert "8bitmime" in conn.esmtp_features
+            assert list(refused.keys()) == ["reject@bob.com"]
+            assert refused["reject@bob.com"][0] == 550
+
+            mail_from, rcpt_to, data = sink.messages[0]
+            assert mail_from == "sender@example.com"
+            assert rcpt_to == ["job@bob.com"]
+            assert b"Subject: Greetings" in data
+
+            # the body is base64 encoded, so check dot-stuffing directly
+            loop.run_until_complete(conn.sendmail(
+                "sender@example.com", ["job@bob.com"], "Subject: x\n\n.\n..a\n"))
+            assert sink.messages[1][2].endswith(b"\r\n.\r\n..a\r\n")
+        finally:
+            self._stop(loop, sink, conn)
+
+    def test_smtputf8_only(self):
+        """Test that 8bit text is only sent as it is with 8BITMIME"""
+        loop, sink = self._start(extensions=["SMTPUTF8"])
+        conn = AsyncSMTP("127.0.0.1", sink.port)
+        try:
+            # the first send connects, the second knows the extensions
+            for _ in range(2):
+                loop.run_until_complete(conn.send(_envelope(body=u"H\xe9llo")))
+            assert "smtputf8" in conn.esmtp_features
+
+            data = sink.messages[1][2]
+            assert b"H\xc3\xa9llo" not in data
+            assert b"Content-Transfer-Encoding: 8bit" not in data
+            assert not [c for c in sink.commands if b"BODY=8BITMIME" in c]
+        finally:
+            self._stop(loop, sink, conn)
+
+    def test_all_refused(self):
+        """Test that a mail with no accepted recipients raises"""
+        loop, sink = self._start()
+        conn = AsyncSMTP("127.0.0.1", sink.port)
+        try:
+            try:
+                loop.run_until_complete(conn.send(_envelope("reject@bob.com")))
+            except smtplib.SMTPRecipientsRefused:
+                pass
+            else:
+                assert False, "SMTPRecipientsRefused not raised"
+            assert sink.messages == []
+        finally:
+            self._stop(loop, sink, conn)
+
+    def test_pipelining(self):
+        """Test that MAIL/RCPT/DATA are sent in one write with PIPELINING"""
+        loop, sink = self._start(extensions=["PIPELINING"])
+        conn = AsyncSMTP("127.0.0.1", sink.port)
+        try:
+            refused = loop.run_until_complete(conn.send(
+                _envelope(["job@bob.com", "reject@bob.com"])))
+            assert list(refused.keys()) == ["reject@bob.com"]
+            assert sink.messages[0][1] == ["job@bob.com"]
+            assert (b"MAIL FROM:<sender@example.com>\r\nRCPT TO:<job@bob.com>\r\n"
+                    b"RCPT TO:<reject@bob.com>\r\nDATA\r\n") in sink.reads
+
+            try:
+                loop.run_until_complete(conn.send(_envelope("reject@bob.com")))
+            except smtplib.SMTPRecipientsRefused:
+                pass
+            else:
+                assert False, "SMTPRecipientsRefused not raised"
+
+            # the connection is still usable
+            loop.run_until_complete(conn.send(_envelope()))
+            assert len(sink.messages) == 2
+        finally:
+            self._stop(loop, sink, conn)
+
+    def test_auth(self):
+        """Test AUTH, with good and bad credentials"""
+        loop, sink = self._start(login="user", password="secret")
+        good = AsyncSMTP("127.0.0.1", sink.port, login="user", password="secret")
+        bad = AsyncSMTP("127.0.0.1", sink.port, login="user", password="wrong")
+        try:
+            loop.run_until_complete(good.send(_envelope()))
+            assert len(sink.messages) == 1
+            assert any(c.startswith(b"AUTH PLAIN") for c in sink.commands)
+
+            try:
+                loop.run_until_complete(bad.send(_envelope()))
+            except smtplib.SMTPAuthenticationError:
+                pass
+            else:
+                assert False, "SMTPAuthenticationError not raised"
+        finally:
+            self._stop(loop, sink, good, bad)
+
+    def test_keepalive(self):
+        """Test that the connection is reused, and reopened when it dies"""
+        loop, sink = self._start(close_after=2)
+        conn = AsyncSMTP("127.0.0.1", sink.port)
+        try:
+            for i in range(5):
+                loop.run_until_complete(conn.send(_envelope()))
+            assert len(sink.messages) == 5
+            assert sink.connections == 3
+        finally:
+            self._stop(loop, sink, conn)
+
+    def test_starttls(self):
+        """Test STARTTLS with a self-signed certificate"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            certfile = os.path.join(tmpdir, "cert.pem")
+            keyfile = os.path.join(tmpdir, "key.pem")
+            try:
+                subprocess.check_call(
+                    ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+                     "-days", "1", "-subj", "/CN=localhost",
+                     "-keyout", keyfile, "-out", certfile],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            except (OSError, subprocess.CalledProcessError):
+                raise unittest.SkipTest("openssl is needed to make a certificate")
+
+            if asyncio is None:
+                raise unittest.SkipTest("asyncio transport needs Python 3.7+")
+
+            server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            server_context.load_cert_chain(certfile, keyfile)
+
+            class TrustingSMTP(AsyncSMTP):
+                def _ssl_context(self):
+                    return ssl.create_default_context(cafile=certfile)
+
+            loop, sink = self._start(ssl_context=server_context,
+                                     login="user", password="secret")
+            conn = TrustingSMTP("localhost", sink.port, login="user",
+                                password="secret", tls=True)
+            try:
+                loop.run_until_complete(conn.send(_envelope()))
+                assert len(sink.messages) == 1
+                assert b"STARTTLS" in sink.commands
+                assert "starttls" not in conn.esmtp_features
+            finally:
+                self._stop(loop, sink, conn)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestSendAsync(object):
+    """Class to test Campaign.send_async"""
+
+    def test_send_async(self):
+        """Test that a campaign is sent over a pool of connections"""
+        if asyncio is None:
+            raise unittest.SkipTest("asyncio transport needs Python 3.7+")
+
+        mailing_list = [
+            {"email": "user%d@example.com" % i, "variables": {"name": "User%d" % i}}
+            for i in range(200)
+        ]
+        tmc = TransactionMailCampaign("sender@example.com", "Hey {{name}}",
+                                      mailing_list, "Hello {{name}}", {},
+                                      streaming=True)
+
+        loop = asyncio.new_event_loop()
+        sink = SMTPSink()
+        loop.run_until_complete(sink.start())
+        pool = AsyncSMTPPool(20, "127.0.0.1", sink.port)
+        try:
+            loop.run_until_complete(tmc.send_async(pool, 20))
+
+            assert sink.connections == 20
+            receivers = sorted(rcpt[0] for _, rcpt, _ in sink.messages)
+            assert receivers == sorted(row["email"] for row in mailing_list)
+        finally:
+            loop.run_until_complete(pool.quit())
+            loop.run_until_complete(sink.stop())
+            loop.close()
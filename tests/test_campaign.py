@@ -32,8 +32,9 @@ except:
 
 from deltamail.campaign import BulkMailCampaign, TransactionMailCampaign
 from deltamail.campaign import CampaignFactory
-from deltamail.campaign import MAX_PREVIEW_FILE_LEN
+from deltamail.campaign import DEDUP_GROUP_SIZE, MAX_PREVIEW_FILE_LEN
 from deltamail.mail import MailFactory
+from deltamail.mailinglist import MailingList
 
 
 class TestBulkMailCampaign(object):
@@ -50,8 +51,14 @@ class TestBulkMailCampaign(object):
     subject_evaled = "BulkMail : Greetings from Festember"
     body_evaled = "Hello Human, greetings from Festember.\nCopyright @ 2015"
 
+    def setup_method(self, method=None):
+        self._create_campaign()
+
+    # nose looks for this name, pytest for the one above
+    setup = setup_method
+
     @patch('deltamail.campaign.MailFactory', autospec=True)
-    def __init__(self, mock_mf):
+    def _create_campaign(self, mock_mf):
         """Create an instance of BulkMailCampaign for testing.
         Also test if it is initialized correctly."""
         self.bmc = BulkMailCampaign(**self.args)
@@ -62,7 +69,15 @@ class TestBulkMailCampaign(object):
         # Rename it. Laziness
         self.args["variables"] = self.args["global_vars"]
         self.args.pop("global_vars", None)
-        mock_mf.assert_called_once_with(**self.args)
+
+        # The subject and the body are handed over as compiled templates
+        assert mock_mf.call_count == 1
+        from_addr, subject, mailing_list, template, variables = mock_mf.call_args[0]
+        assert from_addr == self.args["from_addr"]
+        assert mailing_list == self.args["mailing_list"]
+        assert variables == self.args["variables"]
+        assert subject.render(**variables) == self.subject_evaled
+        assert template.render(**variables) == self.body_evaled
 
         # acquire the actual Envelope object
         self.bmc._mails = [MailFactory(**self.args)]
@@ -188,8 +203,14 @@ class TestTransactionMailCampaign(object):
         }
     ]
 
+    def setup_method(self, method=None):
+        self._create_campaign()
+
+    # nose looks for this name, pytest for the one above
+    setup = setup_method
+
     @patch('deltamail.campaign.MailFactory', autospec=True)
-    def __init__(self, mock_mf):
+    def _create_campaign(self, mock_mf):
         """Create an instance of TransactionMailCampaign for testing.
         Also test if it is initialized correctly."""
 
@@ -203,18 +224,25 @@ class TestTransactionMailCampaign(object):
 
         self.args.pop("global_vars", None)
 
-        self.args["variables"] = self.variables[0]
-        self.args["mailing_list"] = [mailing_list[0]["email"]]
-        # acquire the actual Envelope object
-        self.tmc._mails[0] = MailFactory(**self.args)
-
-        mock_mf.assert_any_call(**self.args)
-
-        self.args["variables"] = self.variables[1]
-        self.args["mailing_list"] = [mailing_list[1]["email"]]
-        # acquire the actual Envelope object
-        self.tmc._mails[1] = MailFactory(**self.args)
-        mock_mf.assert_any_call(**self.args)
+        # The subject and the body are compiled once and the same
+        # compiled templates are handed over for every receiver
+        assert mock_mf.call_count == 2
+        calls = [call[0] for call in mock_mf.call_args_list]
+        assert calls[0][1] is calls[1][1]
+        assert calls[0][3] is calls[1][3]
+
+        for i in range(len(calls)):
+            from_addr, subject, receivers, template, variables = calls[i]
+            assert from_addr == self.args["from_addr"]
+            assert receivers == [mailing_list[i]["email"]]
+            assert variables == self.variables[i]
+            assert subject.render(**variables) == self.evaled[i]["subject"]
+            assert template.render(**variables) == self.evaled[i]["body"]
+
+            self.args["variables"] = self.variables[i]
+            self.args["mailing_list"] = [mailing_list[i]["email"]]
+            # acquire the actual Envelope object
+            self.tmc._mails[i] = MailFactory(**self.args)
         
         # Undo the changes
         self.args["mailing_list"] = mailing_list
@@ -291,12 +319,274 @@ class TestTransactionMailCampaign(object):
         mock_mailer.send.assert_any_call(self.tmc._mails[0])
         assert mock_mailer.send.call_count == 2
 
+    def test_send_concurrency(self):
+        """Test the TransactionMailCampaign.send() method with concurrency"""
+        mock_mailer = Mock(spec=['send'])
+        self.tmc.send(mock_mailer, concurrency=2)
+        mock_mailer.send.assert_any_call(self.tmc._mails[0])
+        mock_mailer.send.assert_any_call(self.tmc._mails[1])
+        assert mock_mailer.send.call_count == 2
+
     def test_preview_in_browser(self):
         """Test the preview_in_browser() method"""
         # UNTESTED!
         pass
 
 
+class TestStreamingCampaign(object):
+    """Class to test streaming TransactionMailCampaign objects"""
+
+    args = TestTransactionMailCampaign.args
+
+    @patch('deltamail.campaign.MailFactory', autospec=True)
+    def test_no_mails_created_upfront(self, mock_mf):
+        """Test that a streaming campaign doesn't create mails in __init__"""
+        tmc = TransactionMailCampaign(streaming=True, **self.args)
+        assert tmc._mails is None
+        assert mock_mf.call_count == 0
+
+    @patch('deltamail.campaign.MailFactory', autospec=True)
+    def test_send(self, mock_mf):
+        """Test that each mail is created just before it is sent"""
+        tmc = TransactionMailCampaign(streaming=True, **self.args)
+
+        created_before_send = []
+        mock_mailer = Mock(spec=['send'])
+        mock_mailer.send.side_effect = \
+            lambda mail: created_before_send.append(mock_mf.call_count)
+
+        tmc.send(mock_mailer)
+
+        assert created_before_send == [1, 2]
+        assert tmc._mails is None
+
+        # The mails are generated again for every run
+        tmc.send(mock_mailer)
+        assert mock_mf.call_count == 4
+
+    @patch('deltamail.campaign.os.path.isdir', autospec=True)
+    @patch('deltamail.campaign.open')
+    @patch('deltamail.campaign.MailFactory', autospec=True)
+    def test_preview_count(self, mock_mf, mk_open, mock_isdir):
+        """Test that previewing stops creating mails after preview_count"""
+        tmc = TransactionMailCampaign(streaming=True, **self.args)
+        mock_mf.return_value._subject = "Subject"
+        mock_mf.return_value._parts = [("text/html", "Body")]
+        mock_mf.return_value.to_addr = ["job@bob.com"]
+        mock_mf.return_value.cc_addr = []
+        mock_mf.return_value.bcc_addr = []
+
+        tmc.preview("./tests/preview-mails/TestStreamingCampaign/", 1)
+
+        assert mock_mf.call_count == 1
+        assert mk_open.call_count == 1
+
+
+class TestBulkBatching(object):
+    """Class to test BulkMailCampaign objects with a batch_size"""
+
+    args = {
+        "from_addr": "sender@example.com",
+        "subject": "Greetings from {{company}}",
+        "mailing_list": ["user%d@example.com" % i for i in range(7)],
+        "template_str": "Hello Human, greetings from {{company}}.",
+        "global_vars": {"company": "Festember"}
+    }
+
+    def test_batches(self):
+        """Test that the receivers are sent the same message in BCC batches"""
+        bmc = BulkMailCampaign(batch_size=3, **self.args)
+
+        mock_mailer = Mock(spec=['send'])
+        bmc.send(mock_mailer)
+
+        sent = [call[0][0].sendmail_args() for call in mock_mailer.send.call_args_list]
+        assert [to_addrs for _, to_addrs, _ in sent] == [
+            self.args["mailing_list"][0:3],
+            self.args["mailing_list"][3:6],
+            self.args["mailing_list"][6:7],
+        ]
+
+        # the message was serialized once, and doesn't name the receivers
+        message = sent[0][2]
+        assert all(msg is message for _, _, msg in sent)
+        assert "To: undisclosed-recipients:;" in message
+        assert "user0@example.com" not in message
+        assert "Bcc" not in message
+
+    def test_personal_to(self):
+        """Test that each receiver is sent the mail with them in To"""
+        bmc = BulkMailCampaign(personal_to=True, **self.args)
+
+        mock_mailer = Mock(spec=['send'])
+        bmc.send(mock_mailer)
+
+        sent = [call[0][0].sendmail_args() for call in mock_mailer.send.call_args_list]
+        assert [to_addrs for _, to_addrs, _ in sent] == [[addr] for addr in self.args["mailing_list"]]
+        for (_, to_addrs, msg) in sent:
+            message = msg.tobytes()
+            assert message.count(b"To: ") == 1
+            assert ("To: %s\r\n" % to_addrs[0]).encode("ascii") in message
+            assert b"Greetings from Festember" in message
+
+    @patch('deltamail.campaign.MailFactory', autospec=True)
+    def test_rendered_once(self, mock_mf):
+        """Test that the mail is rendered once for all the batches"""
+        mock_mf.return_value = MailFactory("sender@example.com", "Hi", [], "Hello", {})
+
+        bmc = BulkMailCampaign(batch_size=2, streaming=True, **self.args)
+        bmc.send(Mock(spec=['send']))
+
+        assert mock_mf.call_count == 1
+        assert mock_mf.call_args[0][2] == []
+
+
+class TestSharedMailCampaign(object):
+    """Class to test TransactionMailCampaign objects whose templates
+    use no personal variables"""
+
+    mailing_list = [
+        {"email": "job@bob.com", "variables": {"name": "Job"}},
+        {"email": "pop@bob.com", "variables": {"name": "Pop"}},
+        {"email": "sop@bob.com", "variables": {"name": "Sop"}},
+    ]
+
+    def _sent(self, campaign):
+        mock_mailer = Mock(spec=['send'])
+        campaign.send(mock_mailer)
+        return [call[0][0] for call in mock_mailer.send.call_args_list]
+
+    @patch('deltamail.campaign.MailFactory', autospec=True, side_effect=MailFactory)
+    def test_rendered_once(self, mock_mf):
+        """Test that the mail is rendered once for all the receivers"""
+        tmc = TransactionMailCampaign("sender@example.com", "Hi from {{company}}",
+                                      self.mailing_list, "Hello", {"company": "Festember"})
+        sent = self._sent(tmc)
+
+        assert mock_mf.call_count == 1
+        assert [mail.sendmail_args()[1] for mail in sent] == \
+            [["job@bob.com"], ["pop@bob.com"], ["sop@bob.com"]]
+        message = sent[1].sendmail_args()[2].tobytes()
+        assert b"To: pop@bob.com\r\n" in message
+        assert b"Subject: Hi from Festember\r\n" in message
+
+    @patch('deltamail.campaign.MailFactory', autospec=True, side_effect=MailFactory)
+    def test_attachments(self, mock_mf):
+        """Test that the mail is rendered once per set of attachments"""
+        mailing_list = [
+            {"email": "job@bob.com", "variables": {"$attachments": "requirements.txt"}},
+            {"email": "pop@bob.com", "variables": {"$attachments": "README.md"}},
+            {"email": "sop@bob.com", "variables": {"$attachments": "requirements.txt"}},
+        ]
+        sent = self._sent(TransactionMailCampaign("sender@example.com", "Hi", mailing_list,
+                                                  "Hello", {}))
+        assert mock_mf.call_count == 2
+        assert b"README.md" in sent[1].sendmail_args()[2].tobytes()
+        assert sent[2].sendmail_args()[2]._skeleton is sent[0].sendmail_args()[2]._skeleton
+
+    @patch('deltamail.campaign.MailFactory', autospec=True, side_effect=MailFactory)
+    def test_used_columns(self, mock_mf):
+        """Test that the personal variables the templates don't use are left out"""
+        mailing_list = [{"email": "job@bob.com", "variables": {"name": "Job", "age": "30"}}]
+        TransactionMailCampaign("sender@example.com", "Hi", mailing_list,
+                                "Hello {{name}}", {"company": "Festember"})
+
+        assert mock_mf.call_args[0][4] == {"name": "Job", "company": "Festember"}
+
+    @patch('deltamail.campaign.MailFactory', autospec=True, side_effect=MailFactory)
+    def test_mailing_list(self, mock_mf):
+        """Test a MailingList, which only the used columns are kept of"""
+        mailing_list = MailingList(["email", "name", "age"], [("job@bob.com", "Job", "30"),
+                                                              ("pop@bob.com", "Pop", "40")])
+        tmc = TransactionMailCampaign("sender@example.com", "Hi", mailing_list,
+                                      "Hello {{name}}", {})
+
+        assert [mail._parts[0][1] for mail in tmc._mails] == [u"Hello Job", u"Hello Pop"]
+        assert mock_mf.call_args[0][4] == {"name": "Pop"}
+
+
+class TestDedupCampaign(object):
+    """Class to test deduplicating TransactionMailCampaign objects"""
+
+    mailing_list = [
+        {"email": "job@bob.com", "variables": {"team": "red"}},
+        {"email": "pop@bob.com", "variables": {"team": "blue"}},
+        {"email": "sop@bob.com", "variables": {"team": "red"}},
+        {"email": "mop@bob.com", "variables": {"team": "red"}},
+        {"email": "top@bob.com", "variables": {"team": "green"}},
+    ]
+
+    def _campaign(self, **kwargs):
+        return TransactionMailCampaign("sender@example.com", "Team {{team}}",
+                                       self.mailing_list, "Go {{team}}!", {},
+                                       dedup=True, **kwargs)
+
+    def _sent(self, campaign):
+        mock_mailer = Mock(spec=['send'])
+        campaign.send(mock_mailer)
+        return [call[0][0] for call in mock_mailer.send.call_args_list]
+
+    def test_groups(self):
+        """Test that receivers of identical mails get one mail"""
+        sent = self._sent(self._campaign())
+
+        receivers = sorted(mail.sendmail_args()[1] for mail in sent)
+        assert receivers == [["job@bob.com", "sop@bob.com", "mop@bob.com"],
+                             ["pop@bob.com"], ["top@bob.com"]]
+
+        group = [mail for mail in sent if len(mail.bcc_addr) == 3][0]
+        assert "To: undisclosed-recipients:;" in group.sendmail_args()[2]
+        assert group._subject == "Team red"
+
+        # single receivers keep their own mail
+        single = [mail for mail in sent if mail.to_addr == ["pop@bob.com"]][0]
+        assert "To: pop@bob.com" in single.sendmail_args()[2]
+
+    def test_batch_size(self):
+        """Test that a group is sent as soon as it is full"""
+        sent = self._sent(self._campaign(batch_size=2))
+
+        receivers = [mail.sendmail_args()[1] for mail in sent]
+        assert receivers[0] == ["job@bob.com", "sop@bob.com"]
+        assert sorted(receivers[1:]) == [["mop@bob.com"], ["pop@bob.com"], ["top@bob.com"]]
+
+    def test_default_group_size(self):
+        """Test that groups are capped without a batch_size too"""
+        mailing_list = [{"email": "user%d@bob.com" % i, "variables": {"team": "red"}}
+                        for i in range(DEDUP_GROUP_SIZE * 2 + 5)]
+        tmc = TransactionMailCampaign("sender@example.com", "Team {{team}}",
+                                      mailing_list, "Go {{team}}!", {}, dedup=True)
+
+        sizes = [len(mail.sendmail_args()[1]) for mail in self._sent(tmc)]
+        assert sizes == [DEDUP_GROUP_SIZE, DEDUP_GROUP_SIZE, 5]
+
+    def test_attachments(self):
+        """Test that mails with different attachments aren't grouped"""
+        mailing_list = [
+            {"email": "job@bob.com", "variables": {"$attachments": "requirements.txt"}},
+            {"email": "pop@bob.com", "variables": {"$attachments": "README.md"}},
+        ]
+        tmc = TransactionMailCampaign("sender@example.com", "Hi", mailing_list,
+                                      "Hello", {}, dedup=True)
+        assert len(self._sent(tmc)) == 2
+
+    @patch('deltamail.campaign.os.path.isdir', autospec=True)
+    @patch('deltamail.campaign.open')
+    def test_preview(self, mk_open, mock_isdir):
+        """Test that each distinct mail is previewed once"""
+        self._campaign(batch_size=2).preview("./tests/preview-mails/TestDedupCampaign/")
+        assert mk_open.call_count == 3
+
+    def test_processes(self):
+        """Test that dedup can't be used with processes"""
+        try:
+            self._campaign(processes=2)
+        except Exception as e:
+            assert "deduplicated" in str(e)
+        else:
+            assert False, "Exception not raised"
+
+
 class TestCampaignFactory(object):
     """Class to test deltamail.campaign.CampaignFactory class"""
 
@@ -0,0 +1,273 @@
+"""Code to test the deltamail.envelopes_mod.conn module"""
+import errno
+import smtplib
+import socket
+import sys
+import time
+import unittest
+
+try:
+    from unittest.mock import Mock, patch
+except:
+    from mock import Mock, patch
+
+if sys.version_info >= (3, 7):
+    from tests.smtpsink import SMTPSinkThread
+else:
+    SMTPSinkThread = None
+
+from deltamail import envelopes_mod as envelopes
+from deltamail.envelopes_mod.conn import _quote_data
+
+
+class TestSMTP(object):
+    """Class to test the envelopes.conn.SMTP class"""
+
+    args = ("sender@example.com", ["job@bob.com"], "Subject: Hi\n\nHello")
+
+    @patch('deltamail.envelopes_mod.conn.smtplib.SMTP', autospec=True)
+    def test_no_noop(self, mock_smtp):
+        """Test that a busy connection isn't checked before each message"""
+        mock_smtp.return_value.has_extn.return_value = False
+        conn = envelopes.conn.SMTP("localhost", 2525)
+        for _ in range(3):
+            conn.sendmail(*self.args)
+
+        mock_smtp.assert_called_once_with("localhost", 2525)
+        assert mock_smtp.return_value.sendmail.call_count == 3
+        assert mock_smtp.return_value.noop.call_count == 0
+
+    @patch('deltamail.envelopes_mod.conn.smtplib.SMTP', autospec=True)
+    def test_reconnect(self, mock_smtp):
+        """Test that a dropped connection is reopened and the message resent"""
+        for error in (smtplib.SMTPServerDisconnected("gone"),
+                      socket.error(errno.EPIPE, "Broken pipe")):
+            mock_smtp.reset_mock()
+            mock_smtp.return_value.has_extn.return_value = False
+            mock_smtp.return_value.sendmail.side_effect = [None, error, {}]
+
+            conn = envelopes.conn.SMTP("localhost", 2525)
+            conn.sendmail(*self.args)
+            assert conn.sendmail(*self.args) == {}
+
+            assert mock_smtp.call_count == 2
+            assert mock_smtp.return_value.sendmail.call_count == 3
+
+    @patch('deltamail.envelopes_mod.conn.smtplib.SMTP', autospec=True)
+    def test_other_errors(self, mock_smtp):
+        """Test that other errors are raised without resending"""
+        refused = smtplib.SMTPRecipientsRefused({"job@bob.com": (550, "No")})
+        mock_smtp.return_value.has_extn.return_value = False
+        mock_smtp.return_value.sendmail.side_effect = refused
+
+        conn = envelopes.conn.SMTP("localhost", 2525)
+        try:
+            conn.sendmail(*self.args)
+        except smtplib.SMTPRecipientsRefused:
+            pass
+        else:
+            assert False, "SMTPRecipientsRefused not raised"
+
+        assert mock_smtp.call_count == 1
+        assert mock_smtp.return_value.sendmail.call_count == 1
+
+        # the connection is still usable after the failed first send
+        mock_smtp.return_value.sendmail.side_effect = None
+        mock_smtp.return_value.sendmail.return_value = {}
+        assert conn.sendmail(*self.args) == {}
+        assert mock_smtp.call_count == 1
+        assert mock_smtp.return_value.sendmail.call_count == 2
+
+    @patch('deltamail.envelopes_mod.conn.time.time', autospec=True)
+    @patch('deltamail.envelopes_mod.conn.smtplib.SMTP', autospec=True)
+    def test_idle(self, mock_smtp, mock_time):
+        """Test that an idle connection is checked, and reopened if dead"""
+        mock_smtp.return_value.has_extn.return_value = False
+        conn = envelopes.conn.SMTP("localhost", 2525, keepalive=30)
+
+        mock_time.return_value = 1000
+        conn.sendmail(*self.args)
+
+        mock_time.return_value = 1020
+        conn.sendmail(*self.args)
+        assert mock_smtp.return_value.noop.call_count == 0
+
+        mock_time.return_value = 1060
+        mock_smtp.return_value.noop.side_effect = smtplib.SMTPServerDisconnected()
+        conn.sendmail(*self.args)
+        assert mock_smtp.return_value.noop.call_count == 1
+        assert mock_smtp.call_count == 2
+
+
+class FakeSMTPLib(object):
+    """Fake smtplib.SMTP connection that replies from a script"""
+
+    def __init__(self, replies, extensions=("pipelining",)):
+        self.replies = list(replies)
+        self.extensions = extensions
+        self.writes = []
+        self.rsets = 0
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return name in self.extensions
+
+    def send(self, data):
+        self.writes.append(data)
+
+    def getreply(self):
+        return self.replies.pop(0)
+
+    def rset(self):
+        self.rsets += 1
+
+    def sendmail(self, *args):
+        assert False, "not pipelined"
+
+
+class TestPipelining(object):
+    """Class to test sending with PIPELINING"""
+
+    def _smtp(self, fake):
+        conn = envelopes.conn.SMTP("localhost", 2525)
+        conn._conn = fake
+        conn._last_used = time.time()
+        return conn
+
+    def test_one_write(self):
+        """Test that MAIL, RCPT and DATA are sent with a single write"""
+        fake = FakeSMTPLib([(250, b"ok"), (250, b"ok"), (251, b"ok"),
+                            (354, b"go"), (250, b"queued")])
+        conn = self._smtp(fake)
+
+        result = conn.sendmail("sender@example.com", ["job@bob.com", "boss@bob.com"],
+                               "Subject: Hi\n\n.Hello")
+        assert result == {}
+        assert fake.writes == [
+            "mail FROM:<sender@example.com>\r\n"
+            "rcpt TO:<job@bob.com>\r\n"
+            "rcpt TO:<boss@bob.com>\r\n"
+            "data\r\n",
+            b"Subject: Hi\r\n\r\n..Hello\r\n.\r\n",
+        ]
+        assert fake.replies == []
+
+    def test_refused(self):
+        """Test that refused recipients are reported like smtplib does"""
+        fake = FakeSMTPLib([(250, b"ok"), (550, b"no"), (250, b"ok"),
+                            (354, b"go"), (250, b"queued")])
+        conn = self._smtp(fake)
+        result = conn.sendmail("sender@example.com", ["job@bob.com", "boss@bob.com"],
+                               "Subject: Hi\n\nHello")
+        assert result == {"job@bob.com": (550, b"no")}
+
+        fake = FakeSMTPLib([(250, b"ok"), (550, b"no"), (554, b"no rcpts")])
+        conn = self._smtp(fake)
+        try:
+            conn.sendmail(*TestSMTP.args)
+        except smtplib.SMTPRecipientsRefused as e:
+            assert e.recipients == {"job@bob.com": (550, b"no")}
+        else:
+            assert False, "SMTPRecipientsRefused not raised"
+        assert fake.rsets == 1
+        assert len(fake.writes) == 1
+
+    def test_sender_refused(self):
+        """Test SMTPSenderRefused, after ending a DATA the server accepted"""
+        fake = FakeSMTPLib([(553, b"bad"), (503, b"no"), (354, b"go"),
+                            (554, b"empty")])
+        conn = self._smtp(fake)
+        try:
+            conn.sendmail(*TestSMTP.args)
+        except smtplib.SMTPSenderRefused as e:
+            assert e.smtp_code == 553
+        else:
+            assert False, "SMTPSenderRefused not raised"
+        assert fake.writes[1] == b".\r\n"
+        assert fake.rsets == 1
+
+    def test_not_advertised(self):
+        """Test that smtplib's sendmail is used without PIPELINING"""
+        fake = FakeSMTPLib([], extensions=())
+        fake.sendmail = Mock(return_value={})
+        self._smtp(fake).sendmail(*TestSMTP.args)
+        fake.sendmail.assert_called_once_with(*TestSMTP.args)
+
+        fake = FakeSMTPLib([])
+        fake.sendmail = Mock(return_value={})
+        conn = self._smtp(fake)
+        conn._pipelining = False
+        conn.sendmail(*TestSMTP.args)
+        fake.sendmail.assert_called_once_with(*TestSMTP.args)
+
+    def test_8bitmime(self):
+        """Test that 8bit text is sent as it is, with BODY=8BITMIME"""
+        envl = envelopes.Envelope(from_addr="sender@example.com", to_addr="job@bob.com",
+                                  subject="Hi", html_body=u"H\xe9llo")
+        fake = FakeSMTPLib([(250, b"ok"), (250, b"ok"), (354, b"go"), (250, b"queued")],
+                           extensions=("pipelining", "8bitmime"))
+        self._smtp(fake).send(envl)
+        assert fake.writes[0].startswith("mail FROM:<sender@example.com> BODY=8BITMIME\r\n")
+        assert b"Content-Transfer-Encoding: 8bit\r\n\r\nH\xc3\xa9llo\r\n" in fake.writes[1]
+
+        # without it, the text is encoded and sent as 7bit
+        fake = FakeSMTPLib([], extensions=())
+        fake.sendmail = Mock(return_value={})
+        self._smtp(fake).send(envl)
+        msg = fake.sendmail.call_args[0][2]
+        assert b"H\xc3\xa9llo" not in _quote_data(msg)
+        assert len(fake.sendmail.call_args[0]) == 3
+
+    def test_smtputf8_only(self):
+        """Test that SMTPUTF8 without 8BITMIME doesn't allow 8bit text"""
+        envl = envelopes.Envelope(from_addr="sender@example.com", to_addr="job@bob.com",
+                                  subject="Hi", html_body=u"H\xe9llo")
+        fake = FakeSMTPLib([(250, b"ok"), (250, b"ok"), (354, b"go"), (250, b"queued")],
+                           extensions=("pipelining", "smtputf8"))
+        self._smtp(fake).send(envl)
+        assert fake.writes[0].startswith("mail FROM:<sender@example.com>\r\n")
+        assert b"H\xc3\xa9llo" not in fake.writes[1]
+        assert b"Content-Transfer-Encoding: 8bit" not in fake.writes[1]
+
+    def test_sink(self):
+        """Test a pipelined send against the SMTP sink"""
+        if SMTPSinkThread is None:
+            raise unittest.SkipTest("the SMTP sink needs Python 3.7+")
+        server = SMTPSinkThread(extensions=["PIPELINING", "SIZE 1000000"])
+        sink = server.start()
+        try:
+            conn = envelopes.conn.SMTP("127.0.0.1", sink.port)
+            refused = conn.sendmail("sender@example.com",
+                                    ["job@bob.com", "reject@bob.com"],
+                                    "Subject: Hi\n\n.Hello\n")
+            conn._conn.quit()
+        finally:
+            server.stop()
+
+        assert list(refused.keys()) == ["reject@bob.com"]
+        assert sink.messages == [("sender@example.com", ["job@bob.com"],
+                                  b"Subject: Hi\r\n\r\n.Hello\r\n")]
+        assert sink.commands[1].startswith(b"mail FROM:<sender@example.com> size=")
+
+    def test_sink_spliced(self):
+        """Test sending a message spliced onto a skeleton"""
+        if SMTPSinkThread is None:
+            raise unittest.SkipTest("the SMTP sink needs Python 3.7+")
+        skeleton = envelopes.serializer.MessageSkeleton(b"Subject: Hi\r\n\r\n.Hello\r\n")
+        msg = skeleton.splice([("To", "job@bob.com")])
+
+        server = SMTPSinkThread(extensions=["PIPELINING"])
+        sink = server.start()
+        try:
+            conn = envelopes.conn.SMTP("127.0.0.1", sink.port)
+            conn.sendmail("sender@example.com", ["job@bob.com"], msg)
+            conn._pipelining = False
+            conn.sendmail("sender@example.com", ["job@bob.com"], msg)
+            conn._conn.quit()
+        finally:
+            server.stop()
+
+        expected = b"Subject: Hi\r\nTo: job@bob.com\r\n\r\n.Hello\r\n"
+        assert [message for _, _, message in sink.messages] == [expected, expected]
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""Code to test the deltamail.envelopes_mod.envelope module"""
+import os
+import pickle
+import shutil
+import tempfile
+
+from deltamail import envelopes_mod as envelopes
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class TestAttachmentCache(object):
+    """Class to test the envelopes.AttachmentCache class"""
+
+    def setup_method(self, method=None):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "brochure.pdf")
+        self._write(b"%PDF brochure")
+
+    def teardown_method(self, method=None):
+        shutil.rmtree(self.tmpdir)
+
+    # nose looks for these names, pytest for the ones above
+    setup = setup_method
+    teardown = teardown_method
+
+    def _write(self, contents, mtime=None):
+        fattch = open(self.fname, "wb")
+        fattch.write(contents)
+        fattch.close()
+        if mtime is not None:
+            os.utime(self.fname, (mtime, mtime))
+
+    def _envelope(self):
+        return envelopes.Envelope(from_addr="sender@example.com",
+                                  to_addr="job@bob.com", subject="Hi",
+                                  html_body="Hello")
+
+    def test_shared(self):
+        """Test that envelopes share the part encoded by the cache"""
+        cache = envelopes.AttachmentCache()
+        envl1 = self._envelope()
+        envl2 = self._envelope()
+        envl1.add_attachment(self.fname, cache=cache)
+        envl2.add_attachment(self.fname, cache=cache)
+
+        assert envl1._parts[1] is envl2._parts[1]
+        assert envl1._parts[1][0] == "application/pdf"
+
+        # the shared part can be put in several messages
+        for envl in (envl1, envl2):
+            attachment = envl.to_mime_message().get_payload()[1]
+            assert attachment.get_payload(decode=True) == b"%PDF brochure"
+            assert attachment.get_filename() == "brochure.pdf"
+
+    def test_same_as_uncached(self):
+        """Test that cached and uncached attachments are the same"""
+        envl1 = self._envelope()
+        envl2 = self._envelope()
+        envl1.add_attachment(self.fname, cache=envelopes.AttachmentCache())
+        envl2.add_attachment(self.fname)
+
+        assert envl1._parts[1][0] == envl2._parts[1][0]
+        assert envl1._parts[1][1].as_string() == envl2._parts[1][1].as_string()
+
+    def test_modified(self):
+        """Test that a modified file is read again"""
+        cache = envelopes.AttachmentCache()
+        self._write(b"version 1", mtime=1000000000)
+        first = cache.get(self.fname)
+
+        self._write(b"version 2", mtime=1000000000)
+        assert cache.get(self.fname) is first
+
+        self._write(b"version 2", mtime=1000000100)
+        second = cache.get(self.fname)
+        assert second is not first
+        assert second[1].get_payload(decode=True) == b"version 2"
+
+    def test_evicted(self):
+        """Test that the least recently used attachment is dropped"""
+        cache = envelopes.AttachmentCache(max_entries=2)
+        fnames = []
+        for name in ("a.pdf", "b.pdf", "c.pdf"):
+            fnames.append(os.path.join(self.tmpdir, name))
+            fattch = open(fnames[-1], "wb")
+            fattch.write(name.encode("ascii"))
+            fattch.close()
+
+        first = cache.get(fnames[0])
+        cache.get(fnames[1])
+        assert cache.get(fnames[0]) is first  # a.pdf is now the most recent
+        cache.get(fnames[2])
+
+        assert len(cache) == 2
+        assert cache.get(fnames[0]) is first
+        with patch("deltamail.envelopes_mod.envelope._attachment_part",
+                   wraps=envelopes.envelope._attachment_part) as mock_part:
+            cache.get(fnames[1])
+        assert mock_part.call_count == 1
+
+
+class TestCompactEnvelope(object):
+    """Class to test the envelopes.CompactEnvelope class"""
+
+    kwargs = {
+        "from_addr": "sender@example.com",
+        "to_addr": ["job@bob.com"],
+        "cc_addr": "cc@example.com",
+        "subject": "Hi",
+        "html_body": "<p>Hello</p>",
+        "text_body": "Hello",
+        "headers": {"Date": "Thu, 01 Jan 2015 00:00:00 +0000"},
+    }
+
+    def test_same_message(self):
+        """Test that compact envelopes make the same messages"""
+        compact = envelopes.CompactEnvelope(**self.kwargs)
+        envl = envelopes.Envelope(**self.kwargs)
+
+        assert not hasattr(compact, "__dict__") or not compact.__dict__
+        assert compact.sendmail_args()[:2] == envl.sendmail_args()[:2]
+        assert compact.to_mime_message().items() == envl.to_mime_message().items()
+        # everything but the boundaries
+        assert ([line for line in compact.as_bytes().split(b"\r\n") if b"=====" not in line] ==
+                [line for line in envl.as_bytes().split(b"\r\n") if b"=====" not in line])
+
+    def test_shared(self):
+        """Test that the sender, charset and headers are shared"""
+        kwargs = dict(self.kwargs)
+        # equal, but not the same objects
+        kwargs["from_addr"] = "".join(["sender", "@example.com"])
+        kwargs["headers"] = {"Date": "".join(["Thu, 01 Jan 2015", " 00:00:00 +0000"])}
+        envl1 = envelopes.CompactEnvelope(**self.kwargs)
+        envl2 = envelopes.CompactEnvelope(**kwargs)
+
+        assert envl1.from_addr is envl2.from_addr
+        assert envl1.charset is envl2.charset
+        assert envl1._addr_format is envl2._addr_format
+        assert envl1._headers[0][1] is envl2._headers[0][1]
+
+    def test_modify(self):
+        """Test the methods that change the addresses and headers"""
+        envl = envelopes.CompactEnvelope(**self.kwargs)
+        envl.add_to_addr("pop@bob.com")
+        envl.add_bcc_addr("bcc@example.com")
+        envl.clear_cc_addr()
+        envl.add_header("To", "undisclosed-recipients:;")
+        envl.add_header("Date", "Fri, 02 Jan 2015 00:00:00 +0000")
+
+        assert envl.to_addr == ["job@bob.com", "pop@bob.com"]
+        assert envl.cc_addr == []
+        assert envl.bcc_addr == ["bcc@example.com"]
+        assert envl.headers == {"To": "undisclosed-recipients:;",
+                                "Date": "Fri, 02 Jan 2015 00:00:00 +0000"}
+        assert "To" in envl._headers
+
+        msg = envl.to_mime_message()
+        assert msg.get_all("To") == ["job@bob.com,pop@bob.com", "undisclosed-recipients:;"]
+        assert msg.get_all("Date") == ["Fri, 02 Jan 2015 00:00:00 +0000"]
+
+        # other attributes can still be set
+        envl.content_key = "key"
+        assert envl.content_key == "key"
+
+    def test_pickle(self):
+        """Test that compact and serialized envelopes can be pickled"""
+        envl = envelopes.CompactEnvelope(**self.kwargs)
+        for protocol in (0, 2):
+            copy = pickle.loads(pickle.dumps(envl, protocol))
+            assert copy.sendmail_args()[:2] == envl.sendmail_args()[:2]
+            assert copy._headers == envl._headers
+
+
+class TestEncodingCache(object):
+    """Class to test the caching of encoded addresses and headers"""
+
+    def _envelope(self, **kwargs):
+        return envelopes.Envelope(from_addr=(u"sender@example.com", u"Zoë"),
+                                  subject=u"Héllo", html_body="Hello", **kwargs)
+
+    def test_encoded_once(self):
+        """Test that each address and header is encoded only once"""
+        envelope_module = envelopes.envelope
+        envelope_module._encoded_addrs.clear()
+        envelope_module._encoded_headers.clear()
+
+        with patch.object(envelope_module, "Header", wraps=envelope_module.Header) as header:
+            for _ in range(3):
+                envl = self._envelope(to_addr=u"Jöb <job@bob.com>")
+                envl.to_mime_message()
+                envl.sendmail_args()
+            # the sender's name, the receiver's name and the subject
+            assert header.call_count == 3
+
+    def test_same_encoding(self):
+        """Test that cached encodings are the ones made the first time"""
+        addrs = [u"Jöb <job@bob.com>", (u"pop@bob.com", u"Pöp"), "sop@bob.com",
+                 ("mop@bob.com", None), None]
+        first = self._envelope(to_addr=list(addrs), bcc_addr="bcc@bob.com")
+        second = self._envelope(to_addr=list(addrs), bcc_addr="bcc@bob.com")
+
+        assert first.recipients == second.recipients == [
+            "=?utf-8?q?J=C3=B6b?= <job@bob.com>", "=?utf-8?q?P=C3=B6p?= <pop@bob.com>",
+            "sop@bob.com", "mop@bob.com", "bcc@bob.com"]
+        assert first.sendmail_args()[1] == first.recipients
+        assert first.to_mime_message()["To"] == second.to_mime_message()["To"]
+
+    def test_invalid_address(self):
+        """Test that invalid addresses are still refused"""
+        envl = self._envelope(to_addr=[["job@bob.com"]])
+        try:
+            envl.recipients
+        except envelopes.envelope.MessageEncodeError:
+            pass
+        else:
+            assert False, "MessageEncodeError not raised"
@@ -0,0 +1,117 @@
+"""Code to test the deltamail.journal module"""
+import os
+import shutil
+import smtplib
+import tempfile
+
+try:
+    from unittest.mock import Mock, patch
+except:
+    from mock import Mock, patch
+
+from deltamail import envelopes_mod as envelopes
+from deltamail.campaign import CampaignFactory
+from deltamail.journal import JournaledSender, SendJournal, read_delivered
+
+
+def _envelope(*to_addrs):
+    return envelopes.Envelope(from_addr="sender@example.com", to_addr=list(to_addrs),
+                              subject="Hi", html_body="Hello")
+
+
+class TestSendJournal(object):
+    """Class to test the SendJournal class and read_delivered"""
+
+    def setup_method(self, method=None):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmpdir, "campaign.journal")
+
+    def teardown_method(self, method=None):
+        shutil.rmtree(self.tmpdir)
+
+    # nose looks for these names, pytest for the ones above
+    setup = setup_method
+    teardown = teardown_method
+
+    def test_record(self):
+        """Test that outcomes are appended and delivered ones read back"""
+        with SendJournal(self.fname) as journal:
+            journal.record("delivered", "job@bob.com")
+            journal.record("refused", "pop@bob.com", (550, b"No\nsuch user"))
+
+        with SendJournal(self.fname) as journal:
+            journal.record("delivered", "sop@bob.com")
+
+        lines = open(self.fname).read().splitlines()
+        assert len(lines) == 3
+        assert lines[1].startswith("refused\tpop@bob.com\t(550, ")
+        assert read_delivered(self.fname) == set(["job@bob.com", "sop@bob.com"])
+
+    def test_torn_line(self):
+        """Test that a line cut short by a crash is ignored"""
+        fjournal = open(self.fname, "w")
+        fjournal.write("delivered\tjob@bob.com\t\ndelivered\tpop@b")
+        fjournal.close()
+
+        assert read_delivered(self.fname) == set(["job@bob.com"])
+        assert read_delivered(os.path.join(self.tmpdir, "missing")) == set()
+
+    @patch('deltamail.journal.os.fsync', autospec=True)
+    def test_batched_sync(self, mock_fsync):
+        """Test that the file is synced every sync_every lines and on close"""
+        journal = SendJournal(self.fname, sync_every=10, sync_interval=3600)
+        for i in range(25):
+            journal.record("delivered", "user%d@example.com" % i)
+        assert mock_fsync.call_count == 2
+
+        journal.close()
+        assert mock_fsync.call_count == 3
+
+
+class TestJournaledSender(object):
+    """Class to test the JournaledSender class"""
+
+    def test_outcomes(self):
+        """Test that every receiver of every mail is recorded"""
+        journal = Mock(spec=SendJournal)
+        smtp_conn = Mock(spec=['send'])
+        sender = JournaledSender(smtp_conn, journal)
+
+        smtp_conn.send.return_value = {"pop@bob.com": (550, b"No")}
+        sender.send(_envelope("job@bob.com", "pop@bob.com"))
+
+        smtp_conn.send.side_effect = smtplib.SMTPServerDisconnected("gone")
+        try:
+            sender.send(_envelope("sop@bob.com"))
+        except smtplib.SMTPServerDisconnected:
+            pass
+        else:
+            assert False, "SMTPServerDisconnected not raised"
+
+        records = [call[0] for call in journal.record.call_args_list]
+        assert records[0] == ("delivered", "job@bob.com")
+        assert records[1] == ("refused", "pop@bob.com", (550, b"No"))
+        assert records[2][:2] == ("failed", "sop@bob.com")
+
+    def test_resume(self):
+        """Test resuming a campaign: delivered receivers aren't rendered"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fjournal = os.path.join(tmpdir, "campaign.journal")
+            with SendJournal(fjournal) as journal:
+                journal.record("delivered", "job@bob.com")
+                journal.record("refused", "pop@bob.com", (550, b"No"))
+
+            files = "./tests/testCampaignFactory-files/"
+            with patch('deltamail.campaign.MailFactory', autospec=True) as mock_mf:
+                campaign = CampaignFactory(
+                    "sender@example.com", "Hi", files + "mailingList.ml",
+                    files + "template.mmtmpl", streaming=True,
+                    exclude=read_delivered(fjournal))
+                campaign.send(Mock(spec=['send']))
+
+            receivers = [call[0][2] for call in mock_mf.call_args_list]
+            assert ["job@bob.com"] not in receivers
+            assert ["pop@bob.com"] in receivers
+        finally:
+            shutil.rmtree(tmpdir)
@@ -1,4 +1,6 @@
+# -*- coding: utf-8 -*-
 """Code to test the deltmail.mail module"""
+import pickle
 import sys
 from os import path
 
@@ -7,6 +9,8 @@ try:
 except:
     from mock import patch
 
+import jinja2
+
 from deltamail import envelopes_mod as envelopes
 from deltamail import mail
 
@@ -99,9 +103,12 @@ class TestMailFactory(object):
                                                       html_body=body_evaled,
                                                       headers={"Date": date})
 
-            mf.add_attachment.assert_any_call(path.abspath(path.expanduser(attch1)))
-            mf.add_attachment.assert_any_call(path.abspath(path.expanduser(attch2)))
-            mf.add_attachment.assert_any_call(path.abspath(path.expanduser(attch3)))
+            mf.add_attachment.assert_any_call(path.abspath(path.expanduser(attch1)),
+                                             cache=None)
+            mf.add_attachment.assert_any_call(path.abspath(path.expanduser(attch2)),
+                                             cache=None)
+            mf.add_attachment.assert_any_call(path.abspath(path.expanduser(attch3)),
+                                             cache=None)
             assert mf.add_attachment.call_count == 3
 
             env_patcher.stop()
@@ -121,3 +128,182 @@ class TestMailFactory(object):
         except:
             env_patcher.stop()
             raise sys.exc_info()
+
+
+class TestCompileTemplate(object):
+    """Class to test the compile_template function"""
+
+    def test_compile_template(self):
+        """Test that strings are compiled and compiled templates are reused"""
+        tmpl = mail.compile_template("Hello {{name}}")
+        assert isinstance(tmpl, mail.CompiledTemplate)
+        assert tmpl.render(name="Job") == u"Hello Job"
+        assert mail.compile_template(tmpl) is tmpl
+
+    def test_pickle(self):
+        """Test that compiled templates can be pickled"""
+        tmpl = pickle.loads(pickle.dumps(mail.compile_template("Hello {{name}}")))
+        assert tmpl.source == "Hello {{name}}"
+        assert tmpl.render(name="Job") == u"Hello Job"
+
+    def test_variables(self):
+        """Test that the variables a template uses are found"""
+        tmpl = mail.compile_template(
+            "{% set greeting = 'Hi' %}{{greeting}} {{name|upper}}\n"
+            "{% for event in events %}{{event}} on {{day}}{% endfor %}"
+            "{% if vip %}VIP{% endif %}")
+        assert tmpl.variables == frozenset(["name", "events", "day", "vip"])
+        assert mail.compile_template("Hello").variables == frozenset()
+
+    def test_MailFactory_compiled(self):
+        """Test the MailFactory function with compiled templates"""
+        subject = mail.compile_template("Greetings from {{company}}")
+        template = mail.compile_template("Hello {{name}}")
+        variables = {"company": "Festember", "name": "Job"}
+
+        mf = mail.MailFactory("sender@example.com", subject, ["job@bob.com"],
+                              template, variables)
+
+        assert mf._subject == u"Greetings from Festember"
+        assert mf._parts[0][1] == u"Hello Job"
+
+
+class Counted(object):
+    """A global variable that counts how many times it is rendered"""
+
+    def __init__(self, value):
+        self.value = value
+        self.rendered = 0
+
+    def __str__(self):
+        self.rendered += 1
+        return self.value
+
+    __unicode__ = __str__
+
+
+class TestBakedTemplate(object):
+    """Class to test CompiledTemplate.bake"""
+
+    source = ("<h1>{{company}} {{year + 1}}</h1>\n"
+              "{% for event in events %}<li>{{event}} {{loop.index}}</li>{% endfor %}\n"
+              "Hi {{name}}, {{msg|upper}}{% if vip %} VIP {{company}}{% endif %}\n"
+              "{% set sign = company %}{% if name == 'Job' %}job{% else %}{{msg}}{% endif %}\n"
+              "{{sign}} {{footer}}")
+    global_vars = {"company": "Festember", "year": 2015, "events": ["a", "b"],
+                   "vip": True, "msg": "global message", "footer": "Bye"}
+    rows = [{"name": "Job", "msg": "hey"}, {"name": "Pop"}, {"name": "Top", "msg": "yo"}]
+
+    def _renders(self, tmpl):
+        return [tmpl.render(**dict(self.global_vars, **row)) for row in self.rows]
+
+    def test_same_text(self):
+        """Test that baked templates render like the original ones"""
+        tmpl = mail.compile_template(self.source)
+        baked = tmpl.bake(self.global_vars, ["name", "msg"])
+        assert isinstance(baked, mail.BakedTemplate)
+        assert self._renders(baked) == self._renders(tmpl)
+
+        unpickled = pickle.loads(pickle.dumps(baked))
+        assert self._renders(unpickled) == self._renders(tmpl)
+
+    def test_rendered_once(self):
+        """Test that the parts with only global variables are rendered once"""
+        company = Counted("Festember")
+        footer = Counted("Bye")
+        baked = mail.compile_template(self.source).bake(
+            dict(self.global_vars, company=company, footer=footer), ["name", "msg"])
+        assert (company.rendered, footer.rendered) == (2, 1)
+
+        texts = [baked.render(**dict(self.global_vars, company=company, footer=footer, **row))
+                 for row in self.rows]
+        # only {{sign}}, which the template sets, is rendered for every mail
+        assert (company.rendered, footer.rendered) == (2 + len(self.rows), 1)
+        assert all(text.startswith(u"<h1>Festember 2016</h1>") for text in texts)
+
+    def test_personal_override(self):
+        """Test that global variables personal ones override aren't baked"""
+        baked = mail.compile_template("{{msg}} {{footer}}").bake(self.global_vars, ["msg"])
+        assert baked.render(msg="hey", footer="Bye") == u"hey Bye"
+        assert baked.render(msg="yo", footer="Ciao") == u"yo Bye"
+
+    def test_impure_not_baked(self):
+        """Test that random text isn't baked into the same text for all"""
+        baked = mail.compile_template(
+            "{{ lipsum(1, False, 20, 50) }} {{name}}").bake({}, ["name"])
+        texts = set(baked.render(name="Job") for _ in range(5))
+        assert len(texts) > 1
+
+
+class TestSubstitution(object):
+    """Class to test rendering {{ variable }} templates without jinja2,
+    against jinja2 itself"""
+
+    # rendered without jinja2
+    simple = [
+        "",
+        "Hello",
+        "Hello {{name}}",
+        "{{ name }}",
+        "{{name}}{{name}}, {{ msg }}!",
+        "Hi {{name}},\r\n\n\t{{msg}}\n",
+        "Hi {{name}}\n\n",
+        "{# a comment #}Hi {{name}}{# another #}",
+        "{% raw %}{{name}} {% if %}{% endraw %} {{name}}",
+        "Hi {{- name -}} ,\n  {{- msg }}",
+        u"H\xe9llo {{name}} \u2713",
+        "{{ missing }} and {{name}}",
+        "50% off {{ name }} { { name } } {name}",
+        open(path.join(path.dirname(__file__), "testCampaignFactory-files",
+                       "template.mmtmpl")).read(),
+    ]
+
+    # rendered with jinja2
+    complex = [
+        "{{ name|upper }}",
+        "{{ name.title }}",
+        "{{ name ~ msg }}",
+        "{{ 'name' }}",
+        "{% if name %}{{name}}{% endif %}",
+        "{% for c in name %}{{c}}{% endfor %}",
+        "{% set x = name %}{{x}}",
+        "{{ range }}",
+        "{{ self }}",
+        "{{ loop }} {{ varargs }} {{ kwargs }} {{ caller }}",
+    ]
+
+    variable_sets = [
+        {"name": "Job", "msg": "You got a job!", "company": "Festember", "copyright": "2015"},
+        {"name": u"J\xf6b \u2713", "msg": "<b>&amp;</b>"},
+        {"name": 42, "msg": None},
+        {"name": 1.5, "msg": ["a", "b"]},
+        {"name": "", "msg": {"a": 1}},
+        {},
+    ]
+
+    def test_simple(self):
+        """Test that simple templates render like jinja2 does, without it"""
+        for source in self.simple:
+            tmpl = mail.compile_template(source)
+            assert tmpl._segments is not None, source
+            for variables in self.variable_sets:
+                assert tmpl.render(**variables) == jinja2.Template(source).render(**variables)
+
+        # the expressions of the complex templates aren't evaluated
+        for source in self.complex:
+            assert mail.compile_template(source)._segments is None, source
+
+    def test_complex(self):
+        """Test that other templates render with jinja2"""
+        for source in self.complex:
+            tmpl = mail.compile_template(source)
+            # with text names, which all of them can take
+            for variables in self.variable_sets[:2]:
+                assert tmpl.render(**variables) == jinja2.Template(source).render(**variables)
+
+    def test_baked(self):
+        """Test that templates simple once baked render without jinja2"""
+        source = "Hi {{name}}{% if vip %}, our VIP{% endif %}. {{company|upper}}"
+        baked = mail.compile_template(source).bake({"vip": True, "company": "Fest"}, ["name"])
+        assert baked._segments is not None
+        assert baked.render(name="Job") == u"Hi Job, our VIP. FEST"
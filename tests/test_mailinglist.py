@@ -0,0 +1,154 @@
+"""Code to test the deltamail.mailinglist module"""
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+
+from deltamail.mailinglist import MailingList, MailingListFile, RowVariables
+
+
+class TestMailingListFile(object):
+    """Class to test the deltamail.mailinglist.MailingListFile class"""
+
+    def setup_method(self, method=None):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown_method(self, method=None):
+        shutil.rmtree(self.tmpdir)
+
+    # nose looks for these names, pytest for the ones above
+    setup = setup_method
+    teardown = teardown_method
+
+    def _write(self, contents):
+        fname = os.path.join(self.tmpdir, "mailingList.ml")
+        fml = open(fname, "w")
+        fml.write(contents)
+        fml.close()
+        return fname
+
+    def _error(self, fn):
+        try:
+            fn()
+        except Exception:
+            return str(sys.exc_info()[1])
+        assert False, "Exception not raised"
+
+    def test_rows(self):
+        """Test that the rows are read in order, skipping blank lines"""
+        fname = self._write("email\tname\tmsg\r\n"
+                            "\r\n"
+                            "job@bob.com\tJob\tHi\r\n"
+                            "pop@bob.com\tPop\t\n")
+
+        ml = MailingListFile(fname)
+        assert ml.headers == ["email", "name", "msg"]
+
+        expected = [
+            {"email": "job@bob.com", "variables": {"name": "Job", "msg": "Hi"}},
+            {"email": "pop@bob.com", "variables": {"name": "Pop", "msg": ""}},
+        ]
+        assert list(ml) == expected
+        # can be iterated over again
+        assert list(ml) == expected
+
+    def test_select(self):
+        """Test reading some of the fields only, and loading the file"""
+        fname = self._write("email\tname\tmsg\tage\n"
+                            "job@bob.com\tJob\tHi\t30\n")
+
+        ml = MailingListFile(fname).select(set(["age", "name", "other"]))
+        assert ml.headers == ["email", "name", "age"]
+        assert list(ml) == [{"email": "job@bob.com", "variables": {"name": "Job", "age": "30"}}]
+
+        loaded = MailingListFile(fname).load()
+        assert isinstance(loaded, MailingList)
+        assert loaded.rows == [("job@bob.com", "Job", "Hi", "30")]
+
+    def test_non_existing_file(self):
+        """Test that a missing file is reported"""
+        fname = os.path.join(self.tmpdir, "NON-EXISTING")
+        assert "doesn't exist" in self._error(lambda: MailingListFile(fname))
+
+    def test_bad_header(self):
+        """Test that the first field is required to be `email`"""
+        fname = self._write("name\temail\nJob\tjob@bob.com\n")
+        msg = self._error(lambda: MailingListFile(fname))
+        assert msg.startswith(fname + ":1: ")
+
+    def test_bad_row(self):
+        """Test that rows are checked lazily and errors have line numbers"""
+        fname = self._write("email\tname\n"
+                            "\n"
+                            "job@bob.com\tJob\n"
+                            "pop@bob.com\n")
+
+        rows = iter(MailingListFile(fname))
+        assert next(rows)["email"] == "job@bob.com"
+
+        msg = self._error(lambda: next(rows))
+        assert msg == fname + ":4: Mismatch in number of columns."
+
+    def test_exclude(self):
+        """Test that excluded rows are skipped without being checked"""
+        fname = self._write("email\tname\n"
+                            "job@bob.com\tJob\n"
+                            "pop@bob.com\n"
+                            "sop@bob.com\tSop\n")
+
+        ml = MailingListFile(fname, exclude=set(["pop@bob.com", "job@bob.com"]))
+        assert [row["email"] for row in ml] == ["sop@bob.com"]
+
+
+class TestMailingList(object):
+    """Class to test the MailingList and RowVariables classes"""
+
+    def _ml(self):
+        return MailingList(["email", "name", "msg"], [
+            ("job@bob.com", "Job", "Hi"),
+            ["pop@bob.com", "Pop", ""],
+        ])
+
+    def test_rows(self):
+        """Test that the rows are kept as tuples and read as mappings"""
+        ml = self._ml()
+        assert len(ml) == 2
+        assert ml.rows[1] == ("pop@bob.com", "Pop", "")
+
+        receivers = list(ml)
+        assert [receiver["email"] for receiver in receivers] == ["job@bob.com", "pop@bob.com"]
+        variables = receivers[0]["variables"]
+        assert isinstance(variables, RowVariables)
+        assert variables == {"name": "Job", "msg": "Hi"}
+        assert variables["name"] == "Job" and variables.get("email") is None
+        assert "msg" in variables and "email" not in variables
+        assert sorted(variables) == ["msg", "name"]
+
+        merged = {"company": "Festember", "name": "nobody"}
+        merged.update(variables)
+        assert merged == {"company": "Festember", "name": "Job", "msg": "Hi"}
+
+        # the rows share their index
+        assert variables._index is receivers[1]["variables"]._index
+
+    def test_append(self):
+        """Test that rows need a value per field"""
+        ml = self._ml()
+        try:
+            ml.append(("sop@bob.com", "Sop"))
+        except Exception as e:
+            assert "number of columns" in str(e)
+        else:
+            assert False, "Exception not raised"
+
+    def test_select(self):
+        """Test keeping some of the fields only"""
+        ml = self._ml().select(set(["msg"]))
+        assert ml.headers == ["email", "msg"]
+        assert ml.rows == [("job@bob.com", "Hi"), ("pop@bob.com", "")]
+
+    def test_pickle(self):
+        """Test that the variables of a row can be pickled"""
+        variables = next(iter(self._ml()))["variables"]
+        assert pickle.loads(pickle.dumps(variables)) == {"name": "Job", "msg": "Hi"}
@@ -0,0 +1,103 @@
+"""Code to test the deltamail.preview module and Campaign.preview_mailbox"""
+import mailbox
+import os
+import re
+import shutil
+import tempfile
+
+from deltamail.campaign import BulkMailCampaign, TransactionMailCampaign
+
+
+class TestPreviewMailbox(object):
+    """Class to test previewing campaigns into an mbox or a Maildir"""
+
+    mailing_list = [
+        {"email": "job@bob.com", "variables": {"name": "Job"}},
+        {"email": "pop@bob.com", "variables": {"name": "Pop"}},
+        {"email": "sop@bob.com", "variables": {"name": "Sop"}},
+    ]
+
+    def setup_method(self, method=None):
+        self.tmpdir = tempfile.mkdtemp()
+        fattch = open(os.path.join(self.tmpdir, "notes.txt"), "w")
+        fattch.write("Some notes")
+        fattch.close()
+
+        self.tmc = TransactionMailCampaign(
+            "sender@example.com", "Hi {{name}}", self.mailing_list,
+            "Hello {{name}}\nFrom the team",
+            {"$attachments": os.path.join(self.tmpdir, "notes.txt")})
+
+    def teardown_method(self, method=None):
+        shutil.rmtree(self.tmpdir)
+
+    # nose looks for these names, pytest for the ones above
+    setup = setup_method
+    teardown = teardown_method
+
+    def _check(self, box):
+        messages = sorted(box, key=lambda msg: msg["To"])
+        assert [msg["To"] for msg in messages] == \
+            ["job@bob.com", "pop@bob.com", "sop@bob.com"]
+
+        msg = messages[0]
+        assert msg["Subject"] == "Hi Job"
+        assert msg["X-Envelope-To"] == "job@bob.com"
+        body, attachment = msg.get_payload()
+        # the "From " line of the body survives the mbox escaping, which
+        # the mailbox module doesn't undo
+        assert re.sub(br"(?m)^>From ", b"From ", body.get_payload(decode=True)) == \
+            b"Hello Job\nFrom the team"
+        assert attachment.get_payload(decode=True) == b"Some notes"
+
+    def test_mbox(self):
+        """Test that all the mails go into one mbox file"""
+        fname = os.path.join(self.tmpdir, "preview.mbox")
+        self.tmc.preview_mailbox(fname)
+        self._check(mailbox.mbox(fname))
+
+        raw = open(fname, "rb").read()
+        assert raw.count(b"\nFrom sender@example.com ") == 2
+
+    def test_mbox_display_name(self):
+        """Test that the From_ line only has the address of the sender"""
+        tmc = TransactionMailCampaign(
+            "The Team <sender@example.com>", "Hi {{name}}", self.mailing_list,
+            "Hello {{name}}", {})
+        fname = os.path.join(self.tmpdir, "preview.mbox")
+        tmc.preview_mailbox(fname)
+
+        box = mailbox.mbox(fname)
+        assert len(box) == 3
+        assert [msg.get_from().split()[0] for msg in box] == ["sender@example.com"] * 3
+        assert box[0]["From"] == "The Team <sender@example.com>"
+
+    def test_maildir(self):
+        """Test that all the mails go into a new Maildir"""
+        dirname = os.path.join(self.tmpdir, "preview")
+        self.tmc.preview_mailbox(dirname, "maildir")
+        assert os.listdir(os.path.join(dirname, "tmp")) == []
+        self._check(mailbox.Maildir(dirname, factory=None))
+
+    def test_preview_count(self):
+        """Test preview_count, and the single preview of bulk mails"""
+        fname = os.path.join(self.tmpdir, "preview.mbox")
+        self.tmc.preview_mailbox(fname, preview_count=2)
+        assert len(mailbox.mbox(fname)) == 2
+
+        bmc = BulkMailCampaign("sender@example.com", "Hi", ["job@bob.com", "pop@bob.com"],
+                               "Hello", {}, batch_size=1)
+        fname = os.path.join(self.tmpdir, "bulk.mbox")
+        bmc.preview_mailbox(fname)
+        messages = list(mailbox.mbox(fname))
+        assert len(messages) == 1
+        assert messages[0]["X-Envelope-To"] == "job@bob.com"
+
+    def test_unknown_format(self):
+        """Test that an unknown format is reported"""
+        try:
+            self.tmc.preview_mailbox(os.path.join(self.tmpdir, "x"), "mh")
+        except Exception as e:
+            assert "Unknown mailbox format" in str(e)
+        else:
+            assert False, "Exception not raised"
@@ -0,0 +1,107 @@
+"""Code to test the deltamail.envelopes_mod.ratelimit module"""
+import threading
+import time
+
+try:
+    from unittest.mock import Mock, patch
+except:
+    from mock import Mock, patch
+
+from deltamail import envelopes_mod as envelopes
+from deltamail.envelopes_mod.ratelimit import RateLimiter
+
+
+class TestRateLimiter(object):
+    """Class to test the envelopes.RateLimiter class"""
+
+    @patch('deltamail.envelopes_mod.ratelimit._now', autospec=True)
+    def test_burst(self, mock_now):
+        """Test that a burst goes through, and the rest waits its turn"""
+        mock_now.return_value = 100.0
+        limiter = RateLimiter(per_second=2, burst=3)
+
+        delays = [limiter.reserve() for _ in range(5)]
+        assert delays == [0, 0, 0, 0.5, 1.0]
+
+        # after a quiet period, the bucket is full again, but no fuller
+        mock_now.return_value = 200.0
+        delays = [limiter.reserve() for _ in range(4)]
+        assert delays == [0, 0, 0, 0.5]
+
+    @patch('deltamail.envelopes_mod.ratelimit._now', autospec=True)
+    def test_per_hour(self, mock_now):
+        """Test the hourly limit, together with the per second one"""
+        mock_now.return_value = 100.0
+        limiter = RateLimiter(per_second=10, per_hour=2)
+
+        assert limiter.reserve() == 0
+        assert limiter.reserve() == 0
+        assert limiter.reserve() == 1800
+
+        assert RateLimiter().reserve() == 0
+
+    @patch('deltamail.envelopes_mod.ratelimit.time.sleep', autospec=True)
+    def test_acquire(self, mock_sleep):
+        """Test that acquire sleeps only when it has to"""
+        limiter = RateLimiter(per_second=1)
+        limiter.acquire()
+        assert mock_sleep.call_count == 0
+
+        limiter.acquire()
+        assert mock_sleep.call_count == 1
+        assert 0.9 < mock_sleep.call_args[0][0] <= 1
+
+    def test_threads(self):
+        """Test that threads sharing a limiter keep to its rate together"""
+        limiter = RateLimiter(per_second=100, burst=1)
+
+        def send():
+            for _ in range(5):
+                limiter.acquire()
+
+        start = time.time()
+        threads = [threading.Thread(target=send) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 20 mails, the first one straight away
+        assert time.time() - start >= 0.18
+
+
+class TestSMTPRateLimit(object):
+    """Class to test rate limiting in envelopes.conn.SMTP"""
+
+    @patch('deltamail.envelopes_mod.conn.smtplib.SMTP', autospec=True)
+    def test_wait(self, mock_smtp):
+        """Test that every message waits on the limiter"""
+        mock_smtp.return_value.has_extn.return_value = False
+        limiter = Mock(spec=RateLimiter)
+        pool = envelopes.SMTPPool(2, "localhost", rate_limit=limiter)
+
+        conns = [pool._conns.get() for _ in range(2)]
+        for conn in conns:
+            assert conn._rate_limit is limiter
+            conn.sendmail("sender@example.com", ["job@bob.com"], "Hello")
+
+        assert limiter.acquire.call_count == 2
+
+    def test_host_defaults(self):
+        """Test that connections to the same known host share a limiter"""
+        gmail1 = envelopes.GMailSMTP()
+        gmail2 = envelopes.conn.SMTP("smtp.googlemail.com", 587, rate_limit="auto")
+        assert gmail1._rate_limit is gmail2._rate_limit
+        assert gmail1._rate_limit.per_hour == 80
+
+        assert envelopes.SendGridSMTP()._rate_limit.per_second == 50
+        assert envelopes.conn.SMTP("localhost", rate_limit="auto")._rate_limit is None
+
+        limiter = RateLimiter()
+        assert envelopes.GMailSMTP(rate_limit=limiter)._rate_limit is limiter
+
+    def test_host_defaults_opt_in(self):
+        """Test that known hosts are only limited when asked to"""
+        assert envelopes.conn.SMTP("smtp.googlemail.com", 587)._rate_limit is None
+        assert envelopes.GMailSMTP(rate_limit=None)._rate_limit is None
+        assert envelopes.SendGridSMTP(rate_limit=False)._rate_limit is None
@@ -0,0 +1,82 @@
+"""Code to test the deltamail.render module"""
+import email
+import pickle
+
+try:
+    from unittest.mock import Mock
+except:
+    from mock import Mock
+
+from deltamail import envelopes_mod as envelopes
+from deltamail.campaign import TransactionMailCampaign
+from deltamail.mail import MailFactory, compile_template
+from deltamail.render import render_parallel
+
+
+def _body(message):
+    """Decoded html body of a serialized message"""
+    msg = email.message_from_string(message)
+    return msg.get_payload()[0].get_payload(decode=True).decode("utf-8")
+
+
+class TestSerializedEnvelope(object):
+    """Class to test the envelopes.SerializedEnvelope class"""
+
+    def test_serialized(self):
+        """Test that it sends the message of the original envelope"""
+        envl = MailFactory("sender@example.com", "Hi {{name}}", ["job@bob.com"],
+                           "Hello {{name}}", {"name": "Job"})
+        envl.add_bcc_addr("boss@bob.com")
+        serialized = pickle.loads(pickle.dumps(envelopes.SerializedEnvelope(envl)))
+
+        from_addr, to_addrs, message = serialized.sendmail_args()
+        assert from_addr == "sender@example.com"
+        assert to_addrs == ["job@bob.com", "boss@bob.com"]
+        assert _body(message) == u"Hello Job"
+
+        assert serialized._subject == u"Hi Job"
+        assert serialized._parts[0][1] == u"Hello Job"
+        assert serialized.to_mime_message()["Subject"] == "Hi Job"
+
+        smtp = envelopes.conn.SMTP("localhost")
+        smtp.sendmail = Mock()
+        smtp.send(serialized)
+        smtp.sendmail.assert_called_once_with(from_addr, to_addrs, message)
+
+
+class TestRenderParallel(object):
+    """Class to test the render_parallel function"""
+
+    mailing_list = [
+        {"email": "user%d@example.com" % i, "variables": {"name": "User%d" % i}}
+        for i in range(25)
+    ]
+
+    def test_order(self):
+        """Test that the mails come back rendered and in order"""
+        mails = list(render_parallel(
+            "sender@example.com", compile_template("Hey {{name}}"),
+            iter(self.mailing_list), compile_template("{{greeting}} {{name}}"),
+            {"greeting": "Hello", "name": "nobody"}, processes=2, chunk_size=4
+        ))
+
+        assert len(mails) == len(self.mailing_list)
+        for mail, receiver in zip(mails, self.mailing_list):
+            name = receiver["variables"]["name"]
+            assert isinstance(mail, envelopes.SerializedEnvelope)
+            assert mail.to_addr == [receiver["email"]]
+            assert mail._subject == u"Hey " + name
+            assert _body(mail.sendmail_args()[2]) == u"Hello " + name
+
+    def test_campaign(self):
+        """Test TransactionMailCampaign with processes"""
+        tmc = TransactionMailCampaign("sender@example.com", "Hey {{name}}",
+                                      self.mailing_list, "Hello {{name}}", {},
+                                      streaming=True, processes=2)
+
+        mock_mailer = Mock(spec=['send'])
+        tmc.send(mock_mailer)
+
+        sent = [call[0][0] for call in mock_mailer.send.call_args_list]
+        assert [mail.to_addr[0] for mail in sent] == \
+            [receiver["email"] for receiver in self.mailing_list]
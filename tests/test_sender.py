@@ -0,0 +1,102 @@
+"""Code to test the deltamail.sender module and envelopes.SMTPPool"""
+import threading
+import time
+
+try:
+    from unittest.mock import Mock
+except:
+    from mock import Mock
+
+from deltamail import envelopes_mod as envelopes
+from deltamail.sender import send_parallel
+
+
+class SlowSMTP(object):
+    """Fake SMTP connection that records who used it and when"""
+
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def __init__(self, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        self.sent = []
+        self.in_use = False
+
+    def send(self, envelope):
+        assert not self.in_use, "connection used by two threads at once"
+        self.in_use = True
+        with SlowSMTP.lock:
+            SlowSMTP.active += 1
+            SlowSMTP.max_active = max(SlowSMTP.max_active, SlowSMTP.active)
+        time.sleep(0.01)
+        self.sent.append(envelope)
+        with SlowSMTP.lock:
+            SlowSMTP.active -= 1
+        self.in_use = False
+
+
+class TestSMTPPool(object):
+    """Class to test the envelopes.SMTPPool class"""
+
+    def test_connections(self):
+        """Test that the pool creates `size` connections with the given args"""
+        pool = envelopes.SMTPPool(3, "localhost", 2525, login="user",
+                                  smtp_class=SlowSMTP)
+        assert pool.size == 3
+
+        conns = [pool._conns.get() for _ in range(3)]
+        for conn in conns:
+            assert conn.args == ("localhost", 2525)
+            assert conn.kwargs == {"login": "user"}
+
+    def test_default_class(self):
+        """Test that the pool uses envelopes.conn.SMTP by default"""
+        pool = envelopes.SMTPPool(2, "localhost", 2525)
+        assert isinstance(pool._conns.get(), envelopes.conn.SMTP)
+
+
+class TestSendParallel(object):
+    """Class to test the send_parallel function"""
+
+    def setup_method(self, method=None):
+        SlowSMTP.active = 0
+        SlowSMTP.max_active = 0
+
+    # nose looks for this name, pytest for the one above
+    setup = setup_method
+
+    def test_send(self):
+        """Test that all mails are sent, over different connections at once"""
+        pool = envelopes.SMTPPool(4, smtp_class=SlowSMTP)
+        mails = list(range(40))
+
+        send_parallel(iter(mails), pool, 4)
+
+        conns = [pool._conns.get() for _ in range(4)]
+        sent = sorted(sum([conn.sent for conn in conns], []))
+        assert sent == mails
+        assert SlowSMTP.max_active > 1
+        assert SlowSMTP.max_active <= 4
+
+    def test_error(self):
+        """Test that sending stops and the first error is raised"""
+        mock_mailer = Mock(spec=['send'])
+        mock_mailer.send.side_effect = ValueError("refused")
+        handed_out = []
+
+        def mails():
+            for i in range(1000):
+                handed_out.append(i)
+                yield i
+
+        try:
+            send_parallel(mails(), mock_mailer, 2)
+        except ValueError:
+            pass
+        else:
+            assert False, "ValueError not raised"
+
+        assert len(handed_out) < 1000
+        assert mock_mailer.send.call_count < 1000
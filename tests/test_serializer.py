@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""Code to test the deltamail.envelopes_mod.serializer module
+
+Every message is serialized both with Envelope.as_bytes and through
+Envelope.to_mime_message, and the two are parsed back with the email
+package and compared.
+"""
+import email
+from email.header import decode_header, make_header
+from email.utils import formatdate
+import os
+import shutil
+import sys
+import tempfile
+
+from deltamail import envelopes_mod as envelopes
+
+try:
+    from unittest.mock import Mock
+except ImportError:
+    from mock import Mock
+
+
+def _parse(msg):
+    if isinstance(msg, bytes) and sys.version_info[0] == 3:
+        return email.message_from_bytes(msg)
+    return email.message_from_string(msg)
+
+
+def _header_value(value):
+    # unfolded and with encoded-words decoded
+    return u" ".join(u"%s" % make_header(decode_header(value)) for value in value.split())
+
+
+def _headers(msg):
+    return [(name.lower(), _header_value(value)) for name, value in msg.items()
+            if name.lower() != "content-type"]
+
+
+def _payload(part):
+    # 7bit and 8bit text keeps the line endings it was parsed with
+    return part.get_payload(decode=True).replace(b"\r\n", b"\n")
+
+
+def assert_same_message(envl, allow_8bit=False):
+    fast = envl.as_bytes(allow_8bit)
+    assert isinstance(fast, bytes)
+    for line in fast.split(b"\r\n"):
+        assert b"\n" not in line and len(line) <= 998
+
+    msg = envl.to_mime_message(allow_8bit)
+    if allow_8bit and sys.version_info[0] == 3:
+        expected = _parse(msg.as_bytes())
+    else:
+        expected = _parse(msg.as_string())
+    actual = _parse(fast)
+
+    assert actual.get_content_type() == expected.get_content_type()
+    assert _headers(actual) == _headers(expected)
+    assert len(actual.get_payload()) == len(expected.get_payload())
+    for actual_part, expected_part in zip(actual.get_payload(), expected.get_payload()):
+        assert actual_part.get_content_type() == expected_part.get_content_type()
+        assert actual_part.get_params() == expected_part.get_params()
+        assert _headers(actual_part) == _headers(expected_part)
+        assert _payload(actual_part) == _payload(expected_part)
+    return fast
+
+
+class TestAsBytes(object):
+    """Class to test Envelope.as_bytes against the email package"""
+
+    def setup_method(self, method=None):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown_method(self, method=None):
+        shutil.rmtree(self.tmpdir)
+
+    # nose looks for these names, pytest for the ones above
+    setup = setup_method
+    teardown = teardown_method
+
+    def _attachment(self, name, contents):
+        fname = os.path.join(self.tmpdir, name)
+        fattch = open(fname, "wb")
+        fattch.write(contents)
+        fattch.close()
+        return fname
+
+    def test_plain(self):
+        """Test a mail with only an html body"""
+        assert_same_message(envelopes.Envelope(
+            from_addr="sender@example.com", to_addr="job@bob.com",
+            subject="Hi", html_body="<p>Hello</p>"))
+
+    def test_text_and_html(self):
+        """Test a mail with text and html bodies, and extra headers"""
+        assert_same_message(envelopes.Envelope(
+            from_addr="Sender <sender@example.com>",
+            to_addr=["job@bob.com", "Alice <alice@example.com>"],
+            cc_addr="cc@example.com", bcc_addr="bcc@example.com",
+            subject="Hi", text_body="Hello\n.\nBye", html_body="<p>Hello</p>\n" * 500,
+            headers={"Date": formatdate(localtime=True), "Reply-To": "reply@example.com"}))
+
+    def test_non_ascii(self):
+        """Test non-ascii subjects, names and bodies"""
+        assert_same_message(envelopes.Envelope(
+            from_addr=(u"sender@example.com", u"Zoë Sender"),
+            to_addr=[u"Jöb <job@bob.com>", (u"alice@example.com", u"Ålice")],
+            cc_addr=(u"cc@example.com", u"Çc"),
+            subject=u"Héllo, wörld " * 10, html_body=u"<p>Héllo ✓</p>",
+            text_body=u"Héllo ✓", headers={"X-Campaign": u"Fêtes"}))
+
+    def test_long_ascii_header(self):
+        """Test that long ascii headers are folded without changing them"""
+        assert_same_message(envelopes.Envelope(
+            from_addr="sender@example.com", to_addr="job@bob.com",
+            subject=" ".join(["word%d" % i for i in range(60)]),
+            html_body="Hello"))
+
+    def test_empty_body(self):
+        """Test an empty body"""
+        assert_same_message(envelopes.Envelope(
+            from_addr="sender@example.com", to_addr="job@bob.com",
+            subject="", html_body="", text_body="Hi"))
+
+    def test_attachments(self):
+        """Test cached and uncached attachments"""
+        pdf = self._attachment("brochure.pdf", os.urandom(100 * 1024))
+        txt = self._attachment("notes.txt", b"line one\nline two\n")
+        cache = envelopes.AttachmentCache()
+
+        for _ in range(2):
+            envl = envelopes.Envelope(from_addr="sender@example.com",
+                                      to_addr="job@bob.com", subject="Hi",
+                                      html_body="<p>Hello</p>")
+            envl.add_attachment(pdf, cache=cache)
+            envl.add_attachment(txt)
+            assert_same_message(envl)
+
+    def test_charset(self):
+        """Test a charset other than utf-8, and mails without parts"""
+        envl = envelopes.Envelope(from_addr="sender@example.com",
+                                  to_addr="job@bob.com", subject="Hi",
+                                  html_body=u"Un caf\xe9, s'il vous pla\xeet",
+                                  charset="iso-8859-1")
+        assert b"quoted-printable" in assert_same_message(envl)
+        assert b"caf\xe9" in assert_same_message(envl, allow_8bit=True)
+
+        assert_same_message(envelopes.Envelope(from_addr="sender@example.com",
+                                               to_addr="job@bob.com", subject="Hi"))
+
+    def test_8bit(self):
+        """Test that text parts are sent as they are when allowed"""
+        envl = envelopes.Envelope(from_addr="sender@example.com",
+                                  to_addr="job@bob.com", subject="Hi",
+                                  html_body=u"<p>H\xe9llo \u2713</p>", text_body=u"x" * 1000)
+        msg = assert_same_message(envl, allow_8bit=True)
+        assert u"H\xe9llo \u2713".encode("utf-8") in msg
+        # too long a line for 8bit
+        assert b"Content-Transfer-Encoding: quoted-printable" in msg
+
+    def test_sendmail_args(self):
+        """Test that sendmail_args serializes with as_bytes when asked to"""
+        envl = envelopes.Envelope(from_addr="sender@example.com",
+                                  to_addr="job@bob.com", cc_addr="cc@example.com",
+                                  subject="Hi", html_body="Hello")
+        from_addr, to_addrs, msg = envl.sendmail_args()
+        assert not isinstance(msg, bytes) or sys.version_info[0] == 2
+
+        envl.fast_serialize = True
+        envl.to_mime_message = Mock(side_effect=AssertionError)
+        assert envl.sendmail_args()[:2] == (from_addr, to_addrs)
+        assert _parse(envl.sendmail_args()[2])["Subject"] == "Hi"
+
+    def test_serialized_envelope(self):
+        """Test that a SerializedEnvelope of a fast one parses back"""
+        envl = envelopes.Envelope(from_addr="sender@example.com",
+                                  to_addr="job@bob.com", subject="Hi",
+                                  html_body="Hello")
+        envl.fast_serialize = True
+        msg = envelopes.SerializedEnvelope(envl).to_mime_message()
+        assert msg["Subject"] == "Hi"
+        assert msg.get_payload()[0].get_payload(decode=True) == b"Hello"
+
+
+class TestTransferEncoding(object):
+    """Class to test the transfer encodings text parts are sent in"""
+
+    def test_ascii(self):
+        """Test that ASCII text is 7bit, unless a line is too long"""
+        te = envelopes.serializer.transfer_encoding
+        assert te(b"Hello\n" * 1000) == "7bit"
+        assert te(b"Hello\n" * 1000, allow_8bit=True) == "7bit"
+        assert te(b"x" * 999) == "quoted-printable"
+        assert te(b"x" * 998 + b"\r\n" + b"x" * 998) == "7bit"
+
+    def test_non_ascii(self):
+        """Test quoted-printable for mostly ASCII text, base64 for the rest"""
+        te = envelopes.serializer.transfer_encoding
+        mostly_ascii = u"Un caf\xe9, s'il vous pla\xeet".encode("utf-8")
+        assert te(mostly_ascii) == "quoted-printable"
+        assert te(u"\u3053\u3093\u306b\u3061\u306f".encode("utf-8")) == "base64"
+        assert te(mostly_ascii, allow_8bit=True) == "8bit"
+        assert te(mostly_ascii * 100, allow_8bit=True) == "quoted-printable"
+
+    def test_text_body(self):
+        """Test that the body decodes back to the text"""
+        import binascii
+
+        text = u"Un caf\xe9,\ns'il vous pla\xeet = " + u"x" * 100
+        charset, encoding, body = envelopes.serializer.text_body(text, "utf-8")
+        assert (charset, encoding) == ("utf-8", "quoted-printable")
+        assert max(len(line) for line in body.split(b"\n")) <= 76
+        assert binascii.a2b_qp(body).decode("utf-8") == text
+
+        assert envelopes.serializer.text_body(text, "utf-8", True) == \
+            ("utf-8", "8bit", text.encode("utf-8"))
+
+
+class TestMessageSkeleton(object):
+    """Class to test MessageSkeleton and SplicedMessage"""
+
+    def _serialized(self, **kwargs):
+        envl = envelopes.Envelope(from_addr="sender@example.com", subject="Hi",
+                                  html_body="Hello\n.hidden line", **kwargs)
+        envl.fast_serialize = True
+        return envelopes.SerializedEnvelope(envl)
+
+    def test_addressed_copy(self):
+        """Test that a copy parses back to the mail with its To header"""
+        envl = self._serialized()
+        copy = envl.addressed_copy((u"job@bob.com", u"Jöb"))
+        from_addr, to_addrs, msg = copy.sendmail_args()
+
+        assert (from_addr, to_addrs) == ("sender@example.com", ["=?utf-8?q?J=C3=B6b?= <job@bob.com>"])
+        assert copy.to_addr == [(u"job@bob.com", u"Jöb")]
+        parsed = copy.to_mime_message()
+        assert _header_value(parsed["To"]) == u"Jöb <job@bob.com>"
+        assert parsed["Subject"] == "Hi"
+        assert _payload(parsed.get_payload()[0]) == b"Hello\n.hidden line"
+
+        # the skeleton is made once and shared
+        other = envl.addressed_copy("pop@bob.com")
+        assert other.sendmail_args()[2]._skeleton is msg._skeleton
+
+    def test_data_chunks(self):
+        """Test that the chunks are what _quote_data makes of the message"""
+        from deltamail.envelopes_mod.conn import _quote_data
+
+        msg = self._serialized().addressed_copy("job@bob.com").sendmail_args()[2]
+        chunks = msg.data_chunks()
+        assert isinstance(chunks[1], memoryview)
+        assert chunks[0] + chunks[1].tobytes() == _quote_data(msg.tobytes())
+        assert len(msg) == len(msg.tobytes())
+
+    def test_has_to(self):
+        """Test that envelopes with a To header can't be spliced onto"""
+        envl = self._serialized(to_addr="job@bob.com")
+        try:
+            envl.addressed_copy("pop@bob.com")
+        except envelopes.envelope.MessageEncodeError:
+            pass
+        else:
+            assert False, "MessageEncodeError not raised"
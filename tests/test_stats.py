@@ -0,0 +1,83 @@
+"""Code to test the deltamail.envelopes_mod.stats module"""
+import smtplib
+
+try:
+    from unittest.mock import patch
+except:
+    from mock import patch
+
+from deltamail import envelopes_mod as envelopes
+from deltamail.envelopes_mod import stats
+from deltamail.mail import MailFactory
+
+
+class TestStats(object):
+    """Class to test the phase timers and counters"""
+
+    def teardown_method(self, method=None):
+        stats.disable()
+        stats.reset()
+
+    # nose looks for this name, pytest for the one above
+    teardown = teardown_method
+
+    def _send(self):
+        with patch('deltamail.envelopes_mod.conn.smtplib.SMTP', autospec=True) as mock_smtp:
+            mock_smtp.return_value.has_extn.return_value = False
+            mock_smtp.return_value.sendmail.return_value = {"pop@bob.com": (550, b"No")}
+
+            conn = envelopes.conn.SMTP("localhost")
+            for name in ("Job", "Pop"):
+                conn.send(MailFactory("sender@example.com", "Hi {{name}}",
+                                      ["job@bob.com", "pop@bob.com"],
+                                      "Hello {{name}}", {"name": name}))
+
+    def test_failed_not_sent(self):
+        """Test that messages the server didn't take aren't counted as sent"""
+        stats.enable()
+        with patch('deltamail.envelopes_mod.conn.smtplib.SMTP', autospec=True) as mock_smtp:
+            mock_smtp.return_value.has_extn.return_value = False
+            mock_smtp.return_value.sendmail.side_effect = \
+                smtplib.SMTPRecipientsRefused({"job@bob.com": (550, b"No")})
+
+            conn = envelopes.conn.SMTP("localhost")
+            try:
+                conn.sendmail("sender@example.com", ["job@bob.com"], "Hello")
+            except smtplib.SMTPRecipientsRefused:
+                pass
+
+        assert stats.snapshot()["timers"]["smtp"][0] == 1
+        assert "sent" not in stats.snapshot()["counters"]
+        assert " 0 sent (" in stats.status_line()
+
+    def test_disabled(self):
+        """Test that nothing is collected unless enabled"""
+        assert stats.timed("render") is stats._NO_TIMER
+        self._send()
+        assert stats.snapshot()["timers"] == {}
+        assert stats.snapshot()["counters"] == {}
+
+    def test_phases(self):
+        """Test that each phase of sending is timed"""
+        stats.enable()
+        self._send()
+
+        figures = stats.snapshot()
+        for phase in ("render", "mime", "serialize", "smtp"):
+            calls, seconds = figures["timers"][phase]
+            assert calls == 2
+            assert seconds >= 0
+        assert figures["counters"] == {"refused": 2, "sent": 2}
+
+        report = stats.report().splitlines()
+        assert [line.split()[0] for line in report[1:6]] == \
+            ["render", "mime", "serialize", "smtp", "refused"]
+        assert report[-1].startswith("elapsed: ")
+
+        assert " 2 sent (" in stats.status_line()
+
+        # the figures are kept when disabled, and cleared when enabled
+        stats.disable()
+        assert stats.snapshot()["timers"]["smtp"][0] == 2
+        stats.enable()
+        assert stats.snapshot()["timers"] == {}